@@ -0,0 +1,44 @@
+"""
+Search-box suggestions over the synthetic 50k-product catalog: the in-process
+prefix index against an istartswith query ordered by sales.
+
+    python -m benchmarks.autocomplete
+"""
+import time
+
+from benchmarks.product_search import seed
+from benchmarks.utils import test_database, measure, report
+
+from shop.autocomplete import get_index, suggestions
+from shop.models import Product
+
+QUERIES = ["c", "ca", "caf", "jugo ma", "arepa qu", "mara"]
+
+
+def legacy_suggestions(query):
+    return list(
+        Product.objects.filter(name__istartswith=query, available=True).order_by('-sales').values_list('name', flat=True)[:8]
+    )
+
+
+def cold_search(index, query):
+    index._memo.clear()
+    return index.search(query)
+
+
+def run(iterations=200):
+    with test_database():
+        seed()
+        start = time.perf_counter()
+        get_index()
+        print(f"index build: {(time.perf_counter() - start) * 1000:.0f} ms for {len(get_index())} entries")
+        index = get_index()
+        for query in QUERIES:
+            print(f"'{query}'")
+            report("  istartswith + ORDER BY sales", *measure(lambda: legacy_suggestions(query), iterations))
+            report("  prefix index, first lookup", *measure(lambda: cold_search(index, query), iterations))
+            report("  prefix index, repeated (memoized)", *measure(lambda: suggestions(query), iterations))
+
+
+if __name__ == "__main__":
+    run()
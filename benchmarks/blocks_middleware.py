@@ -0,0 +1,86 @@
+"""
+Per-request cost of BlocksMiddleware.
+
+Compares the previous implementation (one query per rule on every request)
+with the compiled schedule snapshot, cold (rebuilt every request) and warm.
+
+    python -m benchmarks.blocks_middleware
+"""
+from datetime import time as dtime
+
+from benchmarks.utils import test_database, measure, report
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.test import RequestFactory
+from django.utils import timezone
+
+from blocks.middleware.blocks_middleware import BlocksMiddleware
+from blocks.models import ActiveSite, Hours, DayBlock, VacationBlock, WeekendDay, WeekendDayHour
+from blocks.schedule import invalidate_schedule
+
+
+def legacy_process_request(request):
+    """The middleware body before the schedule snapshot, kept for comparison."""
+    active_site = ActiveSite.objects.first()
+    if not active_site:
+        return None
+
+    now = timezone.localtime()
+    today = now.date()
+    current_time = now.time()
+
+    if now.weekday() in [5, 6]:
+        weekend_day = WeekendDay.objects.filter(active_site=active_site).first()
+        if not weekend_day:
+            return render(request, "pages/blocks/no-service.html", status=503)
+        weekend_hours_qs = weekend_day.hours.all()
+        if not weekend_hours_qs.exists():
+            return render(request, "pages/blocks/no-service.html", status=503)
+        if not any(h.start_time <= current_time <= h.end_time for h in weekend_hours_qs):
+            return render(request, "pages/blocks/no-service.html", status=503)
+    else:
+        hours_qs = Hours.objects.filter(active_site=active_site)
+        list(hours_qs)  # stands in for the old print(hours_qs)
+        if not hours_qs.exists():
+            return render(request, "pages/blocks/no-service.html", status=503)
+        if not any(h.start_time <= current_time <= h.end_time for h in hours_qs):
+            return render(request, "pages/blocks/no-service.html", status=503)
+
+    if DayBlock.objects.filter(active_site=active_site, day=today).exists():
+        return render(request, "pages/blocks/no-service.html", status=503)
+
+    if VacationBlock.objects.filter(active_site=active_site, start_date__lte=today, end_date__gte=today).exists():
+        return render(request, "pages/blocks/no-service.html", status=503)
+    return None
+
+
+def seed():
+    site = ActiveSite.objects.create(name="Sitio")
+    Hours.objects.create(active_site=site, start_time=dtime(0, 0), end_time=dtime(23, 59, 59))
+    for day_of_week in (5, 6):
+        weekend_day = WeekendDay.objects.create(active_site=site, day_of_week=day_of_week)
+        WeekendDayHour.objects.create(weekend_day=weekend_day, start_time=dtime(0, 0), end_time=dtime(23, 59, 59))
+
+
+def run(iterations=2000):
+    with test_database():
+        seed()
+
+        middleware = BlocksMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+
+        def cold():
+            invalidate_schedule()
+            middleware.process_request(request)
+
+        report("legacy (query per rule)", *measure(lambda: legacy_process_request(request), iterations))
+        report("snapshot, rebuilt every request", *measure(cold, iterations))
+        middleware.process_request(request)
+        report("snapshot, warm", *measure(lambda: middleware.process_request(request), iterations))
+
+
+if __name__ == "__main__":
+    run()
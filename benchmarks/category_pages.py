@@ -0,0 +1,51 @@
+"""
+Category listing over a 20k-product category: the previous full materialization
+against one keyset page, at the start and deep into the listing.
+
+    python -m benchmarks.category_pages
+"""
+from benchmarks.utils import test_database, measure, report
+
+from django.contrib.auth import get_user_model
+
+from shop.models import Category, Product
+from shop.pagination import KeysetPage, encode_cursor
+
+
+def seed(products=20_000):
+    seller = get_user_model().objects.create_user(code="seller", first_name="Ana", last_name="Gómez", is_seller=True)
+    category = Category.objects.create(name="Categoría", slug="categoria")
+    Product.objects.bulk_create(
+        Product(
+            category=category,
+            seller=seller,
+            name=f"Producto {p}",
+            slug=f"producto-{p}",
+            price=1000,
+            sales=p % 500,
+            offer_active=(p % 50 == 0),
+            image="product_images/test.webp",
+        )
+        for p in range(products)
+    )
+    return category
+
+
+def run(iterations=20):
+    with test_database():
+        category = seed()
+        def listing():
+            return Product.objects.listing().filter(category=category)
+
+        deep = encode_cursor(listing()[15_000])
+
+        report("full category (previous)", *measure(lambda: list(
+            Product.objects.filter(category=category, available=True).select_related('seller').order_by('-offer_active', '-sales')
+        ), iterations))
+        report("first keyset page", *measure(lambda: KeysetPage(listing()).products, iterations))
+        report("keyset page after 15k products", *measure(lambda: KeysetPage(listing(), deep).products, iterations))
+        report("OFFSET page after 15k products", *measure(lambda: list(listing()[15_000:15_024]), iterations))
+
+
+if __name__ == "__main__":
+    run()
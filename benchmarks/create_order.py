@@ -0,0 +1,70 @@
+"""
+orders.tasks.create_order for orders of 1, 10 and 50 lines: the previous
+per-line loop against the bulk version.
+
+    python -m benchmarks.create_order
+"""
+from decimal import Decimal
+from unittest.mock import patch
+
+from benchmarks.utils import test_database, measure, report
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+
+from orders.models import Order, OrderItem
+from orders.tasks import create_order
+from shop.models import Category, Product
+
+LINE_COUNTS = (1, 10, 50)
+
+
+def seed(products=200, categories=10):
+    seller = get_user_model().objects.create_user(code="seller", first_name="Ana", last_name="Gómez", is_seller=True)
+    get_user_model().objects.create_user(code="buyer", first_name="Luis", last_name="Pérez")
+    category_objs = Category.objects.bulk_create(
+        Category(name=f"Categoría {c}", slug=f"categoria-{c}") for c in range(categories)
+    )
+    return Product.objects.bulk_create(
+        Product(
+            category=category_objs[p % categories], seller=seller, name=f"Producto {p}", slug=f"producto-{p}",
+            price=1000, final_price=1000, image="product_images/test.webp",
+        )
+        for p in range(products)
+    )
+
+
+def legacy_create_order(user_code, products, paid=False, school_address=""):
+    """The per-line loop create_order used before, without the on-commit hooks."""
+    user = get_user_model().objects.get(code=user_code)
+    order = Order.objects.create(user=user, paid=paid, school_address=school_address)
+    for p in products:
+        product = Product.objects.get(id=p["product_id"])
+        OrderItem.objects.create(order=order, product=product, price=Decimal(p["price"]), quantity=p["quantity"])
+        Product.objects.filter(id=product.id).update(sales=F("sales") + p["quantity"])
+        product.category.sales = F("sales") + p["quantity"]
+        product.category.save(update_fields=["sales"])
+    return order
+
+
+def checkout(create, lines):
+    # Like order_create_view, inside one transaction. The on-commit hooks (catalog
+    # version bump, recommendation refresh) run after the transaction and are
+    # left out, as the old loop did not have them.
+    with patch('orders.tasks.schedule_refresh'), patch('orders.tasks.transaction.on_commit'):
+        with transaction.atomic():
+            create("buyer", lines, paid=True, school_address="classroom_01")
+
+
+def run(iterations=50):
+    with test_database():
+        products = seed()
+        for count in LINE_COUNTS:
+            lines = [{'product_id': p.id, 'price': "1000", 'quantity': 1} for p in products[:count]]
+            report(f"{count} lines, per-line loop", *measure(lambda: checkout(legacy_create_order, lines), iterations))
+            report(f"{count} lines, bulk", *measure(lambda: checkout(create_order, lines), iterations))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,80 @@
+"""
+Queued checkout: how long the request takes when it creates the order itself
+against when it only charges and queues it, and how many orders per second a
+pool of 1, 2 and 4 workers gets through, with the in-process and database brokers.
+
+    python -m benchmarks.order_pipeline
+"""
+import time
+from unittest.mock import patch
+
+from benchmarks.create_order import seed
+from benchmarks.utils import test_database, measure, report
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test.utils import override_settings
+from PIL import Image
+
+from orders.models import Checkout, Order
+from orders.pipeline import DatabaseBroker, WorkerPool, get_broker
+from orders.tasks import create_order, debit_credit, reserve_order
+from shop.models import CartItem
+
+LINES = 5
+QUEUED_ORDERS = 200
+POOL_SIZES = (1, 2, 4)
+
+
+def in_request_checkout(user, lines):
+    """What order_create_view did before: charge and create the order in the request."""
+    with transaction.atomic():
+        debit_credit(user, 5000)
+        CartItem.objects.filter(cart__user=user).delete()
+        create_order(user.code, lines, paid=True, school_address="classroom_01")
+
+
+def queued_checkout(user, lines):
+    reserve_order(user, lines, 5000, "classroom_01")
+
+
+def throughput(broker, workers, user, lines):
+    """Queues QUEUED_ORDERS checkouts, then times `workers` threads until all are done."""
+    for _ in range(QUEUED_ORDERS):
+        queued_checkout(user, lines)
+    pool = WorkerPool(broker, workers)
+    start = time.perf_counter()
+    pool.start()
+    while Checkout.objects.filter(status__in=('queued', 'processing')).exists():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    assert not Checkout.objects.filter(status='failed').exists()
+    return QUEUED_ORDERS / elapsed
+
+
+def run(iterations=100):
+    # static/ is not part of the checkout; a blank logo stands in for the favicon.
+    logo = Image.new("RGBA", (64, 64))
+    with test_database(), override_settings(ORDER_BROKER_URL='memory://', ORDER_WORKERS=0), \
+            patch('orders.generate_qr.Image.open', return_value=logo):
+        products = seed()
+        user = get_user_model().objects.get(code="buyer")
+        get_user_model().objects.filter(pk=user.pk).update(credit=50_000_000)
+        lines = [{'product_id': p.id, 'price': "1000", 'quantity': 1} for p in products[:LINES]]
+
+        report(f"request, order created in it ({LINES} lines)", *measure(lambda: in_request_checkout(user, lines), iterations))
+        report(f"request, order queued ({LINES} lines)", *measure(lambda: queued_checkout(user, lines), iterations))
+        broker = get_broker()
+        while broker.dequeue(timeout=0) is not None:
+            pass
+        Checkout.objects.all().delete()
+
+        print(f"\n{QUEUED_ORDERS} queued orders of {LINES} lines ({Order.objects.count()} orders already in history)")
+        for label, broker in (("memory://", get_broker()), ("db://", DatabaseBroker())):
+            for workers in POOL_SIZES:
+                print(f"  {label:<10} {workers} workers {throughput(broker, workers, user, lines):>10.1f} orders/s")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,76 @@
+"""
+Product search over a synthetic 50k-product catalog: the previous
+name__icontains scan against the full-text index.
+
+    python -m benchmarks.product_search
+"""
+import random
+
+from benchmarks.utils import test_database, measure, report
+
+from django.contrib.auth import get_user_model
+
+from shop.models import Category, Product
+from shop.search_index import rebuild_index, search_product_ids
+
+WORDS = [
+    "café", "leche", "arepa", "empanada", "jugo", "mango", "queso", "pan", "chocolate", "galleta",
+    "pollo", "arroz", "maíz", "limón", "fresa", "natural", "grande", "pequeño", "combo", "especial",
+]
+QUERIES = ["cafe", "empanada pollo", "jugo mango", "chocolate", "arepa queso", "limon"]
+SYLLABLES = ["ma", "ra", "to", "lu", "pe", "si", "co", "na", "bo", "ti", "fu", "de", "la", "mi", "so", "ga"]
+
+
+def catalog_words(rng, size=5_000):
+    """Pseudo-words so that, like a real catalog, each term matches only a small share of products."""
+    return ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+def pick_words(rng, vocabulary, k):
+    return [rng.choice(WORDS) if rng.random() < 0.05 else rng.choice(vocabulary) for _ in range(k)]
+
+
+def seed(products=50_000, categories=30):
+    rng = random.Random(42)
+    vocabulary = catalog_words(rng)
+    seller = get_user_model().objects.create_user(code="seller", first_name="Ana", last_name="Gómez", is_seller=True)
+    category_objs = Category.objects.bulk_create(
+        Category(name=f"Categoría {c}", slug=f"categoria-{c}") for c in range(categories)
+    )
+    batch = []
+    for p in range(products):
+        name = " ".join(pick_words(rng, vocabulary, 3))
+        batch.append(Product(
+            category=rng.choice(category_objs),
+            seller=seller,
+            name=name,
+            slug=f"producto-{p}",
+            description=" ".join(pick_words(rng, vocabulary, 8)),
+            price=rng.randint(500, 10_000),
+            sales=rng.randint(0, 1_000),
+            image="product_images/test.webp",
+        ))
+        if len(batch) == 5_000:
+            Product.objects.bulk_create(batch)
+            batch = []
+    Product.objects.bulk_create(batch)
+    rebuild_index()
+
+
+def legacy_search(query):
+    return list(
+        Product.objects.filter(name__icontains=query, available=True).order_by('-offer_active', '-sales').values_list('id', flat=True)
+    )
+
+
+def run(iterations=20):
+    with test_database():
+        seed()
+        for query in QUERIES:
+            print(f"'{query}': {len(legacy_search(query))} icontains matches, {len(search_product_ids(query, limit=50_000))} full-text matches")
+            report("  icontains (name only, accent-sensitive)", *measure(lambda: legacy_search(query), iterations))
+            report("  full-text (top 200)", *measure(lambda: search_product_ids(query), iterations))
+
+
+if __name__ == "__main__":
+    run()
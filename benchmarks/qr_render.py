@@ -0,0 +1,63 @@
+"""
+Order QR rendering: the previous order_qr() (logo reopened and resized, base64 PNG
+on every view) against the cached renderer, cold and from its memory and disk caches.
+
+    python -m benchmarks.qr_render
+"""
+import base64
+import io
+import tempfile
+import time
+import uuid
+from unittest.mock import patch
+
+import benchmarks.utils  # noqa: F401  (sets up Django)
+
+from django.test.utils import override_settings
+from PIL import Image
+
+from orders import generate_qr
+from orders.generate_qr import QRCache, make_qr, render_png, render_svg
+
+
+def legacy_order_qr(qr_data, logo_path):
+    """order_qr() as it was: the logo is read and resized on every call."""
+    qr_img = make_qr(qr_data).make_image(fill_color="black", back_color="white").convert("RGB")
+    logo = Image.open(logo_path)
+    qr_width, qr_height = qr_img.size
+    logo_size = qr_width // 4
+    logo = logo.resize((logo_size, logo_size))
+    pos = ((qr_width - logo_size) // 2, (qr_height - logo_size) // 2)
+    qr_img.paste(logo, pos, mask=logo if logo.mode == "RGBA" else None)
+    buffer = io.BytesIO()
+    qr_img.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def rate(label, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<45} {iterations / elapsed:>10.1f} renders/s")
+
+
+def run(iterations=200):
+    codes = [str(uuid.uuid4()) for _ in range(iterations)]
+    with tempfile.TemporaryDirectory() as directory, override_settings(QR_CACHE_DIR=directory):
+        # static/ is not part of the checkout; a 256x256 icon stands in for the favicon.
+        logo_path = f"{directory}/favicon.ico"
+        Image.new("RGBA", (256, 256), "green").save(logo_path)
+        with patch.object(generate_qr, 'LOGO_PATH', logo_path):
+            rate("previous order_qr (logo read every time)", lambda i: legacy_order_qr(codes[i], logo_path), iterations)
+            rate("PNG, logo loaded once", lambda i: render_png(codes[i]), iterations)
+            rate("SVG, no PIL", lambda i: render_svg(codes[i]), iterations)
+
+            cold = QRCache()
+            rate("cache miss (render + write to disk)", lambda i: cold.get(codes[i]), iterations)
+            rate("memory cache hit", lambda i: cold.get(codes[i]), iterations)
+            rate("disk cache hit (new process)", lambda i: QRCache().get(codes[i]), iterations)
+
+
+if __name__ == "__main__":
+    run()
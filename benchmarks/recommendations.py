@@ -0,0 +1,78 @@
+"""
+"Bought together" recommendations over a synthetic order history: the full
+rebuild with and without NumPy, the incremental refresh after one order, and
+the product page lookup.
+
+    python -m benchmarks.recommendations
+"""
+import random
+import time
+from unittest.mock import patch
+
+from benchmarks.utils import test_database, measure, report
+
+from django.contrib.auth import get_user_model
+
+from orders.models import Order, OrderItem
+from shop import recommendations
+from shop.models import Category, Product
+from shop.recommendations import rebuild_recommendations, recommended_products, refresh_recommendations
+
+
+def seed(products=2_000, orders=20_000, categories=20):
+    rng = random.Random(42)
+    User = get_user_model()
+    seller = User.objects.create_user(code="seller", first_name="Ana", last_name="Gómez", is_seller=True)
+    buyer = User.objects.create_user(code="buyer", first_name="Luis", last_name="Pérez")
+    category_objs = Category.objects.bulk_create(
+        Category(name=f"Categoría {c}", slug=f"categoria-{c}") for c in range(categories)
+    )
+    product_objs = Product.objects.bulk_create(
+        Product(
+            category=rng.choice(category_objs), seller=seller, name=f"Producto {p}", slug=f"producto-{p}",
+            price=1000, image="product_images/test.webp",
+        )
+        for p in range(products)
+    )
+    order_objs = Order.objects.bulk_create(Order(user=buyer, school_address="11A") for _ in range(orders))
+    # Popular products are bought far more often, as in a real shop.
+    weights = [1 / (rank + 1) for rank in range(products)]
+    items = []
+    for order in order_objs:
+        for product in set(rng.choices(product_objs, weights, k=rng.randint(1, 5))):
+            items.append(OrderItem(order=order, product=product, price=1000, quantity=1))
+    OrderItem.objects.bulk_create(items, batch_size=5_000)
+    return product_objs, len(items)
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print(f"{label:<45} {(time.perf_counter() - start) * 1000:>12.1f} ms")
+    return result
+
+
+def run(iterations=200):
+    with test_database():
+        products, items = seed()
+        print(f"{len(products)} products, {items} order lines")
+        pairs = list(recommendations.order_items().values_list('order_id', 'product_id'))
+        if recommendations.numpy is not None:
+            timed("co-occurrence only (NumPy)", lambda: recommendations.top_neighbours(pairs))
+        with patch.object(recommendations, 'numpy', None):
+            timed("co-occurrence only (pure Python)", lambda: recommendations.top_neighbours(pairs))
+        timed("full rebuild", rebuild_recommendations)
+
+        popular, rare = products[0], products[-1]
+        timed("incremental refresh, 3 products", lambda: refresh_recommendations([popular.id, products[10].id, rare.id]))
+        def legacy_related():
+            related = Product.objects.filter(category=popular.category, available=True).exclude(id=popular.id).order_by('-offer_active', '-sales')
+            return list(related[:20]) if related.count() > 10 else list(related[:10])
+
+        report("product page, previous category query", *measure(legacy_related, iterations))
+        report("product page lookup", *measure(lambda: recommended_products([popular.id]), iterations))
+        report("cart lookup (5 products)", *measure(lambda: recommended_products([p.id for p in products[:5]]), iterations))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,53 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Benchmarks run against a throwaway test database, never against db.sqlite3.
+Run them from the project root, for example:
+
+    python -m benchmarks.blocks_middleware
+"""
+import os
+import time
+from contextlib import contextmanager
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', "luis_carlos_cooperativa.settings")
+django.setup()
+
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+@contextmanager
+def test_database():
+    """Creates the test database, yields, and destroys it afterwards."""
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def measure(func, iterations=1000):
+    """Returns (microseconds per call, queries per call) for `func`."""
+    executed = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal executed
+        executed += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+    return elapsed / iterations * 1_000_000, executed / iterations
+
+
+def report(label, micros, queries):
+    print(f"{label:<45} {micros:>12.1f} µs/op {queries:>8.1f} queries/op")
@@ -5,3 +5,6 @@ class BlocksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blocks'
     verbose_name = 'Sitio activo'
+
+    def ready(self):
+        from . import signals  # noqa: F401
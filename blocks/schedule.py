@@ -0,0 +1,255 @@
+import math
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+
+from .models import ActiveSite, Hours, DayBlock, VacationBlock, WeekendDayHour
+
+SCHEDULE_VERSION_KEY = "blocks:schedule:version"
+
+# Seconds a process trusts its snapshot before checking the shared version key.
+VERSION_CHECK_INTERVAL = 5
+
+WEEKEND_DAYS = (5, 6)
+
+# How far ahead next_transition() looks for the site to open or close.
+TRANSITION_HORIZON_DAYS = 366
+
+NO_SERVICE_TEMPLATE = "pages/blocks/no-service.html"
+
+
+class ServiceSchedule:
+    """
+    Compiled snapshot of the active site's service rules:
+        - weekday service hours
+        - weekend service hours (per day)
+        - blocked days
+        - vacation periods
+    Once built it answers "is the site open?" without touching the database.
+    """
+
+    def __init__(self, active=False, weekday_hours=(), weekend_hours=None, blocked_days=(), vacations=()):
+        self.active = active
+        self.weekday_hours = tuple(weekday_hours)
+        self.weekend_hours = {day: tuple(hours) for day, hours in (weekend_hours or {}).items()}
+        self.blocked_days = frozenset(blocked_days)
+        self.vacations = tuple(vacations)
+        # (is_open, computed_at, until) for the last evaluated instant.
+        self._state = None
+        # (reopens_at, rendered body) of the last 503 page.
+        self._blocked_page = None
+
+    @classmethod
+    def from_db(cls):
+        active_site = ActiveSite.objects.first()
+        if not active_site:
+            return cls()
+
+        # Past blocks can never apply again, so they are left out of the snapshot.
+        today = timezone.localdate()
+
+        weekday_hours = Hours.objects.filter(
+            active_site=active_site
+        ).order_by('start_time').values_list('start_time', 'end_time')
+
+        weekend_hours = {}
+        weekend_hours_qs = WeekendDayHour.objects.filter(
+            weekend_day__active_site=active_site
+        ).order_by('start_time').values_list('weekend_day__day_of_week', 'start_time', 'end_time')
+        for day_of_week, start_time, end_time in weekend_hours_qs:
+            weekend_hours.setdefault(day_of_week, []).append((start_time, end_time))
+
+        blocked_days = DayBlock.objects.filter(
+            active_site=active_site,
+            day__gte=today
+        ).values_list('day', flat=True)
+
+        vacations = VacationBlock.objects.filter(
+            active_site=active_site,
+            end_date__gte=today
+        ).order_by('start_date').values_list('start_date', 'end_date')
+
+        return cls(
+            active=True,
+            weekday_hours=weekday_hours,
+            weekend_hours=weekend_hours,
+            blocked_days=blocked_days,
+            vacations=vacations,
+        )
+
+    def hours_for(self, day):
+        """Returns the service windows that apply to a date."""
+        weekday = day.weekday()
+        if weekday in WEEKEND_DAYS:
+            return self.weekend_hours.get(weekday, ())
+        return self.weekday_hours
+
+    def is_blocked_day(self, day):
+        if day in self.blocked_days:
+            return True
+        return any(start <= day <= end for start, end in self.vacations)
+
+    def open_windows(self, day):
+        """Returns the merged (start, end) service windows of a date, empty if the day is blocked."""
+        if self.is_blocked_day(day):
+            return ()
+
+        windows = []
+        for start, end in sorted(self.hours_for(day)):
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(end, windows[-1][1]))
+            else:
+                windows.append((start, end))
+        return windows
+
+    def _is_open_at(self, now):
+        today = now.date()
+        current_time = now.time()
+
+        if not any(start <= current_time <= end for start, end in self.hours_for(today)):
+            return False
+
+        return not self.is_blocked_day(today)
+
+    def next_transition(self, now=None):
+        """
+        Returns the next moment the site changes state: when the current window
+        ends if it is open, or when it opens again if it is closed.
+        Returns None if nothing changes within TRANSITION_HORIZON_DAYS.
+        """
+        if not self.active:
+            return None
+
+        now = timezone.localtime(now)
+        is_open = self._is_open_at(now)
+
+        for offset in range(TRANSITION_HORIZON_DAYS):
+            day = now.date() + timedelta(days=offset)
+            for start, end in self.open_windows(day):
+                start_at = timezone.make_aware(datetime.combine(day, start))
+                end_at = timezone.make_aware(datetime.combine(day, end))
+                if is_open and start_at <= now <= end_at:
+                    return end_at
+                if not is_open and start_at > now:
+                    return start_at
+        return None
+
+    def state(self, now=None):
+        """
+        Returns (is_open, until) at `now` (defaults to the current local time).
+        The answer is memoized until the next transition, so repeated calls are O(1).
+        """
+        if not self.active:
+            return True, None
+
+        now = timezone.localtime(now)
+        cached = self._state
+        if cached is not None:
+            is_open, computed_at, until = cached
+            valid_until = until if until is not None else computed_at + timedelta(days=1)
+            if computed_at <= now < valid_until:
+                return is_open, until
+
+        is_open = self._is_open_at(now)
+        until = self.next_transition(now)
+        self._state = (is_open, now, until)
+        return is_open, until
+
+    def is_open(self, now=None):
+        """Returns True if the site is in service at `now` (defaults to the current local time)."""
+        return self.state(now)[0]
+
+    def blocked_page(self, reopens_at):
+        """Returns the rendered 503 body, rendered once per reopening time."""
+        cached = self._blocked_page
+        if cached is None or cached[0] != reopens_at:
+            body = render_to_string(NO_SERVICE_TEMPLATE, {'reopens_at': reopens_at})
+            cached = self._blocked_page = (reopens_at, body)
+        return cached[1]
+
+
+_schedule = None
+_schedule_version = None
+_checked_at = 0.0
+
+
+def _current_version():
+    version = cache.get(SCHEDULE_VERSION_KEY)
+    if version is None:
+        cache.add(SCHEDULE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(SCHEDULE_VERSION_KEY)
+    return version
+
+
+def get_schedule():
+    """
+    Returns the process-wide ServiceSchedule, rebuilding it when the shared
+    version key changes. The key is checked at most every VERSION_CHECK_INTERVAL seconds.
+    """
+    global _schedule, _schedule_version, _checked_at
+
+    checked_at = time.monotonic()
+    if _schedule is not None and checked_at - _checked_at < VERSION_CHECK_INTERVAL:
+        return _schedule
+
+    version = _current_version()
+    if _schedule is None or version != _schedule_version:
+        _schedule = ServiceSchedule.from_db()
+        _schedule_version = version
+    _checked_at = checked_at
+    return _schedule
+
+
+def blocked_response(now=None):
+    """
+    Returns the 503 response for a blocked request, or None if the site is open.
+    The body is pre-rendered and the response carries Retry-After and a
+    private max-age that both end at the next opening.
+    """
+    now = timezone.localtime(now)
+    schedule = get_schedule()
+    is_open, reopens_at = schedule.state(now)
+    if is_open:
+        return None
+
+    response = HttpResponse(schedule.blocked_page(reopens_at), status=503)
+    if reopens_at is not None:
+        retry_after = max(1, math.ceil((reopens_at - now).total_seconds()))
+        response['Retry-After'] = str(retry_after)
+        patch_cache_control(response, private=True, max_age=retry_after)
+    return response
+
+
+def is_exempt_user(user):
+    """Staff, superusers and sellers are never blocked."""
+    try:
+        return user.is_authenticated and (user.is_staff or user.is_superuser or getattr(user, 'is_seller', False))
+    except Exception:
+        return False
+
+
+def check_request(request, exempt_paths=()):
+    """
+    Shared evaluation used by BlocksMiddleware and the BlocksView decorator.
+    Returns the 503 response if the request must be blocked, otherwise None.
+    """
+    if any(request.path.startswith(p) for p in exempt_paths):
+        return None
+
+    if is_exempt_user(getattr(request, 'user', None)):
+        return None
+
+    return blocked_response()
+
+
+def invalidate_schedule():
+    """Drops the local snapshot and bumps the shared version so other processes rebuild too."""
+    global _schedule
+    _schedule = None
+    cache.set(SCHEDULE_VERSION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from .models import ActiveSite, Hours, DayBlock, VacationBlock, WeekendDay, WeekendDayHour
+from .schedule import invalidate_schedule
+
+SCHEDULE_MODELS = (ActiveSite, Hours, WeekendDay, WeekendDayHour, DayBlock, VacationBlock)
+
+
+def schedule_changed(sender, **kwargs):
+    # Wait for the commit so no process rebuilds the snapshot from stale rows.
+    transaction.on_commit(invalidate_schedule)
+
+
+for model in SCHEDULE_MODELS:
+    post_save.connect(schedule_changed, sender=model, dispatch_uid=f"blocks_schedule_save_{model.__name__}")
+    post_delete.connect(schedule_changed, sender=model, dispatch_uid=f"blocks_schedule_delete_{model.__name__}")
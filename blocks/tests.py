@@ -0,0 +1,144 @@
+from datetime import date, datetime, time, timedelta
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import ActiveSite, Hours, DayBlock, VacationBlock, WeekendDay, WeekendDayHour
+from .decorators import BlocksView
+from .middleware.blocks_middleware import BlocksMiddleware
+from .schedule import ServiceSchedule, blocked_response, get_schedule, invalidate_schedule
+
+
+def local_datetime(day, hour, minute=0):
+    return timezone.make_aware(datetime.combine(day, time(hour, minute)))
+
+
+class ServiceScheduleTests(TestCase):
+    # 2030-01-07 is a Monday, 2030-01-12 a Saturday.
+    MONDAY = date(2030, 1, 7)
+    SATURDAY = date(2030, 1, 12)
+
+    def setUp(self):
+        invalidate_schedule()
+        self.addCleanup(invalidate_schedule)
+        self.site = ActiveSite.objects.create(name="Sitio")
+        Hours.objects.create(active_site=self.site, start_time=time(9, 0), end_time=time(11, 0))
+        saturday = WeekendDay.objects.create(active_site=self.site, day_of_week=5)
+        WeekendDayHour.objects.create(weekend_day=saturday, start_time=time(10, 0), end_time=time(12, 0))
+
+    def test_no_active_site_is_open(self):
+        self.assertTrue(ServiceSchedule().is_open())
+
+    def test_service_hours(self):
+        schedule = ServiceSchedule.from_db()
+        self.assertTrue(schedule.is_open(local_datetime(self.MONDAY, 10)))
+        self.assertFalse(schedule.is_open(local_datetime(self.MONDAY, 12)))
+        self.assertTrue(schedule.is_open(local_datetime(self.SATURDAY, 11)))
+        self.assertFalse(schedule.is_open(local_datetime(self.SATURDAY + timedelta(days=1), 11)))
+
+    def test_day_and_vacation_blocks(self):
+        DayBlock.objects.create(active_site=self.site, day=self.MONDAY)
+        VacationBlock.objects.create(
+            active_site=self.site,
+            start_date=self.MONDAY + timedelta(days=1),
+            end_date=self.MONDAY + timedelta(days=3),
+        )
+        schedule = ServiceSchedule.from_db()
+        self.assertFalse(schedule.is_open(local_datetime(self.MONDAY, 10)))
+        self.assertFalse(schedule.is_open(local_datetime(self.MONDAY + timedelta(days=2), 10)))
+        self.assertTrue(schedule.is_open(local_datetime(self.MONDAY + timedelta(days=4), 10)))
+
+    def test_warm_schedule_does_not_query(self):
+        get_schedule()
+        with self.assertNumQueries(0):
+            get_schedule().is_open(local_datetime(self.MONDAY, 10))
+
+    def test_changes_rebuild_the_schedule(self):
+        self.assertTrue(get_schedule().is_open(local_datetime(self.MONDAY, 10)))
+        with self.captureOnCommitCallbacks(execute=True):
+            DayBlock.objects.create(active_site=self.site, day=self.MONDAY)
+        self.assertFalse(get_schedule().is_open(local_datetime(self.MONDAY, 10)))
+
+    def test_next_transition(self):
+        VacationBlock.objects.create(
+            active_site=self.site,
+            start_date=self.MONDAY + timedelta(days=1),
+            end_date=self.MONDAY + timedelta(days=3),
+        )
+        schedule = ServiceSchedule.from_db()
+        self.assertEqual(schedule.next_transition(local_datetime(self.MONDAY, 10)), local_datetime(self.MONDAY, 11))
+        self.assertEqual(schedule.next_transition(local_datetime(self.MONDAY, 8)), local_datetime(self.MONDAY, 9))
+        # Closed after hours, through the vacation, until Friday morning.
+        self.assertEqual(
+            schedule.next_transition(local_datetime(self.MONDAY, 12)),
+            local_datetime(self.MONDAY + timedelta(days=4), 9),
+        )
+        # Friday evening opens on Saturday's weekend hours.
+        self.assertEqual(schedule.next_transition(local_datetime(self.SATURDAY - timedelta(days=1), 12)), local_datetime(self.SATURDAY, 10))
+
+    def test_blocked_response_has_retry_after(self):
+        now = local_datetime(self.MONDAY, 8, 30)
+        response = blocked_response(now)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(30 * 60))
+        self.assertIn('max-age=1800', response['Cache-Control'])
+        self.assertIsNone(blocked_response(local_datetime(self.MONDAY, 10)))
+
+    def test_blocked_response_is_served_from_memory(self):
+        now = local_datetime(self.MONDAY, 8, 30)
+        blocked_response(now)
+        with self.assertNumQueries(0):
+            first = blocked_response(now + timedelta(minutes=1))
+            second = blocked_response(now + timedelta(minutes=2))
+        self.assertEqual(first.content, second.content)
+
+
+class BlocksGateTests(TestCase):
+    """The middleware and the BlocksView decorator share the same schedule core."""
+
+    def setUp(self):
+        invalidate_schedule()
+        self.addCleanup(invalidate_schedule)
+        # An active site with no service hours is always closed.
+        ActiveSite.objects.create(name="Sitio")
+        self.request = RequestFactory().get('/')
+        self.request.user = AnonymousUser()
+
+    def test_middleware_blocks_without_queries(self):
+        middleware = BlocksMiddleware(lambda request: HttpResponse())
+        middleware.process_request(self.request)
+        with self.assertNumQueries(0):
+            response = middleware.process_request(self.request)
+        self.assertEqual(response.status_code, 503)
+
+    def test_decorator_blocks_without_queries(self):
+        view = BlocksView(lambda request: HttpResponse("ok"))
+        view(self.request)
+        with self.assertNumQueries(0):
+            response = view(self.request)
+        self.assertEqual(response.status_code, 503)
+
+    def test_decorator_calls_view_when_open(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ActiveSite.objects.all().delete()
+        view = BlocksView(lambda request: HttpResponse("ok"))
+        view(self.request)
+        with self.assertNumQueries(0):
+            response = view(self.request)
+        self.assertEqual(response.content, b"ok")
+
+    def test_sellers_are_not_blocked(self):
+        seller = get_user_model().objects.create_user(code="seller", first_name="Ana", last_name="Gómez", is_seller=True)
+        self.request.user = seller
+        view = BlocksView(lambda request: HttpResponse("ok"))
+        self.assertEqual(view(self.request).status_code, 200)
+
+    def test_cart_add_view_is_gated(self):
+        user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.client.force_login(user)
+        response = self.client.post(reverse('shop:cart_add', args=[1]), {'quantity': 1})
+        self.assertEqual(response.status_code, 503)
@@ -1,17 +1,14 @@
 from django import template
-from shop.models import Cart  
+from shop.cart import get_cart_count
 
 register = template.Library()
 
 @register.simple_tag(takes_context=True)
-def cart_tag(context):
-    """Retorna el carrito del usuario"""
+def cart_count(context):
+    """Retorna el número de productos en el carrito sin consultar la base de datos"""
     request = context.get('request')
 
-    if request and request.user.is_authenticated:
-        cart, created = Cart.objects.get_or_create(user=request.user)
-        return cart
-    
-    return None  
-
+    if request:
+        return get_cart_count(request)
 
+    return 0
@@ -1,8 +1,9 @@
 from django import template
 from shop.models import Category  
+from shop.catalog_cache import get_or_set
 register = template.Library()
 
 @register.simple_tag
 def navbar_categories():
-    """Carga las categorías desde la base de datos"""
-    return Category.objects.all()
+    """Carga las categorías desde la caché del catálogo"""
+    return get_or_set('navbar:categories', lambda: list(Category.objects.values('name', 'slug')))
@@ -1,3 +1,52 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
 from django.test import TestCase
+from django.urls import reverse
 
-# Create your tests here.
+from shop.models import Category, Product
+
+
+def clear_caches():
+    """Empties every cache alias: the default one and the carts."""
+    for cache in caches.all():
+        cache.clear()
+
+
+def create_catalog(categories, products_per_category):
+    seller = get_user_model().objects.create_user(
+        code="seller", first_name="Ana", last_name="Gómez", is_seller=True, cooperative_name="Cooperativa"
+    )
+    for c in range(categories):
+        category = Category.objects.create(name=f"Categoría {c}", slug=f"categoria-{c}")
+        for p in range(products_per_category):
+            Product.objects.create(
+                category=category,
+                seller=seller,
+                name=f"Producto {c}-{p}",
+                slug=f"producto-{c}-{p}",
+                price=1000 + p,
+                sales=p,
+                offer_active=(p == 0),
+                image="product_images/test.webp",
+            )
+
+
+class HomeViewTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+
+    def test_top_per_category(self):
+        create_catalog(categories=2, products_per_category=6)
+        products = list(Product.objects.top_per_category(4))
+        self.assertEqual(len(products), 8)
+        first_category = [p.name for p in products[:4]]
+        # Offers first, then by sales.
+        self.assertEqual(first_category, ["Producto 0-0", "Producto 0-5", "Producto 0-4", "Producto 0-3"])
+
+    def test_home_queries_do_not_grow_with_categories(self):
+        create_catalog(categories=30, products_per_category=5)
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('home:home'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['category_products']), 30)
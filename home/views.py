@@ -1,56 +1,62 @@
 from django.shortcuts import render
-from shop.models import Product, Category, ShowBestOffers
+from django.utils.functional import SimpleLazyObject
 
+from shop.models import Product, ShowBestOffers
+from shop.facets import Facets
+from shop.pagination import listing_page, page_query, render_results
+
+# Catalog pages only query the database when their cached fragment
+# ({% catalog_cache cache_name %}) misses, so the data is passed lazily.
 
-def home_view(request):
-    categories_list = Category.objects.all()
-    best_offers = ShowBestOffers.objects.filter(active=True)
 
+def home_products():
     category_products = {}
+    for product in Product.objects.top_per_category(4):
+        category_products.setdefault(product.category, []).append(product)
+    return category_products
 
-    for category in categories_list:
-        products = Product.objects.filter(category=category).order_by("-offer_active", "-sales")[:4]
-        if products.exists():
-            category_products[category] = products
+
+def home_view(request):
+    best_offers = SimpleLazyObject(
+        lambda: list(ShowBestOffers.objects.filter(active=True).select_related('category'))
+    )
 
     context = {
-        'category_products': category_products,
-        'best_offers': best_offers,  
+        'category_products': SimpleLazyObject(home_products),
+        'best_offers': best_offers,
+        'cache_name': 'home',
     }
 
     return render(request, 'pages/home/home.html', context)
 
 def offers_view(request):
-    all_offers = Product.objects.filter(offer_active=True).order_by('-discount_percent', '-sales')
-
-    category_dict = {}
-    for product in all_offers:
-        category_name = product.category.name
-        category_dict.setdefault(category_name, []).append(product)
+    page, filters = listing_page(request, Product.objects.listing().filter(offer_active=True))
 
     context = {
-        'search_results': all_offers, 
-        'categories': category_dict,
+        'page': page,
+        'filters': filters,
+        'facets': SimpleLazyObject(lambda: Facets(page.queryset, request)),
+        'show_category_facet': True,
+        'facets_cache_name': f'facets:offers:{page.variant}',
+        'page_query': page_query(request),
         'search_query': 'Ofertas',
         'results_empty': 'No se hay ofertas aún.',
+        'cache_name': f'offers:{page.cache_key}',
     }
 
-    return render(request, 'pages/shop/search/search.html', context)
+    return render_results(request, 'pages/shop/search/search.html', context)
 
 def best_sellers_view(request):
-    best_sellers = Product.objects.all().order_by('-sales')[:22]
-
-    category_dict = {}
+    best_sellers = SimpleLazyObject(lambda: list(
+        Product.objects.select_related('category', 'seller').order_by('-sales')[:22]
+    ))
 
-    for product in best_sellers:
-        category_name = product.category.name
-        category_dict.setdefault(category_name, []).append(product) 
-        
     context = {
-        'search_results': best_sellers,
-        'categories': category_dict,
+        # A single fixed page, so there is no cursor.
+        'page': {'products': best_sellers},
         'search_query': 'Lo más Vendido',
         'results_empty': 'No se han vendido productos aún.',
+        'cache_name': 'best_sellers',
     }
     return render(request, 'pages/shop/search/search.html', context)
 
@@ -55,7 +55,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'blocks.middleware.blocks_middleware.BlocksMiddleware',
+    # Service hours are enforced per view with blocks.decorators.BlocksView
+    # (checkout and cart). Add 'blocks.middleware.blocks_middleware.BlocksMiddleware'
+    # here to block the whole site instead.
 
 
 
@@ -88,11 +90,69 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # A file, not the shared in-memory database, so that tests with several
+        # threads wait on locks like production does instead of failing at once.
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
+        # Transactions take the write lock when they start, so concurrent checkouts
+        # wait for each other instead of failing with "database is locked".
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
     }
 }
 
 
 
+# Cache
+# Local memory works for a single process. With several gunicorn workers use
+# 'django.core.cache.backends.filebased.FileBasedCache' (or Redis) so that
+# catalog and schedule invalidations reach every worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'luis-carlos-cooperativa',
+    },
+    'carts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'luis-carlos-cooperativa-carts',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# Cart
+# Logged-in users' carts live in the 'carts' cache and are written to CartItem
+# in batches (see shop.cart.WorkingCart); anonymous carts live in the session.
+# Unsaved clicks are lost if the cache drops the entry, at most
+# CART_SYNC_INTERVAL seconds of them. Every web process must see the same carts,
+# so production sets CART_CACHE_URL to a Redis server; `manage.py check --deploy`
+# fails while carts are kept in process memory (see shop.checks).
+CART_CACHE_URL = os.environ.get('CART_CACHE_URL', '')
+if CART_CACHE_URL:
+    CACHES['carts'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CART_CACHE_URL,
+    }
+CART_SESSION_ID = 'cart'
+CART_SYNC_INTERVAL = 30
+
+# Orders
+# Checkout only debits the credit and queues the order; a worker pool creates it
+# (see orders.pipeline). 'memory://' runs ORDER_WORKERS threads inside each web
+# process. 'db://' uses the Checkout table itself as the queue and 'redis://...'
+# uses a Redis list; both need `python manage.py run_order_workers` running.
+# Every pool enqueues again the checkouts a restarted process or a dead worker
+# left behind (see orders.pipeline.WorkerPool), so a charged student gets the order.
+ORDER_BROKER_URL = os.environ.get('ORDER_BROKER_URL', 'memory://')
+ORDER_WORKERS = 4
+# Processes that draw the printable pickup slips in print_order_slips (see
+# orders.slips); 0 draws them in the command itself. The web view always does.
+ORDER_SLIP_WORKERS = 2
+# Long-polls of the sellers' pending-order feed (see orders.feed) that each process
+# holds open at once; each one takes a thread for up to 25 seconds, the others are
+# answered at once and retried later. Run gunicorn with threads (--threads above
+# this number); with sync workers, which serve one request at a time, set it to 0.
+ORDER_FEED_LONG_POLLS = 2
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -137,6 +197,10 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media') 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles') 
 
+# Rendered order QR codes (orders.generate_qr). Outside MEDIA_ROOT on purpose:
+# a QR is what a student shows to collect an order, so it must not be public.
+QR_CACHE_DIR = os.path.join(BASE_DIR, 'qr_cache')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, OrderItem, OrderCancelItem
+from .models import Checkout, Order, OrderItem, OrderCancelItem
 
 
 class ReadOnlyOrderItemInline(admin.TabularInline):
@@ -50,7 +50,8 @@ class ReadOnlyOrderCancelItemInline(admin.TabularInline):
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'created', 'paid', 'status', 'total_amount', 'donot_show']
+    list_display = ['id', 'user', 'created', 'paid', 'status', 'item_count', 'total_amount', 'donot_show']
+    list_select_related = ['user']
     list_filter = ['paid', 'status', 'created']
     search_fields = ['id', 'user__code', 'user__first_name', 'user__last_name']
     ordering = ['-created']
@@ -65,19 +66,34 @@ class OrderAdmin(admin.ModelAdmin):
                 'school_address', 
                 'status',
                 'paid',
+                'item_count',
+                'subtotal',
+                'delivery_fee',
                 'total_amount',
                 'qr_code_data',
             )
         }),
     )
 
-    readonly_fields = ['id', 'created', 'total_amount', 'user', 'school_address', 'qr_code_data']
+    readonly_fields = [
+        'id', 'created', 'item_count', 'subtotal', 'delivery_fee', 'total_amount', 'user', 'school_address', 'qr_code_data'
+    ]
 
     inlines = [ReadOnlyOrderItemInline, ReadOnlyOrderCancelItemInline]
 
     def total_amount(self, obj):
         try:
-            return "${:,.2f}".format(obj.get_total_cost())
+            return "${:,.2f}".format(obj.total)
         except (TypeError, AttributeError):
             return "—"
     total_amount.short_description = 'Total de la orden'
+    total_amount.admin_order_field = 'total'
+
+
+@admin.register(Checkout)
+class CheckoutAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'created', 'status', 'total', 'order', 'attempts']
+    list_filter = ['status', 'created']
+    search_fields = ['id', 'user__code']
+    ordering = ['-created']
+    readonly_fields = ['user', 'products', 'total', 'school_address', 'order', 'error', 'attempts', 'created', 'updated']
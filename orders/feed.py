@@ -0,0 +1,153 @@
+"""
+Live feed of order changes for the sellers' pending-order screens.
+
+Every saved or deleted order is serialized once, after its transaction commits,
+into an in-process ring buffer. Seller screens long-poll with the `since_ts` of
+their last answer and get the changed orders from memory. The buffer only knows
+the changes made in this process (web requests and memory:// order workers), so
+every answer also runs one query for the orders newer than `since_id`: orders
+created by other processes arrive at the latest when the long-poll times out.
+
+A long-poll holds its thread while it waits. Each process keeps at most
+settings.ORDER_FEED_LONG_POLLS of them open; the rest are answered at once and
+told to come back after POLL_RETRY seconds.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.humanize.templatetags.humanize import intcomma
+from django.template.defaultfilters import floatformat
+from django.urls import reverse
+from django.utils import dateformat, timezone
+
+from .models import Order
+
+FEED_BUFFER_SIZE = 500
+# Longest a long-poll request is held open, in seconds.
+MAX_WAIT = 25
+# Seconds a screen waits before polling again when no long-poll slot was free.
+POLL_RETRY = 5
+
+
+class ChangeBuffer:
+    """
+    The last `size` changes as (ts, order_id, payload), in ts order. `ts` is a
+    strictly increasing wall-clock timestamp, so it can be handed out as a cursor.
+    Changes older than `floor` were evicted, or happened before the process started.
+    """
+
+    def __init__(self, size=FEED_BUFFER_SIZE):
+        self._entries = deque(maxlen=size)
+        self._condition = threading.Condition()
+        self._floor = self._last = time.time()
+
+    @property
+    def cursor(self):
+        """Timestamp of the latest change, to start following the feed from now."""
+        with self._condition:
+            return self._last
+
+    def publish(self, order_id, payload):
+        with self._condition:
+            ts = max(time.time(), self._last + 1e-6)
+            if len(self._entries) == self._entries.maxlen:
+                self._floor = self._entries[0][0]
+            self._entries.append((ts, order_id, payload))
+            self._last = ts
+            self._condition.notify_all()
+
+    def since(self, ts, timeout=0):
+        """
+        ([payload, ...], cursor) with the latest payload of every order changed after
+        `ts`, waiting up to `timeout` seconds for one. The payloads are None when
+        the buffer no longer reaches back to `ts`.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if ts < self._floor:
+                    return None, self._last
+                changed = {order_id: payload for entry_ts, order_id, payload in self._entries if entry_ts > ts}
+                remaining = deadline - time.monotonic()
+                if changed or remaining <= 0:
+                    return list(changed.values()), self._last
+                self._condition.wait(remaining)
+
+    def clear(self):
+        with self._condition:
+            self._entries.clear()
+            self._floor = self._last = time.time()
+
+
+changes = ChangeBuffer()
+
+_open_polls = 0
+_open_polls_lock = threading.Lock()
+
+
+@contextmanager
+def long_poll_slot():
+    """True while the request may wait for changes: one of ORDER_FEED_LONG_POLLS per process."""
+    global _open_polls
+    with _open_polls_lock:
+        granted = _open_polls < settings.ORDER_FEED_LONG_POLLS
+        if granted:
+            _open_polls += 1
+    try:
+        yield granted
+    finally:
+        if granted:
+            with _open_polls_lock:
+                _open_polls -= 1
+
+
+def order_payload(order):
+    """What a seller screen needs to draw an order row; `order` comes with its user and items loaded."""
+    items = list(order.items.all())
+    return {
+        'id': order.id,
+        'status': order.status,
+        'user_id': order.user_id,
+        'user': str(order.user),
+        'school_address': order.school_address,
+        'school_address_display': order.get_school_address_display(),
+        'created': dateformat.format(timezone.localtime(order.created), "d/m/Y H:i"),
+        'total': intcomma(floatformat(order.total, 0)),
+        'items': [{'name': item.product.name, 'quantity': item.quantity} for item in items],
+        'seller_ids': sorted({item.product.seller_id for item in items}),
+        'url': reverse('shop:order_detail', args=[order.id]),
+    }
+
+
+def load_payloads(orders):
+    return [order_payload(order) for order in orders.select_related('user').prefetch_related('items__product')]
+
+
+def publish_order(order_id):
+    """Serializes the committed order once, for every screen that follows the feed."""
+    payloads = load_payloads(Order.objects.filter(id=order_id))
+    if payloads:
+        changes.publish(order_id, payloads[0])
+    else:
+        publish_removed(order_id)
+
+
+def publish_removed(order_id):
+    changes.publish(order_id, {'id': order_id, 'status': 'deleted'})
+
+
+def visible_to(payload, seller, school_address="", mine=False):
+    """
+    Whether a pending order belongs on `seller`'s screen with these filters. Orders
+    that left the queue are always sent, so a screen showing them can drop the row.
+    """
+    if payload['status'] != 'pending':
+        return True
+    if payload['user_id'] == seller.pk:
+        return False
+    if school_address and payload['school_address'] != school_address:
+        return False
+    return not mine or seller.pk in payload['seller_ids']
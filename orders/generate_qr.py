@@ -1,8 +1,26 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import qrcode
+import qrcode.image.svg
 from PIL import Image
-import io, base64
 
-def order_qr(qr_data):
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LOGO_PATH = os.path.join(settings.BASE_DIR, "static", "assets", "icons", "favicon.ico")
+# Rendered images kept in memory per process; the disk cache holds all of them.
+QR_MEMORY_CACHE_SIZE = 256
+CONTENT_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def make_qr(qr_data):
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_H,
@@ -11,20 +29,108 @@ def order_qr(qr_data):
     )
     qr.add_data(qr_data)
     qr.make(fit=True)
+    return qr
+
+
+@lru_cache(maxsize=8)
+def load_logo(size):
+    """The logo resized to `size`, read from disk once per process and size; None if it is missing."""
+    try:
+        with Image.open(LOGO_PATH) as logo:
+            return logo.convert("RGBA").resize((size, size))
+    except OSError:
+        logger.warning("QR logo %s could not be read; rendering QR codes without it.", LOGO_PATH)
+        return None
 
-    qr_img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
 
-    logo_path = "static/assets/icons/favicon.ico" 
-    logo = Image.open(logo_path)
+def render_png(qr_data):
+    qr_img = make_qr(qr_data).make_image(fill_color="black", back_color="white").convert("RGB")
 
     qr_width, qr_height = qr_img.size
     logo_size = qr_width // 4
-    logo = logo.resize((logo_size, logo_size))
-    pos = ((qr_width - logo_size) // 2, (qr_height - logo_size) // 2)
-    qr_img.paste(logo, pos, mask=logo if logo.mode == "RGBA" else None)
+    logo = load_logo(logo_size)
+    if logo is not None:
+        pos = ((qr_width - logo_size) // 2, (qr_height - logo_size) // 2)
+        qr_img.paste(logo, pos, mask=logo)
 
     buffer = io.BytesIO()
     qr_img.save(buffer, format="PNG")
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    return buffer.getvalue()
+
+
+def render_svg(qr_data):
+    """Vector QR drawn by qrcode alone, without PIL; ERROR_CORRECT_H, without the logo."""
+    return make_qr(qr_data).make_image(image_factory=qrcode.image.svg.SvgPathImage).to_string()
+
+
+RENDERERS = {"png": render_png, "svg": render_svg}
+
+
+def qr_digest(qr_data):
+    """Names the image of `qr_data` in the cache and in its URL."""
+    return hashlib.sha256(qr_data.encode()).hexdigest()[:32]
+
+
+class QRCache:
+    """
+    Rendered QR images by (digest, format): an LRU in memory in front of a directory
+    of files, so every process renders a given QR at most once. Files are written to
+    a temporary name and renamed, so a reader never sees half an image.
+    """
+
+    def __init__(self, size=QR_MEMORY_CACHE_SIZE):
+        self.size = size
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def path(self, digest, image_format):
+        return os.path.join(settings.QR_CACHE_DIR, digest[:2], f"{digest}.{image_format}")
+
+    def get(self, qr_data, image_format="png"):
+        key = (qr_digest(qr_data), image_format)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+
+        image = self._read(*key)
+        if image is None:
+            image = RENDERERS[image_format](qr_data)
+            self._write(*key, image)
+
+        with self._lock:
+            self._images[key] = image
+            if len(self._images) > self.size:
+                self._images.popitem(last=False)
+        return image
+
+    def _read(self, digest, image_format):
+        try:
+            with open(self.path(digest, image_format), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, digest, image_format, image):
+        path = self.path(digest, image_format)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(image)
+            os.replace(temporary, path)
+        except OSError:
+            logger.exception("Could not store the QR image %s.", path)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+
+
+qr_cache = QRCache()
+
 
-    return qr_base64
+def qr_image(qr_data, image_format="png"):
+    """PNG (or SVG) bytes of the QR for `qr_data`, rendered once and then served from the cache."""
+    return qr_cache.get(qr_data, image_format)
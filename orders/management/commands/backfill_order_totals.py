@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    help = "Calcula y guarda subtotal, envío, total y cantidad de ítems de los pedidos (por ejemplo, tras añadir las columnas)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Recalcula todos los pedidos, no solo los que no tienen totales.")
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all() if options['all'] else Order.objects.filter(item_count=0)
+        updated = orders.refresh_totals()
+        self.stdout.write(self.style.SUCCESS(f"Totales recalculados: {updated} pedidos."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+from orders.qr_tokens import make_qr_token, read_qr_token
+
+
+class Command(BaseCommand):
+    help = (
+        "Cambia el código QR de los pedidos pendientes que aún tienen uno antiguo (UUID) por un token firmado. "
+        "Los QR ya impresos o guardados de esos pedidos dejan de servir."
+    )
+
+    def handle(self, *args, **options):
+        orders = [
+            order for order in Order.objects.filter(status='pending').only('id', 'qr_code_data')
+            if read_qr_token(order.qr_code_data) != order.id
+        ]
+        for order in orders:
+            order.qr_code_data = make_qr_token(order.id)
+        Order.objects.bulk_update(orders, ['qr_code_data'], batch_size=500)
+        self.stdout.write(self.style.SUCCESS(f"Nuevos QR: {len(orders)} pedidos."))
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.models import Order
+from orders.slips import MAX_SLIPS, pending_slips, write_slips_pdf
+
+
+class Command(BaseCommand):
+    help = (
+        "Genera un PDF con la boleta de cada orden pendiente (QR y productos), una por página, "
+        f"en el orden de la cola, hasta {MAX_SLIPS}. --school-address imprime solo las de un salón."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Archivo PDF de salida.")
+        parser.add_argument(
+            '--school-address', default='',
+            choices=[value for value, label in Order._meta.get_field('school_address').choices],
+            help="Solo las órdenes de esta ubicación.",
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.ORDER_SLIP_WORKERS,
+            help="Procesos que dibujan las páginas (0 para hacerlo en este proceso).",
+        )
+
+    def handle(self, *args, **options):
+        orders = Order.objects.pending_queue()
+        if options['school_address']:
+            orders = orders.filter(school_address=options['school_address'])
+        count = orders.count()
+        if not count:
+            raise CommandError("No hay órdenes pendientes para imprimir.")
+
+        with open(options['output'], 'wb') as output:
+            pages = write_slips_pdf(pending_slips(orders), output, options['workers'])
+        self.stdout.write(self.style.SUCCESS(f"{pages} boletas en {options['output']}."))
+        if count > pages:
+            self.stdout.write(self.style.WARNING(
+                f"Quedaron {count - pages} órdenes sin imprimir; usa --school-address para imprimirlas por salón."
+            ))
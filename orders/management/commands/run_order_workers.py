@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from orders.pipeline import InProcessBroker, WorkerPool, create_broker, drain, requeue_checkouts
+
+
+class Command(BaseCommand):
+    help = (
+        "Crea los pedidos en cola con un grupo de workers (ORDER_BROKER_URL db:// o redis://). "
+        "Con memory://, o con --once, solo procesa los pendientes y termina."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.ORDER_WORKERS, help="Hilos de trabajo.")
+        parser.add_argument('--once', action='store_true', help="Procesa lo que hay en cola y termina.")
+
+    def handle(self, *args, **options):
+        broker = create_broker(settings.ORDER_BROKER_URL)
+
+        if options['once'] or isinstance(broker, InProcessBroker):
+            # A memory:// queue lives in each web process; here there are only the leftovers.
+            requeued = requeue_checkouts(broker)
+            if requeued:
+                self.stdout.write(f"{requeued} pedidos pendientes en cola de nuevo.")
+            taken = drain(broker)
+            self.stdout.write(self.style.SUCCESS(f"{taken} pedidos procesados."))
+            return
+
+        # The pool enqueues the leftovers itself, and later the checkouts that stall.
+        pool = WorkerPool(broker, options['workers'])
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(f"{options['workers']} workers procesando pedidos. Ctrl+C para salir."))
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            pool.stop(timeout=5)
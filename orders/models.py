@@ -1,13 +1,61 @@
-import uuid
-
 from django.db import models
 from shop.models import Product
 from users.models import CustomUser
 from datetime import date
 
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.core.exceptions import ValidationError
 from users.models import CustomUser  
+from decimal import Decimal
+
+from .qr_tokens import make_qr_token
+
+# Pedidos recogidos en la cooperativa no pagan envío; el resto paga DELIVERY_FEE.
+PICKUP_ADDRESS = 'cooperative'
+DELIVERY_FEE = Decimal('300')
+
+# Order columns written together by Order.set_totals().
+TOTAL_FIELDS = ['subtotal', 'delivery_fee', 'total', 'item_count']
+
+
+def delivery_fee(school_address):
+    return Decimal('0') if school_address == PICKUP_ADDRESS else DELIVERY_FEE
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def pending_queue(self):
+        """Pending orders oldest first, read in order from the (status, created) index."""
+        return self.filter(status='pending').order_by('created', 'id')
+
+    def after_created(self, created, id):
+        """Orders that come after (created, id) in queue order; `created__gte` lets the index seek to the cursor."""
+        return self.filter(models.Q(created__gt=created) | models.Q(created=created, id__gt=id), created__gte=created)
+
+    def containing_products_of(self, seller):
+        """Orders with at least one product of `seller`, without the duplicates a join would add."""
+        return self.filter(
+            models.Exists(OrderItem.objects.filter(order=models.OuterRef('pk'), product__seller=seller))
+        )
+
+    def refresh_totals(self):
+        """Recomputes the stored totals from the items in a single UPDATE, e.g. to backfill them."""
+        money = models.DecimalField(max_digits=10, decimal_places=2)
+        items = OrderItem.objects.filter(order=models.OuterRef('pk')).order_by().values('order')
+        subtotal = Coalesce(
+            models.Subquery(items.annotate(subtotal=models.Sum(models.F('price') * models.F('quantity'))).values('subtotal')),
+            models.Value(Decimal('0')),
+            output_field=money,
+        )
+        item_count = Coalesce(models.Subquery(items.annotate(count=models.Sum('quantity')).values('count')), 0)
+        fee = models.Case(
+            models.When(school_address=PICKUP_ADDRESS, then=models.Value(Decimal('0'))),
+            default=models.Value(DELIVERY_FEE),
+            output_field=money,
+        )
+        return self.update(subtotal=subtotal, delivery_fee=fee, total=subtotal + fee, item_count=item_count)
+
 
 class Order(models.Model):
     user = models.ForeignKey(
@@ -84,7 +132,17 @@ class Order(models.Model):
         help_text='ID del pedido'
     )
 
-    qr_code_data = models.CharField(max_length=255, null=True, blank=True)
+    # Signed token printed in the QR (see orders.qr_tokens); unique, so a scan can find the order by it.
+    qr_code_data = models.CharField(max_length=255, null=True, blank=True, unique=True)
+
+    # Written by create_order() and refresh_totals(), so lists never add up the items.
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    delivery_fee = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
+
+    # Sent by the confirmation form, so a double click or a retry returns the same order.
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
 
     seller_approved = models.ForeignKey(
         CustomUser,
@@ -95,18 +153,39 @@ class Order(models.Model):
         verbose_name='Aprobado por'
     )
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created']
-        indexes = [models.Index(fields=['-created'])]
+        # SQLite appends the rowid to every index, so this one also serves the
+        # (created, id) tie-break of the pending queue.
+        indexes = [
+            models.Index(fields=['-created']),
+            models.Index(fields=['status', 'created'], name='order_status_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_order_idempotency_key'),
+        ]
 
     def __str__(self):
         return f'Order {self.id} - {self.user.code}'
     
     def get_total_cost(self):
-        total = sum(item.get_cost() for item in self.items.all())
-        if self.school_address != "cooperative":
-            total += 300
-        return total
+        return self.total
+
+    def set_totals(self, subtotal, item_count):
+        self.subtotal = subtotal
+        self.item_count = item_count
+        self.delivery_fee = delivery_fee(self.school_address)
+        self.total = self.subtotal + self.delivery_fee
+
+    def refresh_totals(self):
+        """Recomputes the stored totals from the items with one aggregate query; the caller saves them."""
+        totals = self.items.aggregate(
+            subtotal=models.Sum(models.F('price') * models.F('quantity'), output_field=models.DecimalField()),
+            item_count=models.Sum('quantity'),
+        )
+        self.set_totals(totals['subtotal'] or Decimal('0'), totals['item_count'] or 0)
     
     def clean_delete(self):
         if self.status in ['processing', 'reimbursing']:
@@ -129,9 +208,50 @@ class Order(models.Model):
             raise ValidationError("El usuario que aprueba la orden debe ser vendedor.")
 
     def save(self, *args, **kwargs):
-        if not self.qr_code_data:
-            self.qr_code_data = str(uuid.uuid4()) 
         super().save(*args, **kwargs)
+        if not self.qr_code_data:
+            # The token signs the order id, so it can only be issued once the row has one.
+            self.qr_code_data = make_qr_token(self.pk)
+            Order.objects.filter(pk=self.pk).update(qr_code_data=self.qr_code_data)
+
+class Checkout(models.Model):
+    """
+    Checkout already paid and queued: the request only debits the credit and stores
+    this row; a worker of orders.pipeline creates the order from it.
+    """
+    STATUS_CHOICES = [
+        ('queued', 'En cola'),
+        ('processing', 'Procesando'),
+        ('done', 'Listo'),
+        ('failed', 'Fallido'),
+    ]
+
+    user = models.ForeignKey(CustomUser, related_name='checkouts', on_delete=models.CASCADE)
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True, editable=False)
+    # [{"product_id", "price", "quantity"}, ...] as returned by CartSummary.order_products().
+    products = models.JSONField()
+    total = models.DecimalField(max_digits=10, decimal_places=2)
+    school_address = models.CharField(max_length=30)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    order = models.OneToOneField(Order, related_name='checkout', on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'created'])]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'idempotency_key'], name='unique_checkout_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f'Checkout {self.id} - {self.user_id} ({self.status})'
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
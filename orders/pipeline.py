@@ -0,0 +1,275 @@
+"""
+Queued checkout: the request debits the credit and stores a Checkout
+(orders.tasks.reserve_order), the broker carries its id, and a pool of worker
+threads creates the order (orders.tasks.fulfil_order) while the student polls
+the checkout status.
+
+The broker is chosen by settings.ORDER_BROKER_URL:
+
+    memory://           queue.Queue in this process, workers are threads of it
+    db://               the Checkout table is the queue, no extra service needed
+    redis://host:port/0 a Redis list (falls back to db:// without the redis package)
+"""
+import logging
+import queue
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Checkout
+from .tasks import fulfil_order
+
+try:
+    import redis
+except ImportError:  # Redis is optional; db:// needs nothing but the database.
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# A checkout still 'processing' after this long belongs to a worker that died, and
+# one 'queued' this long ago was probably lost with the memory:// queue of its process.
+STALLED_AFTER = timedelta(minutes=5)
+# Seconds between two looks for stalled checkouts in a running pool.
+REQUEUE_INTERVAL = 60
+
+
+class Broker:
+    """Carries checkout ids from the request to the workers."""
+
+    def enqueue(self, checkout_id):
+        raise NotImplementedError
+
+    def dequeue(self, timeout):
+        """Next checkout id, waiting up to `timeout` seconds (0 does not wait), or None."""
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """
+    queue.Queue drained by `workers` threads of the same process, started with the
+    first checkout. Checkouts queued when the process stops stay 'queued' in the
+    database; the pool enqueues them again when it starts (see WorkerPool).
+    """
+
+    def __init__(self, workers=0):
+        self.queue = queue.Queue()
+        self.workers = workers
+        self.pool = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, checkout_id):
+        self.start()
+        self.queue.put(checkout_id)
+
+    def dequeue(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def start(self):
+        if not self.workers or self.pool is not None:
+            return
+        with self._lock:
+            if self.pool is None:
+                self.pool = WorkerPool(self, self.workers)
+                self.pool.start()
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+
+class DatabaseBroker(Broker):
+    """
+    The Checkout table is the queue: the row is committed before it is enqueued, so
+    enqueue() has nothing to do and workers look for the oldest queued checkout over
+    the (status, created) index. fulfil_order() claims it with a conditional UPDATE,
+    so workers that pick the same id do not both process it.
+    """
+
+    poll_interval = 0.5
+
+    def enqueue(self, checkout_id):
+        pass
+
+    def dequeue(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            checkout_id = (
+                Checkout.objects.filter(status='queued').order_by('created', 'id').values_list('id', flat=True).first()
+            )
+            if checkout_id is not None or time.monotonic() >= deadline:
+                return checkout_id
+            time.sleep(self.poll_interval)
+
+
+class RedisBroker(Broker):
+    """LPUSH on checkout, BRPOP in the workers, so every web process and worker shares one queue."""
+
+    key = "orders:checkouts"
+
+    def __init__(self, url):
+        self.client = redis.Redis.from_url(url)
+
+    def enqueue(self, checkout_id):
+        self.client.lpush(self.key, checkout_id)
+
+    def dequeue(self, timeout):
+        if not timeout:
+            item = self.client.rpop(self.key)
+            return int(item) if item is not None else None
+        item = self.client.brpop(self.key, timeout=max(1, int(timeout)))
+        return int(item[1]) if item is not None else None
+
+
+def create_broker(url, workers=0):
+    scheme = url.split("://", 1)[0]
+    if scheme == "memory":
+        return InProcessBroker(workers)
+    if scheme == "db":
+        return DatabaseBroker()
+    if scheme in ("redis", "rediss"):
+        if redis is None:
+            logger.warning("ORDER_BROKER_URL points to Redis but the redis package is not installed; using db://.")
+            return DatabaseBroker()
+        return RedisBroker(url)
+    raise ImproperlyConfigured(f"Unknown ORDER_BROKER_URL scheme: {url!r}")
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The process-wide broker for settings.ORDER_BROKER_URL."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = create_broker(settings.ORDER_BROKER_URL, settings.ORDER_WORKERS)
+    return _broker
+
+
+def reset_broker(**kwargs):
+    global _broker
+    if kwargs.get('setting') not in (None, 'ORDER_BROKER_URL', 'ORDER_WORKERS'):
+        return
+    with _broker_lock:
+        if isinstance(_broker, InProcessBroker):
+            _broker.stop()
+        _broker = None
+
+
+setting_changed.connect(reset_broker, dispatch_uid="orders_reset_broker")
+
+
+class WorkerPool:
+    """
+    `size` threads that take checkout ids from `broker` and fulfil them, and one more
+    that enqueues again the checkouts left behind: all the queued ones when the pool
+    starts, then every REQUEUE_INTERVAL those stalled for longer than STALLED_AFTER.
+    Without it, a charged student would wait forever for an order that a restarted
+    process or a dead worker never created.
+    """
+
+    def __init__(self, broker, size):
+        self.broker = broker
+        self.size = size
+        self.threads = []
+        self._stopping = threading.Event()
+
+    def start(self):
+        targets = [(self._requeue, "order-requeue")]
+        targets += [(self._run, f"order-worker-{i}") for i in range(self.size)]
+        for target, name in targets:
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        try:
+            while not self._stopping.is_set():
+                checkout_id = self.broker.dequeue(timeout=1)
+                if checkout_id is None:
+                    continue
+                process(checkout_id)
+                close_old_connections()
+        finally:
+            connection.close()
+
+    def _requeue(self):
+        stalled_only = False
+        try:
+            while True:
+                try:
+                    requeued = requeue_checkouts(self.broker, stalled_only=stalled_only)
+                    if requeued:
+                        logger.info("%s checkouts left behind queued again.", requeued)
+                except Exception:
+                    logger.exception("Could not requeue stalled checkouts.")
+                close_old_connections()
+                stalled_only = True
+                if self._stopping.wait(REQUEUE_INTERVAL):
+                    break
+        finally:
+            connection.close()
+
+
+def process(checkout_id):
+    """Fulfils one checkout; an error is logged so it never stops the worker."""
+    try:
+        return fulfil_order(checkout_id)
+    except Exception:
+        logger.exception("Could not process checkout %s.", checkout_id)
+
+
+def drain(broker=None):
+    """Fulfils every checkout waiting in `broker` in this thread. Returns how many were taken."""
+    broker = broker or get_broker()
+    taken = 0
+    while (checkout_id := broker.dequeue(timeout=0)) is not None:
+        process(checkout_id)
+        taken += 1
+    return taken
+
+
+def requeue_checkouts(broker=None, stalled_only=False):
+    """
+    Enqueues again the checkouts a stopped process or a dead worker left behind:
+    'processing' for longer than STALLED_AFTER, and every 'queued' one, or with
+    `stalled_only` only those queued for longer than that. Enqueuing one twice is
+    harmless: fulfil_order() claims each checkout once.
+    """
+    broker = broker or get_broker()
+    now = timezone.now()
+    cutoff = now - STALLED_AFTER
+    stalled = Q(status='processing', updated__lt=cutoff)
+    if stalled_only:
+        stalled |= Q(status='queued', updated__lt=cutoff)
+    else:
+        stalled |= Q(status='queued')
+    checkout_ids = list(Checkout.objects.filter(stalled).order_by('created', 'id').values_list('id', flat=True))
+    # Touched, so a checkout that only waits in a long queue is not pushed again every round.
+    Checkout.objects.filter(stalled, id__in=checkout_ids).update(status='queued', updated=now)
+    for checkout_id in checkout_ids:
+        broker.enqueue(checkout_id)
+    return len(checkout_ids)
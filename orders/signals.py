@@ -0,0 +1,20 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from . import feed
+from .models import Order
+
+
+def order_saved(sender, instance, **kwargs):
+    # After the commit, so the feed sees the items bulk-created with a new order.
+    order_id = instance.pk
+    transaction.on_commit(lambda: feed.publish_order(order_id))
+
+
+def order_deleted(sender, instance, **kwargs):
+    order_id = instance.pk
+    transaction.on_commit(lambda: feed.publish_removed(order_id))
+
+
+post_save.connect(order_saved, sender=Order, dispatch_uid="orders_feed_order_save")
+post_delete.connect(order_deleted, sender=Order, dispatch_uid="orders_feed_order_delete")
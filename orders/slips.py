@@ -0,0 +1,174 @@
+"""
+Printable pickup slips: one A6 page per order with its QR code and items, all
+joined in a single PDF for the staff to print the pending queue at once.
+
+Pages are drawn with Pillow from plain dicts (see `slip_data`), in the calling
+process or, for print_order_slips, in a pool of processes, and appended to the PDF
+in queue order. Only a few page images exist at a time, but PyPDF2 keeps every
+page until the PDF is written, so one PDF holds at most MAX_SLIPS slips.
+"""
+import io
+import multiprocessing
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .generate_qr import qr_image
+
+try:
+    import PyPDF2
+except ImportError:  # Listed in requirements.txt; only needed to join the pages.
+    PyPDF2 = None
+
+# A6 at 150 dpi.
+PAGE_SIZE = (620, 874)
+PAGE_DPI = 150
+MARGIN = 36
+QR_SIZE = 330
+LINE_HEIGHT = 30
+# Found in the system font directories; Pillow's own font has no accented letters.
+FONT_NAME = "DejaVuSans.ttf"
+# Pages rendered or waiting to be appended, per worker process.
+PAGES_IN_FLIGHT = 4
+# Orders read from the database per query while streaming the queue.
+CHUNK_SIZE = 200
+# Slips in one PDF: the writer holds all of its pages in memory.
+MAX_SLIPS = 300
+# Spooled PDFs above this many bytes move from memory to a temporary file.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def slip_data(order):
+    """What a slip prints about `order`, as plain data that can be sent to another process."""
+    # Imported here so worker processes, which only draw, never load the models.
+    from .feed import order_payload
+
+    return {**order_payload(order), 'qr_data': order.qr_code_data}
+
+
+def pending_slips(orders):
+    """
+    Streams the slips of the first MAX_SLIPS `orders`, in their order, loading
+    CHUNK_SIZE orders at a time.
+    """
+    orders = orders.select_related('user').prefetch_related('items__product')[:MAX_SLIPS]
+    for order in orders.iterator(chunk_size=CHUNK_SIZE):
+        yield slip_data(order)
+
+
+@lru_cache(maxsize=4)
+def font(size):
+    try:
+        return ImageFont.truetype(FONT_NAME, size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+def fit(draw, text, text_font, width):
+    """`text` cut with an ellipsis so it fits in `width` pixels."""
+    if draw.textlength(text, font=text_font) <= width:
+        return text
+    while text and draw.textlength(f"{text}…", font=text_font) > width:
+        text = text[:-1]
+    return f"{text}…"
+
+
+def render_slip(slip):
+    """One-page PDF (bytes) with the slip of one order."""
+    page = Image.new("RGB", PAGE_SIZE, "white")
+    draw = ImageDraw.Draw(page)
+    width = PAGE_SIZE[0] - 2 * MARGIN
+    title, body, small = font(40), font(24), font(20)
+
+    y = MARGIN
+    draw.text((MARGIN, y), f"Orden #{slip['id']}", font=title, fill="black")
+    y += 56
+    for text, text_font in (
+        (slip['user'], body),
+        (f"Entregar en: {slip['school_address_display']}", body),
+        (slip['created'], small),
+    ):
+        draw.text((MARGIN, y), fit(draw, text, text_font, width), font=text_font, fill="black")
+        y += 34
+
+    with Image.open(io.BytesIO(qr_image(slip['qr_data']))) as qr:
+        qr = qr.convert("RGB").resize((QR_SIZE, QR_SIZE))
+    page.paste(qr, ((PAGE_SIZE[0] - QR_SIZE) // 2, y))
+    y += QR_SIZE + 12
+
+    total_y = PAGE_SIZE[1] - MARGIN - 48
+    items = slip['items']
+    # The lines that fit above the total; when some do not, the last one sums them up.
+    room = (total_y - y) // LINE_HEIGHT
+    shown = items if len(items) <= room else items[:room - 1]
+    for item in shown:
+        line = fit(draw, f"{item['quantity']} x {item['name']}", body, width)
+        draw.text((MARGIN, y), line, font=body, fill="black")
+        y += LINE_HEIGHT
+    if len(shown) < len(items):
+        rest = sum(item['quantity'] for item in items[len(shown):])
+        draw.text((MARGIN, y), f"y {rest} productos más", font=body, fill="black")
+
+    draw.text((MARGIN, total_y), f"Total: ${slip['total']} COP", font=title, fill="black")
+
+    buffer = io.BytesIO()
+    page.save(buffer, format="PDF", resolution=PAGE_DPI)
+    return buffer.getvalue()
+
+
+def start_worker(qr_cache_dir):
+    # A new process reads the settings module again; share this process' QR cache.
+    settings.QR_CACHE_DIR = qr_cache_dir
+
+
+def render_pages(slips, workers):
+    """
+    The page of every slip, in order. With `workers` > 1 they are drawn in that many
+    processes, keeping at most PAGES_IN_FLIGHT per worker submitted at a time.
+    """
+    if workers <= 1:
+        yield from map(render_slip, slips)
+        return
+
+    # Not forked: when the caller has other threads (a server's, the order workers),
+    # a child could inherit a lock one of them holds, such as the QR cache's.
+    context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=start_worker, initargs=(settings.QR_CACHE_DIR,),
+    ) as pool:
+        pending = deque()
+        for slip in slips:
+            pending.append(pool.submit(render_slip, slip))
+            if len(pending) >= workers * PAGES_IN_FLIGHT:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_slips_pdf(slips, output, workers=0):
+    """Writes the slips as one PDF to the binary file `output`; returns the number of pages."""
+    if PyPDF2 is None:
+        raise ImproperlyConfigured("PyPDF2 is required to print order slips; install requirements.txt.")
+
+    writer = PyPDF2.PdfWriter()
+    pages = 0
+    for page in render_pages(slips, workers):
+        # add_page copies the page into the writer, so its reader can be dropped.
+        writer.add_page(PyPDF2.PdfReader(io.BytesIO(page)).pages[0])
+        pages += 1
+    writer.write(output)
+    return pages
+
+
+def slips_pdf(slips, workers=0):
+    """(file, pages): the PDF in a spooled temporary file, rewound for reading."""
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    pages = write_slips_pdf(slips, output, workers)
+    output.seek(0)
+    return output, pages
@@ -1,17 +1,24 @@
+import logging
+from collections import Counter
 from decimal import Decimal
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.core.exceptions import ValidationError
-from django.db.models import F
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
 
-from .models import Order, OrderItem
-from shop.models import Product
+from .generate_qr import qr_image
+from .models import Checkout, Order, OrderItem
+from shop.models import CartItem, Category, Product
+from shop.catalog_cache import bump_sales_version
+from shop.recommendations import schedule_refresh
 from django.contrib.auth import get_user_model
-from background_task import background
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
-#@background(schedule=0)
-def create_order(user_code, products: list, paid: bool = False, school_address: str = ""):
+def create_order(user_code, products: list, paid: bool = False, school_address: str = "", idempotency_key=None):
     """
     Crea un pedido y actualiza las ventas de productos y categorías.
     """
@@ -20,30 +27,149 @@ def create_order(user_code, products: list, paid: bool = False, school_address:
     if not school_address:
         raise ValidationError("The address cannot be empty.")
 
-    order = Order.objects.create(
-        user=user,
-        paid=paid,
-        school_address=school_address
-    )
-
+    catalog = Product.objects.only('id', 'price', 'category_id').in_bulk([p["product_id"] for p in products])
     for p in products:
-        try:
-            product = Product.objects.get(id=p["product_id"])
-        except Product.DoesNotExist:
+        if p["product_id"] not in catalog:
             raise ValidationError(f"The product ID {p['product_id']} does not exist.")
 
-        OrderItem.objects.create(
+    order = Order(
+        user=user,
+        paid=paid,
+        school_address=school_address,
+        idempotency_key=idempotency_key
+    )
+    # bulk_create skips OrderItem.save(), so its price fallback is applied here.
+    items = [
+        OrderItem(
             order=order,
-            product=product,
-            price=Decimal(p["price"]),
+            product_id=p["product_id"],
+            price=Decimal(p.get("price") or 0) or catalog[p["product_id"]].price,
             quantity=p["quantity"]
         )
+        for p in products
+    ]
+    order.set_totals(sum(item.get_cost() for item in items), sum(item.quantity for item in items))
+    order.save()
+    OrderItem.objects.bulk_create(items)
+
+    product_sales = Counter()
+    category_sales = Counter()
+    for p in products:
+        product_sales[p["product_id"]] += p["quantity"]
+        category_sales[catalog[p["product_id"]].category_id] += p["quantity"]
+    add_sales(Product, product_sales)
+    add_sales(Category, category_sales)
+
+    # Sales counters change the product ranking shown on cached catalog pages;
+    # categories, product cards and prices do not depend on them.
+    transaction.on_commit(bump_sales_version)
+    schedule_refresh([p["product_id"] for p in products])
+
+    return order
 
-        Product.objects.filter(id=product.id).update(
-            sales=F("sales") + p["quantity"]
+
+def add_sales(model, increments):
+    """
+    Suma las ventas de varias filas con un solo UPDATE: sales = sales + CASE id WHEN ... END.
+    """
+    if not increments:
+        return
+    model.objects.filter(id__in=increments).update(
+        sales=F("sales") + Case(
+            *[When(id=pk, then=Value(amount)) for pk, amount in increments.items()],
+            default=Value(0),
         )
+    )
 
-        product.category.sales = F("sales") + p["quantity"]
-        product.category.save(update_fields=["sales"])
 
+def debit_credit(user, amount):
+    """
+    Descuenta `amount` del crédito solo si alcanza, con un UPDATE condicional
+    (credit >= amount): dos pagos simultáneos no pueden dejar el saldo negativo.
+    """
+    return User.objects.filter(pk=user.pk, credit__gte=amount).update(credit=F("credit") - amount) == 1
+
+
+def reserve_order(user, products: list, total, school_address: str, idempotency_key=None):
+    """
+    Parte de la petición en el checkout: cobra el pedido, vacía el carrito guardado y
+    deja un Checkout en cola en una sola transacción; al confirmarse, lo encola en el
+    broker. Devuelve el Checkout, o None si el crédito no alcanza. Si ya existe uno con
+    la misma clave de idempotencia (doble clic o reintento), lo devuelve sin cobrar de nuevo.
+    """
+    from .pipeline import get_broker
+
+    try:
+        with transaction.atomic():
+            if not debit_credit(user, total):
+                return None
+            CartItem.objects.filter(cart__user=user).delete()
+            checkout = Checkout.objects.create(
+                user=user,
+                products=products,
+                total=total,
+                school_address=school_address,
+                idempotency_key=idempotency_key
+            )
+            transaction.on_commit(lambda: get_broker().enqueue(checkout.id))
+            return checkout
+    except IntegrityError:
+        # A concurrent submit with the same key won; the debit above was rolled back.
+        existing = Checkout.objects.filter(user=user, idempotency_key=idempotency_key).first() if idempotency_key else None
+        if existing is None:
+            raise
+        return existing
+
+
+def fulfil_order(checkout_id):
+    """
+    Parte del worker: crea el pedido de un Checkout en cola y deja su QR listo.
+    El Checkout se toma con un UPDATE condicional, así que si el broker lo entrega dos
+    veces solo un worker lo procesa. Si el pedido no se puede crear (un producto se
+    borró, por ejemplo) se devuelve el crédito y el Checkout queda como fallido.
+    """
+    claimed = Checkout.objects.filter(id=checkout_id, status='queued').update(
+        status='processing', attempts=F('attempts') + 1, updated=timezone.now()
+    )
+    if not claimed:
+        return None
+    checkout = Checkout.objects.get(id=checkout_id)
+
+    try:
+        with transaction.atomic():
+            order = create_order(
+                checkout.user_id,
+                checkout.products,
+                paid=True,
+                school_address=checkout.school_address,
+                idempotency_key=checkout.idempotency_key
+            )
+            Checkout.objects.filter(id=checkout_id).update(status='done', order=order, updated=timezone.now())
+    except IntegrityError:
+        # A previous attempt created the order but died before marking the checkout.
+        order = None
+        if checkout.idempotency_key:
+            order = Order.objects.filter(user_id=checkout.user_id, idempotency_key=checkout.idempotency_key).first()
+        if order is None:
+            return fail_checkout(checkout, "No se pudo crear el pedido.")
+        Checkout.objects.filter(id=checkout_id).update(status='done', order=order, updated=timezone.now())
+    except (ValidationError, Http404) as error:
+        return fail_checkout(checkout, "; ".join(getattr(error, 'messages', [str(error)])))
+    except Exception:
+        logger.exception("Could not create the order of checkout %s.", checkout_id)
+        return fail_checkout(checkout, "No se pudo crear el pedido.")
+
+    try:
+        # Rendered now so the QR page the student is sent to is served from the cache.
+        qr_image(order.qr_code_data)
+    except Exception:
+        logger.exception("Could not render the QR of order %s.", order.id)
     return order
+
+
+def fail_checkout(checkout, error):
+    """Devuelve el crédito cobrado y marca el Checkout como fallido."""
+    with transaction.atomic():
+        User.objects.filter(pk=checkout.user_id).update(credit=F("credit") + checkout.total)
+        Checkout.objects.filter(id=checkout.id).update(status='failed', error=error[:255], updated=timezone.now())
+    return None
@@ -1,3 +1,619 @@
-from django.test import TestCase
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import int_to_base36
+from PIL import Image
+
+from home.tests import clear_caches, create_catalog
+from shop.cart import CART_LOCK_TIMEOUT, WorkingCart
+from shop.models import CartItem, Category, Product
+from shop.tests import cart_request
+from . import feed, generate_qr
+from .feed import ChangeBuffer
+from .generate_qr import QRCache, qr_digest
+from .models import DELIVERY_FEE, Checkout, Order, OrderItem
+from .pipeline import STALLED_AFTER, DatabaseBroker, InProcessBroker, WorkerPool, drain, get_broker, requeue_checkouts
+from .qr_tokens import make_qr_token, read_qr_token
+from .slips import PyPDF2, pending_slips, render_pages, write_slips_pdf
+from .tasks import create_order, fulfil_order, reserve_order
+
+
+def mock_qr_rendering(test):
+    """Rendering is covered by QRCacheTests; here the worker's QR step is checked through this mock."""
+    patcher = patch('orders.tasks.qr_image')
+    test.render_qr = patcher.start()
+    test.addCleanup(patcher.stop)
+
+
+def use_temporary_qr_cache(test):
+    """Renders QR codes into a directory of the test's own, with empty process caches."""
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    settings_override = override_settings(QR_CACHE_DIR=directory)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+    generate_qr.qr_cache.clear()
+    generate_qr.load_logo.cache_clear()
+    test.addCleanup(generate_qr.load_logo.cache_clear)
+
+
+@override_settings(ORDER_BROKER_URL='memory://', ORDER_WORKERS=0)
+class CheckoutTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        mock_qr_rendering(self)
+        create_catalog(categories=1, products_per_category=3)
+        self.user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.user.credit = Decimal("10000")
+        self.user.save()
+        self.products = list(Product.objects.order_by('name'))
+        cart = WorkingCart(cart_request(self.user))
+        cart.add(self.products[0], 2)
+        cart.add(self.products[1], 1)
+        cart.flush()
+        self.client.force_login(self.user)
+
+    def checkout(self, data):
+        """Posts the confirmation form and runs the worker, as the queue would."""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('orders:order_create'), data)
+        drain()
+        return response
+
+    def test_busy_cart_is_not_ordered(self):
+        cart = WorkingCart(cart_request(self.user))
+        cart.cache.set(f"{cart.key}:lock", "other", CART_LOCK_TIMEOUT)
+        with patch('shop.cart.CART_LOCK_TIMEOUT', 0):
+            response = self.checkout({'school_address': 'cooperative'})
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Checkout.objects.exists())
+        self.assertEqual(len(WorkingCart(cart_request(self.user))), 2)
+
+    def test_summary_is_computed_once_with_one_query(self):
+        cart = WorkingCart(cart_request(self.user))
+        summary = cart.summary
+        with self.assertNumQueries(1):
+            self.assertEqual(summary.item_count, 3)
+            self.assertEqual(summary.subtotal, Decimal("1000") * 2 + Decimal("1001"))
+            self.assertEqual(summary.total("classroom_01"), summary.subtotal + DELIVERY_FEE)
+            self.assertEqual(summary.total("cooperative"), summary.subtotal)
+            self.assertEqual([line.total for line in summary.lines], [Decimal("2000"), Decimal("1001")])
+        self.assertIs(cart.summary, summary)
+        # A click invalidates it.
+        cart.add(self.products[2], 1)
+        self.assertIsNot(cart.summary, summary)
+        self.assertEqual(cart.summary.count, 3)
+
+    def test_confirmation_page_uses_the_summary(self):
+        response = self.client.get(reverse('orders:order_continue'))
+        self.assertEqual(response.context['total'], Decimal("3001"))
+        self.assertContains(response, 'data-delivery-fee="300"')
+        self.assertContains(response, 'data-pickup-address="cooperative"')
+
+    def test_checkout_charges_the_total_with_delivery(self):
+        response = self.checkout({'school_address': 'classroom_01'})
+        checkout = Checkout.objects.get()
+        self.assertRedirects(response, reverse('orders:checkout', args=[checkout.id]), fetch_redirect_response=False)
+        self.user.refresh_from_db()
+        order = Order.objects.get()
+        self.assertEqual(checkout.total, order.get_total_cost())
+        self.assertEqual(self.user.credit, Decimal("10000") - order.get_total_cost())
+        self.assertEqual(order.get_total_cost(), Decimal("3001") + DELIVERY_FEE)
+        self.assertFalse(CartItem.objects.exists())
+
+    def test_double_submit_creates_one_order(self):
+        data = {'school_address': 'cooperative', 'idempotency_key': 'a1b2c3'}
+        first = self.checkout(data)
+        second = self.checkout(data)
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(Checkout.objects.count(), 1)
+        self.assertEqual(Order.objects.count(), 1)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credit, Decimal("10000") - Decimal("3001"))
+
+    def test_insufficient_credit_is_rejected(self):
+        get_user_model().objects.filter(pk=self.user.pk).update(credit=Decimal("3000"))
+        response = self.checkout({'school_address': 'cooperative'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Checkout.objects.exists())
+        self.assertFalse(Order.objects.exists())
+        self.assertTrue(CartItem.objects.exists())
+
+    def test_pickup_has_no_delivery_fee(self):
+        self.checkout({'school_address': 'cooperative'})
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credit, Decimal("10000") - Decimal("3001"))
+
+    def test_unavailable_products_block_checkout(self):
+        Product.objects.filter(id=self.products[1].id).update(available=False)
+        response = self.checkout({'school_address': 'cooperative'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertRedirects(self.client.get(reverse('orders:order_continue')), reverse('shop:cart_detail'))
+
+
+    def test_status_is_polled_until_the_worker_is_done(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('orders:order_create'), {'school_address': 'cooperative'})
+        # The request only charged and queued the checkout.
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.client.get(response['Location']).status_code, 200)
+        checkout = Checkout.objects.get()
+        status_url = reverse('orders:checkout_status', args=[checkout.id])
+        self.assertEqual(self.client.get(status_url).json()['status'], 'queued')
+
+        self.assertEqual(drain(), 1)
+        status = self.client.get(status_url).json()
+        order = Order.objects.get()
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['order_id'], order.id)
+        self.assertEqual(status['redirect_url'], reverse('orders:order_qr', args=[order.id]))
+        self.render_qr.assert_called_once_with(order.qr_code_data)
+
+    def test_other_students_cannot_see_a_checkout(self):
+        self.checkout({'school_address': 'cooperative'})
+        other = get_user_model().objects.create_user(code="other", first_name="Ana", last_name="Gómez")
+        self.client.force_login(other)
+        checkout = Checkout.objects.get()
+        self.assertEqual(self.client.get(reverse('orders:checkout_status', args=[checkout.id])).status_code, 404)
+
+
+@override_settings(ORDER_BROKER_URL='memory://', ORDER_WORKERS=0)
+class PipelineTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        mock_qr_rendering(self)
+        create_catalog(categories=1, products_per_category=2)
+        self.user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        get_user_model().objects.filter(pk=self.user.pk).update(credit=Decimal("5000"))
+        self.products = list(Product.objects.order_by('id'))
+        self.lines = [{'product_id': p.id, 'price': "1000", 'quantity': 1} for p in self.products]
+
+    def reserve(self, key=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return reserve_order(self.user, self.lines, Decimal("2000"), "cooperative", key)
+
+    def test_a_checkout_delivered_twice_is_processed_once(self):
+        checkout = self.reserve()
+        get_broker().enqueue(checkout.id)
+        self.assertEqual(drain(), 2)
+        checkout.refresh_from_db()
+        self.assertEqual((checkout.status, checkout.attempts), ('done', 1))
+        self.assertEqual(Order.objects.get(), checkout.order)
+        self.assertEqual(Product.objects.get(id=self.products[0].id).sales, self.products[0].sales + 1)
+
+    def test_failed_checkout_refunds_the_credit(self):
+        checkout = self.reserve()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credit, Decimal("3000"))
+        Product.objects.filter(id=self.products[1].id).delete()
+
+        self.assertIsNone(fulfil_order(checkout.id))
+        checkout.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(checkout.status, 'failed')
+        self.assertIn(str(self.products[1].id), checkout.error)
+        self.assertEqual(self.user.credit, Decimal("5000"))
+        self.assertFalse(Order.objects.exists())
+
+    def test_database_broker_takes_queued_checkouts_in_order(self):
+        first, second = self.reserve("first"), self.reserve("second")
+        broker = DatabaseBroker()
+        self.assertEqual(broker.dequeue(timeout=0), first.id)
+        self.assertEqual(drain(broker), 2)
+        self.assertEqual(list(Checkout.objects.order_by('id').values_list('status', flat=True)), ['done', 'done'])
+        self.assertIsNone(broker.dequeue(timeout=0))
+
+    def test_stalled_checkouts_are_queued_again(self):
+        get_user_model().objects.filter(pk=self.user.pk).update(credit=Decimal("6000"))
+        _, lost, dead = self.reserve("fresh"), self.reserve("lost"), self.reserve("dead")
+        long_ago = timezone.now() - STALLED_AFTER - timedelta(minutes=1)
+        Checkout.objects.filter(id=lost.id).update(updated=long_ago)
+        Checkout.objects.filter(id=dead.id).update(status='processing', updated=long_ago)
+        broker = InProcessBroker()
+
+        self.assertEqual(requeue_checkouts(broker, stalled_only=True), 2)
+        self.assertEqual([broker.dequeue(timeout=0) for _ in range(3)], [lost.id, dead.id, None])
+        # Touched, so the next round leaves them alone; a starting pool takes every queued one.
+        self.assertEqual(requeue_checkouts(broker, stalled_only=True), 0)
+        self.assertEqual(requeue_checkouts(broker), 3)
+        self.assertEqual(drain(broker), 3)
+        self.assertEqual(set(Checkout.objects.values_list('status', flat=True)), {'done'})
+
+
+class CreateOrderTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=2, products_per_category=10)
+        get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.products = list(Product.objects.order_by('id'))
+
+    def lines(self, products, quantity=1):
+        return [{'product_id': p.id, 'price': str(p.final_price), 'quantity': quantity} for p in products]
+
+    def test_query_count_does_not_grow_with_lines(self):
+        # One of them stores the QR token, which signs the new order's id.
+        with self.assertNumQueries(7):
+            create_order("student", self.lines(self.products[:1]), school_address="cooperative")
+        with self.assertNumQueries(7):
+            create_order("student", self.lines(self.products), school_address="cooperative")
+        self.assertEqual(OrderItem.objects.count(), 21)
+
+    def test_sales_are_added_per_product_and_category(self):
+        first, second, other_category = self.products[0], self.products[1], self.products[10]
+        lines = self.lines([first, second, other_category], quantity=2) + self.lines([first], quantity=3)
+        create_order("student", lines, school_address="cooperative")
+
+        sales = dict(Product.objects.values_list('id', 'sales'))
+        self.assertEqual(sales[first.id], first.sales + 5)
+        self.assertEqual(sales[second.id], second.sales + 2)
+        self.assertEqual(sales[other_category.id], other_category.sales + 2)
+        self.assertEqual(sales[self.products[2].id], self.products[2].sales)
+        self.assertEqual(dict(Category.objects.values_list('slug', 'sales')), {'categoria-0': 7, 'categoria-1': 2})
+
+    def test_missing_price_falls_back_to_the_product_price(self):
+        order = create_order("student", [{'product_id': self.products[0].id, 'price': "0", 'quantity': 1}], school_address="cooperative")
+        self.assertEqual(order.items.get().price, self.products[0].price)
+
+    def test_unknown_product_creates_nothing(self):
+        with self.assertRaises(ValidationError):
+            create_order("student", self.lines(self.products[:1]) + [{'product_id': 999, 'price': "1", 'quantity': 1}], school_address="cooperative")
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderTotalsTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=2)
+        self.student = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.products = list(Product.objects.order_by('id'))
+        self.lines = [{'product_id': p.id, 'price': str(p.price), 'quantity': 2} for p in self.products]
+
+    def place(self, school_address="classroom_01"):
+        return create_order("student", self.lines, paid=True, school_address=school_address)
+
+    def count_queries(self, url):
+        self.client.get(url)  # Warms the navbar and session caches.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_totals_are_stored_at_creation(self):
+        delivered, picked_up = self.place(), self.place("cooperative")
+        delivered.refresh_from_db()
+        self.assertEqual(delivered.subtotal, Decimal("4002"))
+        self.assertEqual(delivered.delivery_fee, DELIVERY_FEE)
+        self.assertEqual(delivered.total, Decimal("4002") + DELIVERY_FEE)
+        self.assertEqual(delivered.item_count, 4)
+        self.assertEqual(Order.objects.get(id=picked_up.id).total, Decimal("4002"))
+
+    def test_backfill_recomputes_from_the_items(self):
+        delivered, picked_up = self.place(), self.place("cooperative")
+        Order.objects.update(subtotal=0, delivery_fee=0, total=0, item_count=0)
+        call_command('backfill_order_totals', stdout=StringIO())
+        delivered.refresh_from_db()
+        picked_up.refresh_from_db()
+        self.assertEqual((delivered.subtotal, delivered.delivery_fee, delivered.total, delivered.item_count),
+                         (Decimal("4002"), DELIVERY_FEE, Decimal("4002") + DELIVERY_FEE, 4))
+        self.assertEqual((picked_up.delivery_fee, picked_up.total), (Decimal("0"), Decimal("4002")))
+
+    def test_cancelling_refunds_the_stored_total(self):
+        order = self.place()
+        seller = get_user_model().objects.get(code="seller")
+        self.client.force_login(seller)
+        self.client.post(reverse('orders:order_cancel_stock', args=[order.id]), {'cancel_products': [self.products[0].id]})
+        order.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+        self.assertEqual(get_user_model().objects.get(code="student").credit, order.total)
+
+    def test_seller_lists_do_not_grow_with_orders(self):
+        seller = get_user_model().objects.get(code="seller")
+        seller.is_staff = seller.is_superuser = True
+        seller.save()
+        self.client.force_login(seller)
+        self.place()
+        pending = self.count_queries(reverse('shop:pending_orders'))
+        changelist = self.count_queries(reverse('admin:orders_order_changelist'))
+        for _ in range(5):
+            self.place()
+        self.assertEqual(self.count_queries(reverse('shop:pending_orders')), pending)
+        self.assertEqual(self.count_queries(reverse('admin:orders_order_changelist')), changelist)
+
+    def test_student_order_list_does_not_grow_with_orders(self):
+        self.client.force_login(self.student)
+        self.place()
+        queries = self.count_queries(reverse('orders:order_list'))
+        for _ in range(5):
+            self.place()
+        self.assertEqual(self.count_queries(reverse('orders:order_list')), queries)
+
+
+class QRCacheTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        use_temporary_qr_cache(self)
+
+    def test_renders_once_then_memory_then_disk(self):
+        calls = []
+
+        def render(qr_data):
+            calls.append(qr_data)
+            return f"png:{qr_data}".encode()
+
+        with patch.dict(generate_qr.RENDERERS, {'png': render}):
+            self.assertEqual(generate_qr.qr_image("abc"), b"png:abc")
+            self.assertEqual(generate_qr.qr_image("abc"), b"png:abc")
+            # Another process: empty memory, same directory.
+            self.assertEqual(QRCache().get("abc"), b"png:abc")
+        self.assertEqual(calls, ["abc"])
+
+    def test_logo_is_loaded_once(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        logo_path = f"{directory}/logo.png"
+        Image.new("RGBA", (64, 64), "red").save(logo_path)
+        with patch.object(generate_qr, 'LOGO_PATH', logo_path), patch.object(generate_qr.Image, 'open', wraps=Image.open) as opened:
+            first = generate_qr.render_png("order-1")
+            generate_qr.render_png("order-2")
+        self.assertEqual(opened.call_count, 1)
+        self.assertTrue(first.startswith(b"\x89PNG"))
+
+    def test_svg_does_not_need_pil(self):
+        with patch.object(generate_qr, 'Image', None):
+            svg = generate_qr.qr_image("order-1", "svg")
+        self.assertIn(b"<svg", svg)
+
+    def test_image_url_is_private_and_long_lived(self):
+        create_catalog(categories=1, products_per_category=1)
+        student = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        order = create_order("student", [{'product_id': Product.objects.get().id, 'price': "0", 'quantity': 1}], school_address="cooperative")
+        self.client.force_login(student)
+
+        page = self.client.get(reverse('orders:order_qr', args=[order.id]))
+        digest = qr_digest(order.qr_code_data)
+        self.assertEqual(page.context['qr_url'], reverse('orders:order_qr_image', args=[order.id, digest, "png"]))
+        # static/ is not in the repository, so the QR is drawn without the logo.
+        with self.assertLogs('orders.generate_qr', 'WARNING'):
+            image = self.client.get(page.context['qr_url'])
+        self.assertEqual(image['Content-Type'], "image/png")
+        self.assertEqual(image['Cache-Control'], "private, max-age=31536000, immutable")
+        self.assertTrue(image.content.startswith(b"\x89PNG"))
+        self.assertEqual(self.client.get(page.context['qr_url'], HTTP_IF_NONE_MATCH=image['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(page.context['qr_svg_url'])['Content-Type'], "image/svg+xml")
+
+        self.assertEqual(self.client.get(reverse('orders:order_qr_image', args=[order.id, "0" * 32, "png"])).status_code, 404)
+        self.client.force_login(get_user_model().objects.get(code="seller"))
+        self.assertEqual(self.client.get(page.context['qr_url']).status_code, 404)
+
+
+class ChangeBufferTests(TestCase):
+
+    def test_latest_change_per_order_after_the_cursor(self):
+        buffer = ChangeBuffer(size=10)
+        start = buffer.cursor
+        buffer.publish(1, {'id': 1, 'status': 'pending'})
+        middle = buffer.cursor
+        buffer.publish(2, {'id': 2, 'status': 'pending'})
+        buffer.publish(1, {'id': 1, 'status': 'completed'})
+
+        payloads, cursor = buffer.since(start)
+        self.assertEqual(payloads, [{'id': 1, 'status': 'completed'}, {'id': 2, 'status': 'pending'}])
+        self.assertGreater(cursor, middle)
+        self.assertEqual(buffer.since(middle)[0], [{'id': 2, 'status': 'pending'}, {'id': 1, 'status': 'completed'}])
+        self.assertEqual(buffer.since(cursor), ([], cursor))
+
+    def test_cursor_older_than_the_buffer_is_unknown(self):
+        buffer = ChangeBuffer(size=2)
+        start = buffer.cursor
+        for order_id in range(3):
+            buffer.publish(order_id, {'id': order_id})
+        self.assertIsNone(buffer.since(start)[0])
+        self.assertIsNone(buffer.since(start - 60)[0])
+
+    def test_waiting_reader_wakes_up_on_a_change(self):
+        buffer = ChangeBuffer()
+        cursor = buffer.cursor
+        publisher = threading.Timer(0.05, buffer.publish, args=(7, {'id': 7}))
+        publisher.start()
+        started = time.monotonic()
+        payloads, _ = buffer.since(cursor, timeout=5)
+        publisher.join()
+        self.assertEqual(payloads, [{'id': 7}])
+        self.assertLess(time.monotonic() - started, 2)
+
+
+class SlipTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        use_temporary_qr_cache(self)
+        create_catalog(categories=1, products_per_category=2)
+        get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.products = list(Product.objects.order_by('id'))
+
+    def place(self, school_address="classroom_01", lines=1):
+        return create_order(
+            "student",
+            [{'product_id': product.id, 'price': "1000", 'quantity': 2} for product in self.products[:lines]],
+            school_address=school_address,
+        )
+
+    def test_slips_follow_the_queue_and_carry_the_qr(self):
+        first, second = self.place(lines=2), self.place("classroom_02")
+        slips = list(pending_slips(Order.objects.pending_queue()))
+        self.assertEqual([slip['id'] for slip in slips], [first.id, second.id])
+        self.assertEqual(slips[0]['qr_data'], first.qr_code_data)
+        self.assertEqual(slips[0]['items'], [{'name': product.name, 'quantity': 2} for product in self.products[:2]])
+        # One PDF holds every page in memory, so it is capped.
+        with patch('orders.slips.MAX_SLIPS', 1):
+            self.assertEqual([slip['id'] for slip in pending_slips(Order.objects.pending_queue())], [first.id])
+
+    def test_pages_keep_the_order_in_a_process_pool(self):
+        for lines in (1, 2, 1, 2, 2):
+            self.place(lines=lines)
+        slips = list(pending_slips(Order.objects.pending_queue()))
+        sequential = list(render_pages(slips, workers=0))
+        self.assertTrue(all(page.startswith(b"%PDF") for page in sequential))
+        # Pages differ only in their creation date, which has a fixed width.
+        self.assertEqual([len(page) for page in render_pages(slips, workers=2)], [len(page) for page in sequential])
+        self.assertNotEqual(len(sequential[0]), len(sequential[1]))
+
+    @skipUnless(PyPDF2, "PyPDF2 is not installed")
+    def test_one_pdf_page_per_pending_order(self):
+        self.place()
+        self.place("classroom_02")
+        Order.objects.filter(id=self.place().id).update(status='completed')
+
+        output = BytesIO()
+        pages = write_slips_pdf(pending_slips(Order.objects.pending_queue()), output, workers=2)
+        self.assertEqual(pages, 2)
+        self.assertEqual(len(PyPDF2.PdfReader(BytesIO(output.getvalue())).pages), 2)
+
+    @skipUnless(PyPDF2, "PyPDF2 is not installed")
+    def test_command_prints_one_classroom(self):
+        self.place()
+        self.place("classroom_02")
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as output:
+            call_command('print_order_slips', output.name, school_address="classroom_02", workers=0, stdout=StringIO())
+            self.assertEqual(len(PyPDF2.PdfReader(output.name).pages), 1)
+
+
+class QRTokenTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=1)
+        get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.product = Product.objects.get()
+        self.order = create_order("student", [{'product_id': self.product.id, 'price': "0", 'quantity': 1}], school_address="classroom_01")
+        self.client.force_login(get_user_model().objects.get(code="seller"))
+        feed.changes.clear()
+
+    def scan(self, qr_code, **data):
+        return self.client.post(reverse('orders:process_qr'), {'qr_code': qr_code, **data}, content_type="application/json")
+
+    def test_token_signs_the_order_id(self):
+        token = self.order.qr_code_data
+        self.assertEqual(read_qr_token(token), self.order.id)
+        self.assertNotEqual(make_qr_token(self.order.id), token)
+        order_id, nonce, signature = token.split(".")
+        self.assertIsNone(read_qr_token(f"{int_to_base36(self.order.id + 1)}.{nonce}.{signature}"))
+        self.assertIsNone(read_qr_token(f"{order_id}.{nonce}.{signature[:-1]}"))
+        for garbage in ("", "abc", "..", "not a token", str(uuid.uuid4())):
+            self.assertIsNone(read_qr_token(garbage))
+
+    def test_scan_completes_the_pending_order_once(self):
+        cursor = feed.changes.cursor
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.scan(self.order.qr_code_data)
+        self.assertTrue(response.json()['success'])
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.status, self.order.seller_approved_id), ("completed", "seller"))
+        self.assertEqual([payload['status'] for payload in feed.changes.since(cursor)[0]], ["completed"])
+
+        response = self.scan(self.order.qr_code_data)
+        self.assertEqual(response.json()['message'], "La orden no está pendiente.")
+
+    def test_forged_codes_are_rejected_without_touching_orders(self):
+        order_id, nonce, signature = self.order.qr_code_data.split(".")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.scan(f"{order_id}.{nonce}x.{signature}")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse([query for query in queries if "orders_order" in query['sql']])
+        self.assertEqual(self.scan(self.order.qr_code_data, order_id=self.order.id + 1).json()['message'], "QR incorrecto.")
+
+    def test_reissued_token_leaves_the_old_qr_stale(self):
+        old = self.order.qr_code_data
+        Order.objects.filter(id=self.order.id).update(qr_code_data=str(uuid.uuid4()))
+        call_command('issue_qr_tokens', stdout=StringIO())
+        self.order.refresh_from_db()
+        self.assertEqual(read_qr_token(self.order.qr_code_data), self.order.id)
+
+        self.assertEqual(self.scan(old).status_code, 400)
+        self.assertTrue(self.scan(self.order.qr_code_data, order_id=self.order.id).json()['success'])
+
+
+class DoubleSpendTests(TransactionTestCase):
+
+    def setUp(self):
+        clear_caches()
+        mock_qr_rendering(self)
+        create_catalog(categories=1, products_per_category=1)
+        self.user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        get_user_model().objects.filter(pk=self.user.pk).update(credit=Decimal("5000"))
+        product = Product.objects.get()
+        self.lines = [{'product_id': product.id, 'price': "1000", 'quantity': 1}]
+
+    def checkout_concurrently(self, threads, key):
+        results, errors = [], []
+        start = threading.Barrier(threads)
+
+        def worker(i):
+            try:
+                start.wait()
+                results.append(reserve_order(self.user, self.lines, Decimal("1000"), "cooperative", key(i)))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.user.refresh_from_db()
+        return results
+
+    def test_concurrent_checkouts_never_overdraw(self):
+        results = self.checkout_concurrently(12, key=lambda i: f"key-{i}")
+        self.assertEqual(len([checkout for checkout in results if checkout is not None]), 5)
+        self.assertEqual(results.count(None), 7)
+        self.assertEqual(self.user.credit, Decimal("0"))
+        self.assertEqual(Checkout.objects.count(), 5)
+
+    def test_concurrent_retries_create_one_checkout(self):
+        results = self.checkout_concurrently(8, key=lambda i: "same-key")
+        self.assertEqual(len({checkout.id for checkout in results}), 1)
+        self.assertEqual(self.user.credit, Decimal("4000"))
+        self.assertEqual(Checkout.objects.count(), 1)
+
+    @override_settings(ORDER_BROKER_URL='memory://', ORDER_WORKERS=0)
+    def test_worker_pool_creates_every_order(self):
+        self.checkout_concurrently(5, key=lambda i: f"key-{i}")
+        broker = get_broker()
+        self.assertIsInstance(broker, InProcessBroker)
+        pool = WorkerPool(broker, 3)
+        pool.start()
+        try:
+            for _ in range(100):
+                if not Checkout.objects.exclude(status='done').exists():
+                    break
+                time.sleep(0.05)
+        finally:
+            pool.stop()
+        self.assertEqual(Order.objects.count(), 5)
+        self.assertEqual(Product.objects.get().sales, 5)
@@ -1,8 +1,8 @@
 import re
 import json
+import uuid
 
 
-from decimal import Decimal
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import HttpResponseBadRequest, JsonResponse, Http404
 from django.contrib.auth.decorators import login_required
@@ -10,40 +10,31 @@ from django.views.decorators.http import require_POST
 from django.core.exceptions import ValidationError
 from django.contrib.auth import logout
 from django.db import transaction
-from django.db.models import F, Sum
+from django.db.models import F
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import reverse
 
-from .models import Order
-from shop.models import Cart, Product, Category
+from .models import DELIVERY_FEE, PICKUP_ADDRESS, TOTAL_FIELDS, Checkout, Order
+from shop.models import Product, Category
+from shop.cart import CartBusy, get_cart, get_cart_summary
 from .forms import SearchOrderForm
-from .tasks import create_order
-from .generate_qr import order_qr
+from .tasks import reserve_order
+from .generate_qr import CONTENT_TYPES, qr_digest, qr_image
+from .qr_tokens import read_qr_token
+from . import feed
 
 from shop.decorators import seller_required
+from blocks.decorators import BlocksView
 from .models import Order, OrderItem, OrderCancelItem
 
 @login_required
 def continue_order_view(request):
-    try:
-        cart = Cart.objects.get(user=request.user)
-    except Cart.DoesNotExist:
-        return redirect('shop:cart_detail')
-
-    items = cart.cart_items.select_related('product').all()
-    if not items.exists():
+    summary = get_cart_summary(request)
+    if not summary.lines or summary.has_unavailable:
         return redirect('shop:cart_detail')
 
-    unavailable_items = [item for item in items if not item.product.available]
-    if unavailable_items:
-        return redirect('shop:cart_detail')
-
-    total = Decimal('0')
-    for item in items:
-        item.total = item.quantity * item.product.price
-        total += item.total
-
+    total = summary.subtotal
     credit = request.user.credit
     has_enough_credit = credit >= total
     remaining_credit = credit - total if has_enough_credit else 0
@@ -51,31 +42,52 @@ def continue_order_view(request):
     full_name = getattr(request.user, 'get_full_name', lambda: '')()
 
     context = {
-        'items': items,
+        'items': summary.lines,
         'total': total,
         'credit': credit,
         'has_enough_credit': has_enough_credit,
         'remaining_credit': remaining_credit,
         'can_continue': has_enough_credit,
         'full_name': full_name,
+        'delivery_fee': DELIVERY_FEE,
+        'pickup_address': PICKUP_ADDRESS,
+        'idempotency_key': uuid.uuid4().hex,
         'school_address_choices':  Order._meta.get_field('school_address').choices
     }
 
     return render(request, "pages/orders/continue_order.html", context)
 
 @login_required
+@BlocksView
 @require_POST
 def order_create_view(request):
     user = request.user
-    cart = get_object_or_404(Cart, user=user)
+    idempotency_key = request.POST.get("idempotency_key", "")[:64] or None
 
-    if not cart.cart_items.exists():
-        return JsonResponse({"error": "El carrito está vacío."}, status=400)
+    if idempotency_key:
+        existing = Checkout.objects.filter(user=user, idempotency_key=idempotency_key).first()
+        if existing is not None:
+            # Double click or retry of a checkout that already went through.
+            return redirect("orders:checkout", checkout_id=existing.id)
 
-    total = Decimal(cart.get_total_cost())
+    cart = get_cart(request)
+    try:
+        # Held until the cart is forgotten, so a click in another tab is either in the
+        # order or waits for the next cart.
+        with cart.locked():
+            return create_from_cart(request, cart, idempotency_key)
+    except CartBusy:
+        return JsonResponse({"error": "El carrito se está actualizando; intenta de nuevo."}, status=409)
 
-    if user.credit < total:
-        return JsonResponse({"error": "Saldo insuficiente."}, status=400)
+
+def create_from_cart(request, cart, idempotency_key):
+    summary = cart.summary
+
+    if not summary.lines:
+        return JsonResponse({"error": "El carrito está vacío."}, status=400)
+
+    if summary.has_unavailable:
+        return JsonResponse({"error": "El carrito tiene productos no disponibles."}, status=400)
 
     school_address = request.POST.get("school_address")
     valid_choices = dict(Order._meta.get_field("school_address").choices)
@@ -83,38 +95,59 @@ def order_create_view(request):
     if school_address not in valid_choices:
         return JsonResponse({"error": "Dirección escolar inválida."}, status=400)
 
-    products = []
-    for item in cart.cart_items.select_related('product'):
-        product = item.product
-
-        products.append({
-            "product_id": product.id,
-            "price": str(product.price),
-            "quantity": item.quantity,
-        })
+    # The same total the confirmation page showed, delivery included.
+    total = summary.total(school_address)
 
     try:
-        with transaction.atomic():
-            user.credit -= total
-            user.save()
+        # The credit check happens in the debit itself, not on the loaded user.
+        checkout = reserve_order(request.user, summary.order_products(), total, school_address, idempotency_key)
+    except Exception as e:
+        return HttpResponseBadRequest(f"Error al crear el pedido: {str(e)}")
 
-            cart.cart_items.all().delete()
+    if checkout is None:
+        return JsonResponse({"error": "Saldo insuficiente."}, status=400)
 
-            create_order(
-                user.code,
-                products,
-                paid=True,
-                school_address=school_address
-            )
+    cart.forget()
+    # The order is created by a worker; the student waits on the checkout page.
+    return redirect("orders:checkout", checkout_id=checkout.id)
 
-        return redirect("orders:order_list")
-    except Exception as e:
-        return HttpResponseBadRequest(f"Error al crear el pedido: {str(e)}")
+
+@login_required
+def checkout_view(request, checkout_id):
+    checkout = get_object_or_404(Checkout, id=checkout_id, user=request.user)
+    return render(request, "pages/orders/checkout_status.html", {
+        "checkout": checkout,
+        "status": checkout_status(checkout),
+    })
+
+
+@login_required
+def checkout_status_view(request, checkout_id):
+    """Polled by the checkout page until the worker is done with the checkout."""
+    checkout = get_object_or_404(Checkout, id=checkout_id, user=request.user)
+    return JsonResponse(checkout_status(checkout))
+
+
+def checkout_status(checkout):
+    status = {
+        "status": checkout.status,
+        "label": checkout.get_status_display(),
+        "finished": checkout.finished,
+        "order_id": checkout.order_id,
+        "error": checkout.error,
+        "redirect_url": None,
+    }
+    if checkout.status == "done":
+        status["redirect_url"] = reverse("orders:order_qr", args=[checkout.order_id])
+    return status
 
 
 @login_required
 def order_list_view(request):
-    orders = Order.objects.filter(user=request.user).exclude(donot_show=True).order_by('-created')
+    orders = (
+        Order.objects.filter(user=request.user).exclude(donot_show=True).order_by('-created')
+        .prefetch_related('items__product')
+    )
     form_search_order = SearchOrderForm()
 
     context = {
@@ -141,7 +174,10 @@ def order_search_view(request):
     if form.is_valid():
         search_query = form.cleaned_data.get('search_query')
         if search_query:
-            orders_items = orders.filter(items__product__name__icontains=search_query).distinct()
+            orders_items = (
+                orders.filter(items__product__name__icontains=search_query).distinct()
+                .prefetch_related('items__product')
+            )
 
     context = {
         'form': form,
@@ -162,10 +198,8 @@ def order_delete_view(request, order_id):
             "Solo se pueden eliminar pedidos pendientes."
         )
 
-
-    total_amount = order.items.aggregate(
-        total=Sum(F("price") * F("quantity"))
-    )["total"] or Decimal("0.00")
+    # Everything that was charged, delivery included.
+    total_amount = order.total
 
     if hasattr(request.user, "credit"):
         request.user.credit = F("credit") + total_amount
@@ -178,36 +212,68 @@ def order_delete_view(request, order_id):
 @login_required
 def order_qr_view(request, order_id):
     order = get_object_or_404(Order, id=order_id, user=request.user, status="pending", donot_show=False)
-    qr_code = order_qr(order.qr_code_data)
+    digest = qr_digest(order.qr_code_data)
     return render(request, "pages/orders/order_qr.html", {
         "order": order,
-        "qr_code": qr_code,
+        "qr_url": reverse("orders:order_qr_image", args=[order.id, digest, "png"]),
+        "qr_svg_url": reverse("orders:order_qr_image", args=[order.id, digest, "svg"]),
     })
 
 
+@login_required
+def order_qr_image_view(request, order_id, digest, image_format):
+    """
+    The QR image of an order, from the QR cache. The URL carries a digest of the QR
+    data, so the image behind it never changes and browsers may keep it for a year;
+    it stays private because the QR is what collects the order.
+    """
+    order = get_object_or_404(Order, id=order_id, user=request.user, status="pending", donot_show=False)
+    if image_format not in CONTENT_TYPES or digest != qr_digest(order.qr_code_data):
+        raise Http404
+
+    headers = {"Cache-Control": "private, max-age=31536000, immutable", "ETag": f'"{digest}"'}
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return HttpResponse(status=304, headers=headers)
+    return HttpResponse(qr_image(order.qr_code_data, image_format), content_type=CONTENT_TYPES[image_format], headers=headers)
+
+
 @csrf_exempt
 @login_required
 @seller_required
 def process_qr_view(request):
+    """
+    Completes the order of a scanned QR. The token names its order and is checked
+    against its signature first, so forged codes are rejected without a query; a
+    valid one completes the order with a single UPDATE that only matches while the
+    order is pending and the token is still its current one. `order_id` is optional:
+    when sent, the QR must belong to that order.
+    """
     if request.method == "POST":
         try:
             data = json.loads(request.body)
-            order_id = data.get("order_id")
-            qr_code = data.get("qr_code")
-        except (json.JSONDecodeError, KeyError):
+            qr_code = data["qr_code"]
+            expected_id = data.get("order_id")
+        except (json.JSONDecodeError, KeyError, TypeError):
             return JsonResponse({"success": False, "message": "Datos inválidos."}, status=400)
 
-        order = get_object_or_404(Order, id=order_id)
-
-        if order.status != "pending":
-            return JsonResponse({"success": False, "message": "La orden no está pendiente."}, status=400)
-
-        if qr_code != order.qr_code_data:
+        order_id = read_qr_token(qr_code)
+        if order_id is None or (expected_id and str(expected_id) != str(order_id)):
             return JsonResponse({"success": False, "message": "QR incorrecto."}, status=400)
 
-        order.status = "completed"
-        order.seller_approved = request.user
-        order.save(update_fields=["status", "seller_approved"])
+        completed = Order.objects.filter(id=order_id, qr_code_data=qr_code, status="pending").update(
+            status="completed", seller_approved=request.user,
+        )
+        if completed:
+            # update() sends no post_save, so the feed is told here.
+            transaction.on_commit(lambda: feed.publish_order(order_id))
+
+        if not completed:
+            status = Order.objects.filter(id=order_id).values_list("status", flat=True).first()
+            if status is None:
+                raise Http404("Orden no encontrada.")
+            if status != "pending":
+                return JsonResponse({"success": False, "message": "La orden no está pendiente."}, status=400)
+            return JsonResponse({"success": False, "message": "QR vencido, usa el más reciente de la orden."}, status=400)
 
         return JsonResponse({"success": True, "redirect_url": reverse("shop:pending_orders")})
 
@@ -220,7 +286,7 @@ def order_cancel_stock_view(request, order_id):
     Cancela la orden si al menos un producto está sin stock.
     - Los productos sin stock se registran en OrderCancelItem.
     - TODOS los productos permanecen en OrderItem.
-    - Se reembolsa TODO el dinero de la orden (get_total_cost).
+    - Se reembolsa TODO el dinero de la orden (el total guardado, recalculado de los ítems).
     - La orden se marca como 'cancelled_stock'.
     - Si algo falla, se revierte toda la operación.
     """
@@ -246,14 +312,15 @@ def order_cancel_stock_view(request, order_id):
                             quantity=item.quantity,
                         )
 
+                order.refresh_totals()
                 if order.paid:
-                    refund_amount = order.get_total_cost()
+                    refund_amount = order.total
                     if refund_amount > 0 and hasattr(order.user, "credit"):
                         order.user.credit = F("credit") + refund_amount
                         order.user.save(update_fields=["credit"])
 
                 order.status = "cancelled"
-                order.save(update_fields=["status"])
+                order.save(update_fields=["status", *TOTAL_FIELDS])
 
         except Exception as e:
             return HttpResponseBadRequest(f"Error al cancelar la orden: {str(e)}")
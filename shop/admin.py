@@ -13,7 +13,7 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'slug', 'price', 'seller', 'category')
+    list_display = ('name', 'slug', 'price', 'final_price', 'seller', 'category')
     prepopulated_fields = {'slug': ('name',)}
 
 
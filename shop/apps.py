@@ -5,3 +5,10 @@ class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
     verbose_name = 'Comercio'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+        from . import checks  # noqa: F401
+        from . import signals
+
+        post_migrate.connect(signals.create_search_index, sender=self)
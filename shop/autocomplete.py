@@ -0,0 +1,243 @@
+import bisect
+import heapq
+import threading
+import time
+
+from django.core.cache import cache
+from django.urls import reverse
+
+from .models import Category, Product
+from .search_index import tokenize
+
+AUTOCOMPLETE_VERSION_KEY = "autocomplete:version"
+AUTOCOMPLETE_LIMIT = 8
+
+# Seconds between checks of the shared version key.
+VERSION_CHECK_INTERVAL = 5
+# Full rebuild interval, so sales-based ranking does not drift.
+REBUILD_INTERVAL = 60 * 10
+
+
+class PrefixIndex:
+    """
+    Sorted array of the distinct normalized words in product and category names,
+    each with its entries ordered by sales. A prefix lookup is a binary search for
+    the range of matching words plus a lazy merge of their lists, which stops as soon
+    as `limit` entries are found. Results of repeated prefixes are memoized until
+    the index changes.
+    """
+
+    MEMO_SIZE = 1024
+
+    def __init__(self):
+        self._words = []
+        self._postings = {}
+        self._entries = {}
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _entry(name, sales, **data):
+        return {'name': name, 'sales': sales, 'words': tuple(sorted(set(tokenize(name)))), **data}
+
+    def build(self, items):
+        """Replaces the whole index with `items`, an iterable of (key, name, sales, data)."""
+        entries = {key: self._entry(name, sales, **data) for key, name, sales, data in items}
+        postings = {}
+        for key, entry in entries.items():
+            for word in entry['words']:
+                postings.setdefault(word, []).append((-entry['sales'], key))
+        for posting in postings.values():
+            posting.sort()
+        with self._lock:
+            self._entries, self._postings, self._words = entries, postings, sorted(postings)
+            self._memo = {}
+
+    def add(self, key, name, sales, **data):
+        entry = self._entry(name, sales, **data)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            for word in entry['words']:
+                posting = self._postings.get(word)
+                if posting is None:
+                    posting = self._postings[word] = []
+                    bisect.insort(self._words, word)
+                bisect.insort(posting, (-sales, key))
+            self._memo = {}
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+            self._memo = {}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for word in entry['words']:
+            posting = self._postings[word]
+            i = bisect.bisect_left(posting, (-entry['sales'], key))
+            if i < len(posting) and posting[i][1] == key:
+                del posting[i]
+            if not posting:
+                del self._postings[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+
+    def _matching_postings(self, prefix):
+        words = self._words
+        lo = bisect.bisect_left(words, prefix)
+        hi = bisect.bisect_left(words, prefix + "\U0010ffff", lo)
+        return [self._postings[word] for word in words[lo:hi]]
+
+    def search(self, query, limit=AUTOCOMPLETE_LIMIT):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        memo_key = (tuple(tokens), limit)
+        with self._lock:
+            results = self._memo.get(memo_key)
+            if results is not None:
+                return results
+
+            # Walk the postings of the most selective token, then check the others.
+            postings = min((self._matching_postings(token) for token in tokens), key=lambda p: sum(map(len, p)))
+
+            results, seen = [], set()
+            merged = postings[0] if len(postings) == 1 else heapq.merge(*postings)
+            for _, key in merged:
+                if key in seen:
+                    continue
+                seen.add(key)
+                entry = self._entries[key]
+                if len(tokens) == 1 or all(any(word.startswith(token) for word in entry['words']) for token in tokens):
+                    results.append(entry)
+                    if len(results) == limit:
+                        break
+
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo = {}
+            self._memo[memo_key] = results
+        return results
+
+
+def product_item(product):
+    return ('product', product.id), product.name, product.sales, {'type': 'product', 'id': product.id, 'slug': product.slug}
+
+
+def category_item(category):
+    return ('category', category.id), category.name, category.sales, {'type': 'category', 'slug': category.slug}
+
+
+def load_items():
+    products = Product.objects.filter(available=True).only('id', 'name', 'slug', 'sales')
+    for product in products.iterator(chunk_size=5000):
+        yield product_item(product)
+    for category in Category.objects.only('id', 'name', 'slug', 'sales'):
+        yield category_item(category)
+
+
+_index = PrefixIndex()
+_state = {'version': None, 'built_at': None, 'checked_at': 0.0}
+_state_lock = threading.Lock()
+
+
+def _shared_version():
+    version = cache.get(AUTOCOMPLETE_VERSION_KEY)
+    if version is None:
+        cache.add(AUTOCOMPLETE_VERSION_KEY, 1, None)
+        version = cache.get(AUTOCOMPLETE_VERSION_KEY, 1)
+    return version
+
+
+def get_index():
+    """Returns the process-wide index, rebuilding it when another process changed the catalog."""
+    now = time.monotonic()
+    if _state['built_at'] is not None and now - _state['checked_at'] < VERSION_CHECK_INTERVAL:
+        return _index
+
+    with _state_lock:
+        version = _shared_version()
+        stale = _state['built_at'] is None or now - _state['built_at'] > REBUILD_INTERVAL
+        if stale or version != _state['version']:
+            _index.build(load_items())
+            _state['version'] = version
+            _state['built_at'] = now
+        _state['checked_at'] = now
+    return _index
+
+
+def invalidate_index():
+    """Forces this process to rebuild the index on its next lookup."""
+    with _state_lock:
+        _state['built_at'] = None
+
+
+def _bump_version():
+    try:
+        return cache.incr(AUTOCOMPLETE_VERSION_KEY)
+    except ValueError:
+        cache.add(AUTOCOMPLETE_VERSION_KEY, 2, None)
+        return cache.get(AUTOCOMPLETE_VERSION_KEY)
+
+
+def _apply(update):
+    """
+    Applies an incremental change to the local index and bumps the shared version
+    so other processes rebuild; this process keeps its index since it is up to date.
+    """
+    with _state_lock:
+        up_to_date = _state['built_at'] is not None and _state['version'] == _shared_version()
+        if up_to_date:
+            update(_index)
+        version = _bump_version()
+        if up_to_date:
+            _state['version'] = version
+
+
+def _add_item(item):
+    key, name, sales, data = item
+    _apply(lambda index: index.add(key, name, sales, **data))
+
+
+def product_changed(product):
+    if product.available:
+        _add_item(product_item(product))
+    else:
+        product_removed(product.id)
+
+
+def product_removed(product_id):
+    _apply(lambda index: index.remove(('product', product_id)))
+
+
+def category_changed(category):
+    _add_item(category_item(category))
+
+
+def category_removed(category_id):
+    # Removing a category also removes its products; let every process rebuild.
+    with _state_lock:
+        _bump_version()
+
+
+def entry_url(entry):
+    url = entry.get('url')
+    if url is None:
+        if entry['type'] == 'product':
+            url = reverse('shop:product_detail', args=[entry['id'], entry['slug']])
+        else:
+            url = reverse('shop:search_by_category', args=[entry['slug']])
+        entry['url'] = url
+    return url
+
+
+def suggestions(query, limit=AUTOCOMPLETE_LIMIT):
+    return [
+        {'type': entry['type'], 'name': entry['name'], 'url': entry_url(entry)}
+        for entry in get_index().search(query, limit)
+    ]
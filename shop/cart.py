@@ -1,88 +1,368 @@
+import logging
+import secrets
+import time
+from contextlib import contextmanager
 from decimal import Decimal
+
 from django.conf import settings
-from shop.models import Product
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.functional import cached_property
 
+from orders.models import delivery_fee
+from shop.models import MAX_CART_QUANTITY, Cart, CartItem, Product
+
+logger = logging.getLogger(__name__)
+
+# Alias de settings.CACHES con los carritos: compartido por todos los procesos (ver shop.checks).
+CART_CACHE_ALIAS = 'carts'
+# Carritos de usuarios en la caché; se guardan en CartItem mucho antes de expirar.
+CART_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# Segundos que dura el candado por usuario que evita que dos pestañas se pisen.
+CART_LOCK_TIMEOUT = 5
+# Cambios que acepta una sola actualización por lotes.
+MAX_CART_BATCH = 50
+
+
+class CartBusy(Exception):
+    """
+    Otra petición del mismo usuario tiene el candado del carrito; no se cambió nada
+    y la petición se puede reintentar.
+    """
+
+
+def get_cart(request):
+    """
+    Devuelve el carrito de la petición; se crea una sola vez por petición.
+    """
+    cart = getattr(request, '_working_cart', None)
+    if cart is None or cart.user != _user(request):
+        cart = request._working_cart = WorkingCart(request)
+    return cart
+
+
+def get_cart_summary(request):
+    """
+    Devuelve el resumen del carrito de la petición; se calcula una sola vez por petición.
+    """
+    return get_cart(request).summary
+
+
+def get_cart_count(request):
+    """
+    Devuelve el número de productos distintos en el carrito.
+    Sale de la caché o de la sesión; solo se consulta la base de datos si la caché está vacía.
+    """
+    return get_cart_summary(request).count
 
-class Cart:
-    def __init__(self, request):
-        """
-        Inicializa el carrito de compras.
-        """
-        self.session = request.session
-        cart = self.session.get(settings.CART_SESSION_ID)  # Obtiene el carrito de la sesión
 
-        if not cart:
-            cart = self.session[settings.CART_SESSION_ID] = {}  # Crea un carrito vacío si no existe
+def _user(request):
+    user = getattr(request, 'user', None)
+    return user if user is not None and user.is_authenticated else None
 
-        self.cart = cart
 
-    def add(self, product, quantity=1, update_quantity=False):
+class WorkingCart:
+    """
+    Carrito de compras unificado.
+
+    Los clics trabajan sobre una copia: en la sesión para visitantes anónimos y en la
+    caché para usuarios autenticados, así que agregar, cambiar o quitar productos no
+    abre una transacción en la base de datos. Los cambios se guardan en CartItem por
+    lotes (write-behind): al pagar, al iniciar o cerrar sesión y cuando pasan
+    settings.CART_SYNC_INTERVAL segundos desde la última escritura.
+    """
+
+    def __init__(self, request, user=None):
+        self.request = request
+        self.user = user or _user(request)
+        self._state = None
+        self._summary = None
+
+    @property
+    def key(self):
+        return f"cart:{self.user.pk}"
+
+    @property
+    def cache(self):
+        return caches[CART_CACHE_ALIAS]
+
+    def _load(self):
+        if self.user is None:
+            stored = self.request.session.get(settings.CART_SESSION_ID, {})
+            return {'items': {int(product_id): quantity for product_id, quantity in stored.items()}}
+
+        state = self.cache.get(self.key)
+        if state is None:
+            items = dict(CartItem.objects.filter(cart__user=self.user).values_list('product_id', 'quantity'))
+            state = {'items': items, 'synced': dict(items), 'synced_at': time.time()}
+            self.cache.set(self.key, state, CART_CACHE_TIMEOUT)
+        return state
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = self._load()
+        return self._state
+
+    @property
+    def items(self):
+        """{product_id: cantidad} en el orden en que se agregaron."""
+        return self.state['items']
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, product_id):
+        return product_id in self.items
+
+    @contextmanager
+    def locked(self):
         """
-        Agrega un producto al carrito o actualiza su cantidad.
+        Candado por usuario con un valor propio, para soltar solo el candado que se tomó.
+        Al tomarlo se descarta la copia ya leída, así que lo que se lea dentro viene de
+        la caché. El candado expira a los CART_LOCK_TIMEOUT segundos, por si quien lo
+        tiene murió; si en ese tiempo no se consigue se lanza CartBusy sin tocar nada.
         """
-        product_id = str(product.id)
+        lock = f"{self.key}:lock"
+        token = secrets.token_hex(8)
+        deadline = time.monotonic() + CART_LOCK_TIMEOUT
+        while not self.cache.add(lock, token, CART_LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                raise CartBusy(lock)
+            time.sleep(0.005)
+        self._state = None
+        self._summary = None
+        try:
+            yield
+        finally:
+            # Si expiró y otra petición lo tomó, su valor es otro y no se toca.
+            if self.cache.get(lock) == token:
+                self.cache.delete(lock)
 
-        if product_id not in self.cart:
-            self.cart[product_id] = {
-                'quantity': 0,
-                'price': str(product.price)  # Guardamos el precio como string para evitar problemas con JSON
+    @contextmanager
+    def _mutation(self):
+        """
+        Entrega los productos para modificarlos y guarda el resultado. Para usuarios
+        autenticados relee la caché bajo el candado, para no perder cambios de otra pestaña.
+        """
+        self._summary = None
+        if self.user is None:
+            yield self.items
+            self.request.session[settings.CART_SESSION_ID] = {
+                str(product_id): quantity for product_id, quantity in self.items.items()
             }
+            return
 
-        if update_quantity:
-            self.cart[product_id]['quantity'] = quantity
-        else:
-            self.cart[product_id]['quantity'] += quantity
-
-        self.save()
+        with self.locked():
+            yield self.items
+            self.cache.set(self.key, self._state, CART_CACHE_TIMEOUT)
+            if time.time() - self._state['synced_at'] >= settings.CART_SYNC_INTERVAL:
+                self._flush()
 
-    def save(self):
+    def add(self, product, quantity=1):
         """
-        Guarda los cambios en la sesión.
+        Suma `quantity` unidades del producto, con un tope de MAX_CART_QUANTITY.
+        Devuelve la cantidad guardada.
         """
-        self.session[settings.CART_SESSION_ID] = self.cart
-        self.session.modified = True
+        with self._mutation() as items:
+            items[product.id] = min(items.get(product.id, 0) + quantity, MAX_CART_QUANTITY)
+            return items[product.id]
 
-    def remove(self, product):
+    def update(self, product_id, quantity):
         """
-        Elimina un producto del carrito.
+        Cambia la cantidad de un producto que ya está en el carrito.
+        Devuelve la cantidad guardada, o None si el producto no estaba.
         """
-        product_id = str(product.id)
+        with self._mutation() as items:
+            if product_id not in items:
+                return None
+            items[product_id] = max(1, min(quantity, MAX_CART_QUANTITY))
+            return items[product_id]
 
-        if product_id in self.cart:
-            del self.cart[product_id]
-            self.save()
-
-    def __iter__(self):
+    def update_many(self, quantities):
         """
-        Itera sobre los productos en el carrito y obtiene los objetos `Product`.
+        Aplica varios cambios {product_id: cantidad} en una sola modificación; 0 quita
+        el producto. Los productos que no están en el carrito se ignoran.
         """
-        product_ids = self.cart.keys()
-        products = Product.objects.filter(id__in=product_ids)
+        with self._mutation() as items:
+            for product_id, quantity in quantities.items():
+                if product_id not in items:
+                    continue
+                if quantity <= 0:
+                    del items[product_id]
+                else:
+                    items[product_id] = min(quantity, MAX_CART_QUANTITY)
 
-        cart = self.cart.copy()
-        for product in products:
-            cart[str(product.id)]['product'] = product
+    def remove(self, product_id):
+        """
+        Elimina un producto del carrito. Devuelve si estaba.
+        """
+        with self._mutation() as items:
+            return items.pop(product_id, None) is not None
 
-        for item in cart.values():
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
+    @property
+    def summary(self):
+        if self._summary is None:
+            self._summary = CartSummary(self.items)
+        return self._summary
 
-    def __len__(self):
+    def flush(self):
         """
-        Devuelve el número total de productos en el carrito.
+        Guarda en CartItem los cambios pendientes.
         """
-        return sum(item['quantity'] for item in self.cart.values())
+        if self.user is None:
+            return
+        with self.locked():
+            self._flush()
 
-    def get_total_price(self):
+    def _flush(self):
         """
-        Devuelve el precio total del carrito.
+        Escribe solo lo que cambió desde la última escritura, en una transacción:
+        un upsert para las cantidades nuevas y un DELETE para los productos quitados.
         """
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        state = self.state
+        items, synced = state['items'], state['synced']
+        changed = {product_id: quantity for product_id, quantity in items.items() if synced.get(product_id) != quantity}
+        removed = [product_id for product_id in synced if product_id not in items]
+
+        if changed or removed:
+            with transaction.atomic():
+                cart, _ = Cart.objects.get_or_create(user=self.user)
+                if removed:
+                    CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+                if changed:
+                    existing = set(Product.objects.filter(id__in=changed).values_list('id', flat=True))
+                    for product_id in changed.keys() - existing:
+                        # El producto se borró mientras estaba en el carrito.
+                        del items[product_id]
+                    CartItem.objects.bulk_create(
+                        [CartItem(cart=cart, product_id=product_id, quantity=changed[product_id]) for product_id in existing],
+                        update_conflicts=True,
+                        unique_fields=['cart', 'product'],
+                        update_fields=['quantity'],
+                    )
 
-    def clear(self):
+        state['synced'] = dict(items)
+        state['synced_at'] = time.time()
+        self.cache.set(self.key, state, CART_CACHE_TIMEOUT)
+
+    def forget(self):
         """
-        Vacía el carrito.
+        Descarta la copia en caché; la próxima lectura vuelve a cargar CartItem.
         """
-        del self.session[settings.CART_SESSION_ID]
-        self.session.modified = True
+        if self.user is not None:
+            self.cache.delete(self.key)
+        self._state = None
+        self._summary = None
+
+
+class CartSummary:
+    """
+    Resumen del carrito: productos con su precio efectivo, subtotal, recargo de envío
+    y número de unidades. Lo usan la página del carrito, la de confirmación, la barra
+    de navegación y la creación del pedido, así que todos aplican las mismas reglas.
+    Los productos se cargan con una sola consulta y solo si se usan; el contador de
+    la barra de navegación no consulta la base de datos.
+    """
+
+    def __init__(self, items):
+        self.items = dict(items)
+
+    @property
+    def count(self):
+        """Productos distintos en el carrito."""
+        return len(self.items)
+
+    @cached_property
+    def lines(self):
+        """CartItem sin guardar con su producto, `price` (precio final) y `total`."""
+        products = Product.objects.in_bulk(list(self.items))
+        lines = []
+        for product_id, quantity in self.items.items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            line = CartItem(product=product, quantity=quantity)
+            line.price = product.final_price
+            line.total = line.price * quantity
+            lines.append(line)
+        return lines
+
+    @cached_property
+    def available_lines(self):
+        return [line for line in self.lines if line.product.available]
+
+    @property
+    def has_unavailable(self):
+        return len(self.available_lines) != len(self.lines)
+
+    @cached_property
+    def item_count(self):
+        """Unidades de los productos disponibles."""
+        return sum(line.quantity for line in self.available_lines)
+
+    @cached_property
+    def subtotal(self):
+        """Valor de los productos disponibles, sin envío."""
+        return sum((line.total for line in self.available_lines), Decimal('0'))
+
+    def delivery_fee(self, school_address):
+        return delivery_fee(school_address)
+
+    def total(self, school_address):
+        return self.subtotal + self.delivery_fee(school_address)
+
+    def as_json(self):
+        return {
+            'count': self.count,
+            'item_count': self.item_count,
+            'subtotal': str(self.subtotal),
+            'has_unavailable': self.has_unavailable,
+            'lines': {
+                line.product.id: {'quantity': line.quantity, 'price': str(line.price), 'total': str(line.total)}
+                for line in self.lines
+            },
+        }
+
+    def order_products(self):
+        """Productos disponibles en el formato que recibe orders.tasks.create_order."""
+        return [
+            {'product_id': line.product.id, 'price': str(line.price), 'quantity': line.quantity}
+            for line in self.available_lines
+        ]
+
+
+def merge_session_cart(request, user):
+    """
+    Al iniciar sesión, suma el carrito anónimo de la sesión al del usuario y lo guarda.
+    Los productos no disponibles o del mismo vendedor se descartan.
+    El inicio de sesión no falla si el carrito está ocupado: el carrito anónimo queda
+    en la sesión sin sumar.
+    """
+    anonymous = request.session.get(settings.CART_SESSION_ID)
+    cart = request._working_cart = WorkingCart(request, user)
+    try:
+        if anonymous:
+            allowed = Product.objects.filter(id__in=[int(product_id) for product_id in anonymous], available=True).exclude(seller=user)
+            with cart._mutation() as items:
+                for product in allowed.only('id'):
+                    quantity = anonymous[str(product.id)]
+                    items[product.id] = min(items.get(product.id, 0) + quantity, MAX_CART_QUANTITY)
+        request.session.pop(settings.CART_SESSION_ID, None)
+        cart.flush()
+    except CartBusy:
+        logger.warning("Cart of %s busy at login; merging or saving it was skipped.", user.pk)
+
+
+def flush_user_cart(request, user):
+    """
+    Al cerrar sesión, guarda el carrito del usuario y libera la copia en caché.
+    Si el carrito está ocupado se deja la copia en caché, que se guarda en la próxima escritura.
+    """
+    cart = WorkingCart(request, user)
+    try:
+        cart.flush()
+    except CartBusy:
+        logger.warning("Cart of %s busy at logout; keeping its cached copy.", user.pk)
+        return
+    cart.forget()
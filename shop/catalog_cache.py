@@ -0,0 +1,93 @@
+import threading
+
+from django.core.cache import cache
+
+# Catalog pages and fragments are cached under version numbers, and bumping a
+# version drops everything keyed on it at once:
+#   catalog  every product, category or offer change
+#   sales    every order, for what is listed in sales order (ranking, best sellers)
+#   prices   a product's final price or availability, for the price facet data
+CATALOG_VERSION_KEY = "catalog:version"
+SALES_VERSION_KEY = "catalog:sales_version"
+PRICES_VERSION_KEY = "catalog:prices_version"
+CATALOG_CACHE_TIMEOUT = 60 * 15
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def get_versions(keys):
+    """The current number of each version in `keys`, in the same order."""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, 1, None)
+            versions[key] = cache.get(key, 1)
+    return [versions[key] for key in keys]
+
+
+def get_catalog_version():
+    return get_versions([CATALOG_VERSION_KEY])[0]
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 2, None)
+
+
+def bump_catalog_version():
+    """Invalidates every cached catalog page and fragment at once."""
+    bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_sales_version():
+    """Invalidates what is cached in sales order; called after every order."""
+    bump_version(SALES_VERSION_KEY)
+
+
+def bump_prices_version():
+    """Invalidates the cached price data of the facets."""
+    bump_version(PRICES_VERSION_KEY)
+
+
+def catalog_key(*parts, versions=(CATALOG_VERSION_KEY,)):
+    return ":".join(["catalog", *map(str, get_versions(list(versions))), *map(str, parts)])
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_or_set(name, builder, timeout=CATALOG_CACHE_TIMEOUT, versions=(CATALOG_VERSION_KEY,)):
+    """
+    Returns the cached value stored under `name` for the current number of
+    `versions`, calling `builder()` and storing its result on a miss.
+    """
+    key = catalog_key(name, versions=versions)
+    value = cache.get(key)
+    if value is not None:
+        _count('hits')
+        return value
+
+    _count('misses')
+    value = builder()
+    cache.set(key, value, timeout)
+    return value
+
+
+def get_stats():
+    """Returns the hit/miss counters of this process."""
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / total if total else 0.0
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats['hits'] = 0
+        _stats['misses'] = 0
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+from .cart import CART_CACHE_ALIAS
+
+# Backends that keep a copy per process: each gunicorn worker would have its own carts.
+PROCESS_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches, deploy=True)
+def check_cart_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get(CART_CACHE_ALIAS, {}).get('BACKEND')
+    if backend is None:
+        return [Error(
+            f"CACHES has no '{CART_CACHE_ALIAS}' alias for the logged-in users' carts.",
+            hint="Set CART_CACHE_URL to a Redis server.",
+            id='shop.E001',
+        )]
+    if backend in PROCESS_CACHE_BACKENDS:
+        return [Error(
+            f"The '{CART_CACHE_ALIAS}' cache ({backend}) is not shared between processes: "
+            "each worker would keep its own copy of a cart and overwrite the others' changes.",
+            hint="Set CART_CACHE_URL to a Redis server.",
+            id='shop.E002',
+        )]
+    return []
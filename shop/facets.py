@@ -0,0 +1,195 @@
+import statistics
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Count, Q
+from django.http import QueryDict
+
+from .catalog_cache import PRICES_VERSION_KEY, get_or_set
+from .models import Product
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional; statistics.quantiles gives the same cut points.
+    numpy = None
+
+# Fallback bucket boundaries in COP, used while the catalog is too small for quantiles.
+FIXED_PRICE_BOUNDARIES = (1000, 2000, 5000, 10000)
+PRICE_QUANTILES = 5
+MIN_PRODUCTS_FOR_QUANTILES = 20
+# Quantile boundaries are rounded to a multiple of this, so labels read well.
+PRICE_ROUNDING = 500
+# Prices have two decimals, so "max_price = boundary - CENT" is "below the boundary".
+CENT = Decimal('0.01')
+
+# ?sort= values and whether they sort descending.
+PRICE_SORTS = {'price': False, '-price': True}
+
+
+def price_vector():
+    """Final prices of every available product, cached until one of them changes (see shop.signals)."""
+    return get_or_set(
+        'facets:prices',
+        lambda: [float(price) for price in Product.objects.filter(available=True).values_list('final_price', flat=True)],
+        versions=(PRICES_VERSION_KEY,),
+    )
+
+
+def quantile_boundaries(prices, buckets=PRICE_QUANTILES):
+    if numpy is not None:
+        cuts = numpy.quantile(numpy.asarray(prices), [i / buckets for i in range(1, buckets)]).tolist()
+    else:
+        cuts = statistics.quantiles(prices, n=buckets, method='inclusive')
+    rounded = {int(round(cut / PRICE_ROUNDING) * PRICE_ROUNDING) for cut in cuts}
+    return tuple(sorted(boundary for boundary in rounded if boundary > 0))
+
+
+def price_boundaries():
+    """
+    Bucket boundaries for the price facet: catalog quantiles so every bucket holds
+    a similar share of products, or FIXED_PRICE_BOUNDARIES for small catalogs.
+    """
+    def build():
+        prices = price_vector()
+        if len(prices) < MIN_PRODUCTS_FOR_QUANTILES:
+            return FIXED_PRICE_BOUNDARIES
+        return quantile_boundaries(prices) or FIXED_PRICE_BOUNDARIES
+
+    return get_or_set('facets:price_boundaries', build, versions=(PRICES_VERSION_KEY,))
+
+
+def price_buckets(boundaries):
+    """[(min, max), ...] with open ends as None."""
+    edges = [None, *boundaries, None]
+    return list(zip(edges, edges[1:]))
+
+
+def bucket_filter(low, high):
+    condition = Q()
+    if low is not None:
+        condition &= Q(final_price__gte=low)
+    if high is not None:
+        condition &= Q(final_price__lt=high)
+    return condition
+
+
+class Facets:
+    """
+    Counts for the filters of a result set, computed in one GROUP BY category query
+    with conditional counts for offers and each price bucket. The option links carry
+    the filters and, of the other query parameters, only those named in `keep`.
+    """
+
+    def __init__(self, queryset, request=None, boundaries=None, keep=()):
+        self.buckets = price_buckets(price_boundaries() if boundaries is None else boundaries)
+
+        aggregates = {
+            'count': Count('id'),
+            'offers': Count('id', filter=Q(offer_active=True)),
+        }
+        for i, (low, high) in enumerate(self.buckets):
+            aggregates[f'price_{i}'] = Count('id', filter=bucket_filter(low, high))
+
+        rows = list(
+            queryset.order_by().values('category__name', 'category__slug').annotate(**aggregates).order_by('category__name')
+        )
+
+        self.categories = [
+            {'name': row['category__name'], 'slug': row['category__slug'], 'count': row['count']} for row in rows
+        ]
+        self.count = sum(row['count'] for row in rows)
+        self.offers = sum(row['offers'] for row in rows)
+        self.no_offers = self.count - self.offers
+        self.prices = [
+            {
+                'min': low,
+                'max': high,
+                'max_price': high - CENT if high is not None else None,
+                'count': sum(row[f'price_{i}'] for row in rows),
+            }
+            for i, (low, high) in enumerate(self.buckets)
+        ]
+        if request is not None:
+            self.add_links(request, keep)
+
+    def __bool__(self):
+        return self.count > 0
+
+    def add_links(self, request, keep=()):
+        """Adds to every option the URL that applies it, or removes it when it is already applied."""
+        filters = parse_filters(request)
+        base = {name: request.GET[name] for name in keep if name in request.GET}
+        for category in self.categories:
+            category['active'] = filters['category'] == category['slug']
+            category['url'] = filter_url(filters, base, category=None if category['active'] else category['slug'])
+
+        self.offer_options = []
+        for value, label, count in (('1', "En oferta", self.offers), ('0', "Sin oferta", self.no_offers)):
+            active = filters['offer'] == value
+            self.offer_options.append({
+                'label': label, 'count': count, 'active': active,
+                'url': filter_url(filters, base, offer=None if active else value),
+            })
+
+        for bucket in self.prices:
+            bucket['active'] = (filters['min_price'], filters['max_price']) == (bucket['min'], bucket['max_price'])
+            if bucket['active']:
+                bucket['url'] = filter_url(filters, base, min_price=None, max_price=None)
+            else:
+                bucket['url'] = filter_url(filters, base, min_price=bucket['min'], max_price=bucket['max_price'])
+
+
+def parse_price(value):
+    try:
+        price = Decimal(value)
+    except (TypeError, InvalidOperation):
+        return None
+    return price if price.is_finite() and price >= 0 else None
+
+
+def parse_filters(request):
+    """Sort and facet filters from the query string; anything invalid is ignored."""
+    params = request.GET
+    return {
+        'sort': params.get('sort') if params.get('sort') in PRICE_SORTS else "",
+        'min_price': parse_price(params.get('min_price')),
+        'max_price': parse_price(params.get('max_price')),
+        'offer': params.get('offer') if params.get('offer') in ('1', '0') else "",
+        'category': params.get('category', "")[:200],
+    }
+
+
+def filter_url(filters, base=None, **changes):
+    """
+    Query string for the parsed `filters` with `changes` applied (None removes a
+    filter), from the first page. It is built from the filters and `base` only:
+    facets are cached per filter variant, so their links must not carry other
+    parameters of the request that happened to fill the cache.
+    """
+    params = QueryDict(mutable=True)
+    params.update(base or {})
+    for name, value in {**filters, **changes}.items():
+        if value is not None and value != "":
+            params[name] = value
+    return f"?{params.urlencode()}"
+
+
+def has_filters(filters):
+    """Whether any facet filter (not just a sort) is applied."""
+    return bool(filters['category'] or filters['offer']) or filters['min_price'] is not None or filters['max_price'] is not None
+
+
+def filters_key(filters):
+    return "{sort}:{min_price}:{max_price}:{offer}:{category}".format(**filters)
+
+
+def apply_filters(queryset, filters):
+    """Narrows `queryset` with the filters from parse_filters(); all of them hit indexed columns."""
+    if filters['category']:
+        queryset = queryset.filter(category__slug=filters['category'])
+    if filters['offer']:
+        queryset = queryset.filter(offer_active=filters['offer'] == '1')
+    if filters['min_price'] is not None:
+        queryset = queryset.filter(final_price__gte=filters['min_price'])
+    if filters['max_price'] is not None:
+        queryset = queryset.filter(final_price__lte=filters['max_price'])
+    return queryset
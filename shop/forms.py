@@ -8,8 +8,9 @@ from django.utils.text import slugify
 from django.contrib.auth import get_user_model
 from django.core.files.base import ContentFile
 from django.forms import inlineformset_factory
+from django.db.models import F
 
-from.models import Category, Product, RechargeLogs
+from.models import MAX_CART_QUANTITY, Category, Product, RechargeLogs
 from luis_carlos_cooperativa.utils.validators import validate_images
 from luis_carlos_cooperativa.utils.convert_image import convert_image_to_webp
 from django.utils import timezone
@@ -18,7 +19,7 @@ User = get_user_model()
 
 
 PRODUCT_QUANTITY_CHOICES = [] # = [(1, "1"), (2, "2"), ..., (20, "20")]
-for i in range(1, 21):
+for i in range(1, MAX_CART_QUANTITY + 1):
     PRODUCT_QUANTITY_CHOICES.append((i, str(i)))
 
 
@@ -31,10 +32,10 @@ class CartAddProductForm(forms.Form):
 
 class CartUpdateProductForm(forms.Form):
     update = forms.IntegerField(
-        max_value=20,
+        max_value=MAX_CART_QUANTITY,
         min_value=1,
         validators=[MinValueValidator(1)],
-        widget=forms.NumberInput(attrs={'class': 'form-control', 'min': 1, 'max': 20, 'placeholder': 'Max 20'})
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'min': 1, 'max': MAX_CART_QUANTITY, 'placeholder': f'Max {MAX_CART_QUANTITY}'})
     )
 
 
@@ -218,8 +219,10 @@ class CreditRechargeForm(forms.Form):
         except User.DoesNotExist:
             raise ValueError("El usuario con este código no existe.")
 
-        user_obj.credit += amount
-        user_obj.save()
+        # Only the credit column, added in SQL, so a concurrent checkout debit is not overwritten.
+        user_obj.credit = F('credit') + amount
+        user_obj.save(update_fields=['credit'])
+        user_obj.refresh_from_db(fields=['credit'])
 
         RechargeLogs.objects.create(
             seller=self.user,
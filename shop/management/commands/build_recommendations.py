@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.recommendations import RECOMMENDATIONS_PER_PRODUCT, rebuild_recommendations
+
+
+class Command(BaseCommand):
+    help = "Recalcula las recomendaciones de \"comprados juntos\" a partir de todo el historial de pedidos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--k', type=int, default=RECOMMENDATIONS_PER_PRODUCT, help="Recomendaciones por producto.")
+
+    def handle(self, *args, **options):
+        products = rebuild_recommendations(options['k'])
+        self.stdout.write(self.style.SUCCESS(f"Recomendaciones recalculadas para {products} productos."))
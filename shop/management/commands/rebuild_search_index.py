@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Product
+from shop.search_index import create_index, rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Crea (si falta) y reconstruye el índice de búsqueda de productos."
+
+    def handle(self, *args, **options):
+        if not create_index():
+            rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f"Índice reconstruido: {Product.objects.count()} productos."))
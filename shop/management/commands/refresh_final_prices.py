@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.catalog_cache import bump_catalog_version, bump_prices_version
+from shop.models import Product
+
+
+class Command(BaseCommand):
+    help = "Recalcula el precio final guardado de todos los productos (por ejemplo, tras añadir la columna)."
+
+    def handle(self, *args, **options):
+        updated = Product.objects.refresh_final_prices()
+        bump_catalog_version()
+        bump_prices_version()
+        self.stdout.write(self.style.SUCCESS(f"Precio final recalculado: {updated} productos."))
@@ -1,4 +1,4 @@
-from decimal import Decimal
+from decimal import Decimal, ROUND_HALF_UP
 
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
@@ -8,7 +8,8 @@ from django.utils.translation import gettext_lazy as _
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
-from django.db.models import Sum, F
+from django.db.models import Case, DecimalField, Sum, F, Q, Value, When, Window
+from django.db.models.functions import Round, RowNumber
 from django.conf import settings
 
 class Category(models.Model):
@@ -47,8 +48,12 @@ class Category(models.Model):
         return reverse('shop:search_by_category', args=[self.slug])
 
     def get_price_ranges(self):
-        if self.price_ranges:
-            return self.price_ranges
+        """Price buckets of the category's available products, with their counts."""
+        from .facets import Facets
+
+        facets = Facets(self.product.filter(available=True))
+        if facets:
+            return facets.prices
         else:
             return False
     
@@ -57,6 +62,82 @@ class Category(models.Model):
 
 
 
+# Fields that determine Product.final_price.
+PRICE_FIELDS = ('price', 'discount_percent', 'discount_price', 'offer_active')
+
+
+def final_price_expression():
+    """
+    SQL version of Product.calculate_final_price(), used to backfill the stored column.
+    It multiplies by 0.01 instead of dividing by 100: SQLite casts integral
+    decimals to integers, so the division would truncate.
+    """
+    return Case(
+        When(offer_active=True, discount_price__gt=0, then=F('discount_price')),
+        When(
+            offer_active=True,
+            discount_percent__gt=0,
+            then=Round(F('price') - F('price') * F('discount_percent') * Value(Decimal('0.01')), 2),
+        ),
+        default=F('price'),
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    )
+
+
+class ProductQuerySet(models.QuerySet):
+
+    def top_per_category(self, limit=4):
+        """
+        Returns the best `limit` products of every category in a single query,
+        ranked with ROW_NUMBER() over the category by (-offer_active, -sales).
+        Category and seller are joined so cards can be rendered without extra queries.
+        """
+        return self.annotate(
+            category_rank=Window(
+                expression=RowNumber(),
+                partition_by=F('category'),
+                order_by=[F('offer_active').desc(), F('sales').desc(), F('id').asc()],
+            )
+        ).filter(
+            category_rank__lte=limit
+        ).select_related(
+            'category', 'seller'
+        ).order_by('category__name', 'category_id', 'category_rank')
+
+    def listing(self):
+        """
+        Available products in catalog order (-offer_active, -sales, id), the order
+        keyset pagination relies on; `id` makes it total so no product is skipped or repeated.
+        """
+        return self.filter(available=True).select_related('category', 'seller').order_by('-offer_active', '-sales', 'id')
+
+    def by_price(self, descending=False):
+        """Orders by the stored final price, with `id` to make the order total for keyset pagination."""
+        return self.order_by('-final_price' if descending else 'final_price', 'id')
+
+    def after_price(self, final_price, id, descending=False):
+        """Products that come after (final_price, id) in by_price() order."""
+        if descending:
+            return self.filter(Q(final_price__lt=final_price) | Q(final_price=final_price, id__gt=id), final_price__lte=final_price)
+        return self.filter(Q(final_price__gt=final_price) | Q(final_price=final_price, id__gt=id), final_price__gte=final_price)
+
+    def refresh_final_prices(self):
+        """Recomputes final_price in a single UPDATE, e.g. after rows were changed with .update()."""
+        return self.update(final_price=final_price_expression())
+
+    def after(self, offer_active, sales, id):
+        """
+        Products that come after (offer_active, sales, id) in catalog order.
+        The redundant `sales__lte` bound lets the index seek straight to the cursor;
+        `offer_active__in` is used because SQLite cannot seek on the "NOT offer_active"
+        that a plain boolean filter compiles to.
+        """
+        same_offer = Q(offer_active__in=[offer_active], sales__lte=sales) & (Q(sales__lt=sales) | Q(sales=sales, id__gt=id))
+        if offer_active:
+            return self.filter(same_offer | Q(offer_active=False))
+        return self.filter(same_offer)
+
+
 class Product(models.Model):
     category = models.ForeignKey(
         Category,
@@ -145,7 +226,17 @@ class Product(models.Model):
         verbose_name=_("¿Disponible?"),
         help_text=_("Indica si el producto está disponible para la venta.")
     )
+    final_price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=0,
+        editable=False,
+        verbose_name=_("Precio final"),
+        help_text=_("Precio que se cobra, con la oferta aplicada. Se actualiza al guardar el producto.")
+    )
+
 
+    objects = ProductQuerySet.as_manager()
 
     class Meta:
         ordering = ['name'] 
@@ -153,6 +244,10 @@ class Product(models.Model):
             models.Index(fields=['id', 'slug']),
             models.Index(fields=['price']),
             models.Index(fields=['-created']),
+            models.Index(fields=['category', '-offer_active', '-sales', 'id']),
+            models.Index(fields=['-offer_active', '-sales', 'id']),
+            models.Index(fields=['final_price', 'id']),
+            models.Index(fields=['category', 'final_price', 'id']),
         ]
         verbose_name = _("Producto")
         verbose_name_plural = _("Productos")
@@ -176,14 +271,25 @@ class Product(models.Model):
             self.image.delete(save=False)
         super().delete(*args, **kwargs)
 
-    def get_final_price(self):
+    def save(self, *args, **kwargs):
+        self.final_price = self.calculate_final_price()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) & set(PRICE_FIELDS):
+            kwargs['update_fields'] = {*update_fields, 'final_price'}
+        super().save(*args, **kwargs)
+
+    def calculate_final_price(self):
+        price = Decimal(self.price)
         if self.offer_active:
             if self.discount_price:
-                return self.discount_price
-            elif self.discount_percent > 0:
+                return Decimal(self.discount_price)
+            elif self.discount_percent and self.discount_percent > 0:
                 discount_percentage = Decimal(self.discount_percent) / Decimal(100)
-                return self.price - (self.price * discount_percentage)
-        return self.price
+                price = price - (price * discount_percentage)
+        return price.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+    def get_final_price(self):
+        return self.final_price
 
 class Cart(models.Model):
     user = models.OneToOneField(
@@ -211,20 +317,23 @@ class Cart(models.Model):
 
 
     def get_total(self):
-        return sum(item.product.get_final_price() * item.quantity for item in self.cart_items.select_related("product"))
+        total = self.cart_items.aggregate(
+            total=Sum(F('product__final_price') * F('quantity'), output_field=DecimalField(max_digits=12, decimal_places=2))
+        )['total']
+        return total or Decimal('0')
 
     def get_total_cost(self):
-        return sum(item.product.get_final_price() * item.quantity for item in self.cart_items.select_related("product"))
+        return self.get_total()
 
 
     def get_cart_items_data(self):
         return [
             {
-                'product_id': item.product.id,
-                'price': float(item.product.get_final_price()),
-                'quantity': item.quantity
+                'product_id': item['product_id'],
+                'price': float(item['product__final_price']),
+                'quantity': item['quantity']
             }
-            for item in self.cart_items.select_related("product")
+            for item in self.cart_items.values('product_id', 'product__final_price', 'quantity')
         ]
 
     def mark_as_paid(self):
@@ -238,6 +347,10 @@ class Cart(models.Model):
     def total_items (self):
         return self.cart_items.count()
 
+# Most units of one product a cart may hold; also enforced by a check constraint.
+MAX_CART_QUANTITY = 20
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey("Cart", on_delete=models.CASCADE, related_name="cart_items")
     product = models.ForeignKey("Product", on_delete=models.CASCADE, related_name="cart_items")
@@ -245,6 +358,12 @@ class CartItem(models.Model):
 
     class Meta:
         unique_together = ('cart', 'product')
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(quantity__gte=1, quantity__lte=MAX_CART_QUANTITY),
+                name='cart_item_quantity_range',
+            ),
+        ]
 
 
     def clean(self):
@@ -261,6 +380,24 @@ class CartItem(models.Model):
     def __str__(self):
         return f"{self.quantity} x {self.product.name} en el carrito de {self.cart.user.code}"
 
+class ProductRecommendation(models.Model):
+    """
+    Top-k products bought together with `product`, precomputed from order history
+    by shop.recommendations. `rank` 0 is the strongest.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="recommendations")
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="recommended_by")
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        verbose_name = _("Recomendación")
+        verbose_name_plural = _("Recomendaciones")
+        unique_together = ('product', 'rank')
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} ({self.score:.3f})"
+
 class ShowBestOffers(models.Model):
     category = models.ForeignKey(
         "Category",
@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+
+from django.shortcuts import render
+from django.utils.functional import cached_property
+
+from .facets import PRICE_SORTS, apply_filters, filters_key, parse_filters
+
+PAGE_SIZE = 24
+ORDER_PAGE_SIZE = 50
+# Order cursors carry `created` as integer microseconds since this instant.
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+RESULTS_PAGE_TEMPLATE = 'components/shop/_results_page.html'
+
+
+def encode_cursor(product):
+    return f"{int(product.offer_active)}.{product.sales}.{product.id}"
+
+
+def decode_cursor(cursor):
+    """Returns (offer_active, sales, id) or None for a missing or malformed cursor."""
+    try:
+        offer_active, sales, pk = (int(part) for part in (cursor or "").split("."))
+    except ValueError:
+        return None
+    return bool(offer_active), sales, pk
+
+
+def encode_price_cursor(product):
+    return f"{product.final_price}~{product.id}"
+
+
+def decode_price_cursor(cursor):
+    """Returns (final_price, id) or None for a missing or malformed cursor."""
+    try:
+        final_price, pk = (cursor or "").split("~")
+        return Decimal(final_price), int(pk)
+    except (ValueError, InvalidOperation):
+        return None
+
+
+class KeysetPage:
+    """
+    One page of a queryset in catalog order, read from the position a cursor points at.
+    The cost does not depend on how deep the page is, unlike OFFSET. Nothing is
+    queried until the products are accessed, so a cached page costs nothing.
+    `variant` names the sort and filters in use, for cache keys.
+    """
+
+    def __init__(self, queryset, cursor=None, per_page=None, variant=""):
+        self.queryset = queryset
+        self.cursor = self.clean_cursor(cursor)
+        self.per_page = per_page or PAGE_SIZE
+        self.variant = variant
+
+    def clean_cursor(self, cursor):
+        """A malformed cursor reads as the first page."""
+        return cursor if self.decode(cursor) else ""
+
+    def decode(self, cursor):
+        return decode_cursor(cursor)
+
+    def encode(self, product):
+        return encode_cursor(product)
+
+    def seek(self, queryset, position):
+        return queryset.after(*position)
+
+    @property
+    def cache_key(self):
+        return f"{self.variant}:{self.cursor}"
+
+    @cached_property
+    def _rows(self):
+        queryset = self.seek(self.queryset, self.decode(self.cursor)) if self.cursor else self.queryset
+        return list(queryset[:self.per_page + 1])
+
+    @property
+    def products(self):
+        return self._rows[:self.per_page]
+
+    @property
+    def next_cursor(self):
+        if len(self._rows) > self.per_page:
+            return self.encode(self._rows[self.per_page - 1])
+        return ""
+
+
+class PricePage(KeysetPage):
+    """Keyset page in final price order, cheapest first unless `descending`."""
+
+    def __init__(self, queryset, cursor=None, per_page=None, variant="", descending=False):
+        self.descending = descending
+        super().__init__(queryset.by_price(descending), cursor, per_page, variant)
+
+    def decode(self, cursor):
+        return decode_price_cursor(cursor)
+
+    def encode(self, product):
+        return encode_price_cursor(product)
+
+    def seek(self, queryset, position):
+        return queryset.after_price(*position, descending=self.descending)
+
+
+def encode_order_cursor(order):
+    micros = (order.created - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}.{order.id}"
+
+
+def decode_order_cursor(cursor):
+    """Returns (created, id) or None for a missing or malformed cursor."""
+    try:
+        micros, pk = (int(part) for part in (cursor or "").split("."))
+        return EPOCH + timedelta(microseconds=micros), pk
+    except (ValueError, OverflowError):
+        return None
+
+
+class OrderQueuePage(KeysetPage):
+    """Keyset page of a queryset in pending queue order (Order.objects.pending_queue())."""
+
+    def __init__(self, queryset, cursor=None, per_page=None):
+        super().__init__(queryset, cursor, per_page or ORDER_PAGE_SIZE)
+
+    def decode(self, cursor):
+        return decode_order_cursor(cursor)
+
+    def encode(self, order):
+        return encode_order_cursor(order)
+
+    def seek(self, queryset, position):
+        return queryset.after_created(*position)
+
+    @property
+    def orders(self):
+        return self.products
+
+
+class RankedPage(KeysetPage):
+    """
+    Page over a list of ranked ids, such as search results. The cursor is the
+    position of the next id, and only the products of the page are loaded.
+    """
+
+    def __init__(self, queryset, ranked_ids, cursor=None, per_page=None):
+        super().__init__(queryset, cursor, per_page)
+        self.ranked_ids = ranked_ids
+
+    def clean_cursor(self, cursor):
+        return cursor if (cursor or "").isdigit() else ""
+
+    @cached_property
+    def _rows(self):
+        start = int(self.cursor or 0)
+        page_ids = self.ranked_ids[start:start + self.per_page]
+        products_by_id = self.queryset.in_bulk(page_ids)
+        return [products_by_id[pk] for pk in page_ids if pk in products_by_id]
+
+    @property
+    def next_cursor(self):
+        start = int(self.cursor or 0)
+        if start + self.per_page < len(self.ranked_ids):
+            return str(start + self.per_page)
+        return ""
+
+
+def listing_page(request, queryset):
+    """
+    Page of a product listing for the request: catalog order by default, or by
+    final price with ?sort=price / ?sort=-price, narrowed by the facet filters.
+    Returns the page and the filters in use, for the filter form.
+    """
+    filters = parse_filters(request)
+    queryset = apply_filters(queryset, filters)
+    cursor = request.GET.get('cursor')
+    if filters['sort']:
+        return PricePage(queryset, cursor, variant=filters_key(filters), descending=PRICE_SORTS[filters['sort']]), filters
+    return KeysetPage(queryset, cursor, variant=filters_key(filters)), filters
+
+
+def page_query(request):
+    """Current query string without the paging parameters, ready to be followed by `cursor=`."""
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    params.pop('partial', None)
+    query = params.urlencode()
+    return f"{query}&" if query else ""
+
+
+def is_partial(request):
+    """Load-more requests ask for just the next cards with ?partial=1."""
+    return request.GET.get('partial') == '1'
+
+
+def render_results(request, template_name, context):
+    """Renders a results page, or only its next cards for load-more requests."""
+    if is_partial(request):
+        if context.get('cache_name'):
+            context['cache_name'] += ':partial'
+        template_name = RESULTS_PAGE_TEMPLATE
+    return render(request, template_name, context)
@@ -0,0 +1,208 @@
+import logging
+import math
+from collections import Counter, defaultdict
+from itertools import combinations
+
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from .models import Product, ProductRecommendation
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional; the pure-Python path gives the same scores.
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATIONS_PER_PRODUCT = 12
+# Orders in these states did not really happen, so they are not co-purchases.
+EXCLUDED_ORDER_STATUSES = ('refunded', 'cancelled')
+
+
+def order_items():
+    from orders.models import OrderItem
+    return OrderItem.objects.exclude(order__status__in=EXCLUDED_ORDER_STATUSES)
+
+
+def cosine(pair_count, count_a, count_b):
+    """Orders with both products over the geometric mean of their order counts."""
+    return pair_count / math.sqrt(count_a * count_b)
+
+
+def top_neighbours(pairs, k=RECOMMENDATIONS_PER_PRODUCT):
+    """
+    Item-item co-occurrence from (order_id, product_id) pairs, as
+    {product_id: [(neighbour_id, score), ...]} with the best `k` neighbours first.
+    """
+    if numpy is not None:
+        return _top_neighbours_numpy(pairs, k)
+    return _top_neighbours_python(pairs, k)
+
+
+def _top_neighbours_python(pairs, k):
+    products_by_order = defaultdict(set)
+    for order_id, product_id in pairs:
+        products_by_order[order_id].add(product_id)
+
+    orders_per_product = Counter()
+    pair_counts = Counter()
+    for products in products_by_order.values():
+        orders_per_product.update(products)
+        pair_counts.update(combinations(sorted(products), 2))
+
+    neighbours = defaultdict(list)
+    for (a, b), together in pair_counts.items():
+        score = cosine(together, orders_per_product[a], orders_per_product[b])
+        neighbours[a].append((b, score))
+        neighbours[b].append((a, score))
+    return {
+        product_id: sorted(candidates, key=lambda c: (-c[1], c[0]))[:k]
+        for product_id, candidates in neighbours.items()
+    }
+
+
+def _top_neighbours_numpy(pairs, k):
+    """
+    Builds the sparse order x product incidence matrix in COO form and multiplies it
+    by its transpose without densifying: every pair of products in the same order
+    becomes one (row, col) entry, and duplicated entries are summed with numpy.unique.
+    """
+    data = numpy.unique(numpy.asarray(list(pairs), dtype=numpy.int64).reshape(-1, 2), axis=0)
+    if not len(data):
+        return {}
+    orders, order_index = numpy.unique(data[:, 0], return_inverse=True)
+    products, product_index = numpy.unique(data[:, 1], return_inverse=True)
+    orders_per_product = numpy.bincount(product_index, minlength=len(products))
+
+    # Rows are sorted by order, so each order's products are contiguous: pairing every
+    # row with the row `offset` places later, while both are in the same order, visits
+    # each pair once with one vectorized pass per offset instead of a loop over orders.
+    rows, cols = [], []
+    for offset in range(1, len(data)):
+        same_order = order_index[offset:] == order_index[:-offset]
+        if not same_order.any():
+            break
+        rows.append(product_index[:-offset][same_order])
+        cols.append(product_index[offset:][same_order])
+    if not rows:
+        return {}
+
+    rows = numpy.concatenate(rows)
+    cols = numpy.concatenate(cols)
+    keys, together = numpy.unique(rows * len(products) + cols, return_counts=True)
+    a, b = numpy.divmod(keys, len(products))
+    scores = together / numpy.sqrt(orders_per_product[a] * orders_per_product[b])
+
+    # Both directions, then sort by product, score desc, neighbour id.
+    source = numpy.concatenate([a, b])
+    target = numpy.concatenate([b, a])
+    scores = numpy.concatenate([scores, scores])
+    order = numpy.lexsort((products[target], -scores, source))
+    source, target, scores = source[order], target[order], scores[order]
+
+    neighbours = {}
+    starts = numpy.flatnonzero(numpy.r_[True, source[1:] != source[:-1]])
+    for start, end in zip(starts, numpy.r_[starts[1:], len(source)]):
+        end = min(end, start + k)
+        neighbours[int(products[source[start]])] = [
+            (int(products[t]), float(score)) for t, score in zip(target[start:end], scores[start:end])
+        ]
+    return neighbours
+
+
+def _store(neighbours, product_ids):
+    """Replaces the stored recommendations of `product_ids`."""
+    ProductRecommendation.objects.filter(product_id__in=product_ids).delete()
+    ProductRecommendation.objects.bulk_create(
+        ProductRecommendation(product_id=product_id, recommended_id=neighbour_id, score=score, rank=rank)
+        for product_id in product_ids
+        for rank, (neighbour_id, score) in enumerate(neighbours.get(product_id, []))
+    )
+
+
+def rebuild_recommendations(k=RECOMMENDATIONS_PER_PRODUCT):
+    """Offline job: recomputes every product's neighbours from the whole order history."""
+    neighbours = top_neighbours(order_items().values_list('order_id', 'product_id').iterator(chunk_size=10_000), k)
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        _store(neighbours, list(neighbours))
+    return len(neighbours)
+
+
+def refresh_recommendations(product_ids, k=RECOMMENDATIONS_PER_PRODUCT):
+    """
+    Incremental refresh after an order: only the products in it gained co-purchases,
+    so only their neighbour lists are recomputed, with three indexed aggregate
+    queries each. Scores of other products drift slightly until the next rebuild.
+    """
+    items = order_items()
+    neighbours = {}
+    for product_id in set(product_ids):
+        orders = items.filter(product_id=product_id).values('order_id')
+        product_orders = orders.count()
+        together = (
+            items.filter(order_id__in=orders)
+            .exclude(product_id=product_id)
+            .values('product_id')
+            .annotate(together=Count('order_id', distinct=True))
+        )
+        counts = dict(
+            items.filter(product_id__in=together.values('product_id'))
+            .values('product_id')
+            .annotate(orders=Count('order_id', distinct=True))
+            .values_list('product_id', 'orders')
+        )
+        scored = [
+            (row['product_id'], cosine(row['together'], product_orders, counts[row['product_id']]))
+            for row in together
+        ]
+        neighbours[product_id] = sorted(scored, key=lambda c: (-c[1], c[0]))[:k]
+
+    with transaction.atomic():
+        _store(neighbours, list(neighbours))
+
+
+def schedule_refresh(product_ids):
+    """Refreshes after the current transaction commits; a failure never breaks checkout."""
+    def refresh():
+        try:
+            refresh_recommendations(product_ids)
+        except Exception:
+            logger.exception("Could not refresh recommendations.")
+
+    transaction.on_commit(refresh)
+
+
+def recommended_products(product_ids, limit=20, exclude=()):
+    """
+    Available products most bought together with `product_ids`, best first, in one
+    query over the (product, rank) index. Several sources add up their scores.
+    """
+    return list(
+        Product.objects.filter(recommended_by__product_id__in=product_ids, available=True)
+        .exclude(id__in=[*product_ids, *exclude])
+        .annotate(recommendation_score=Sum('recommended_by__score'))
+        .select_related('seller')
+        .order_by('-recommendation_score', 'id')[:limit]
+    )
+
+
+def related_products(product_ids, category_ids, limit=20, exclude_seller=None):
+    """
+    Co-purchase recommendations for `product_ids`, topped up with the best sellers of
+    `category_ids` while there is not enough order history (a second query only then).
+    """
+    products = recommended_products(product_ids, limit)
+    if exclude_seller is not None:
+        products = [product for product in products if product.seller_id != exclude_seller.pk]
+    if len(products) < limit:
+        fallback = (
+            Product.objects.listing()
+            .filter(category_id__in=category_ids)
+            .exclude(id__in=[*product_ids, *(product.id for product in products)])
+        )
+        if exclude_seller is not None:
+            fallback = fallback.exclude(seller=exclude_seller)
+        products += list(fallback[:limit - len(products)])
+    return products
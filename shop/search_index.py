@@ -0,0 +1,225 @@
+import logging
+import re
+import unicodedata
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Q
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = "shop_product_search"
+SEARCH_LIMIT = 200
+
+# Rank weights for name, category and description.
+NAME_WEIGHT, CATEGORY_WEIGHT, DESCRIPTION_WEIGHT = 10.0, 4.0, 1.0
+
+
+def normalize(text):
+    """Lowercases and strips accents, so "Café" and "cafe" index and match the same way."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text):
+    return re.findall(r"\w+", normalize(text))
+
+
+def product_document(product):
+    return normalize(product.name), normalize(product.category.name), normalize(product.description)
+
+
+class SearchBackend:
+    """
+    Fallback used when the database has no full-text support:
+    an accent-sensitive icontains over name, description and category.
+    """
+
+    def create(self):
+        return False
+
+    def index(self, products):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+    def clear(self):
+        pass
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        products = Product.objects.filter(available=True)
+        for token in query.split():
+            products = products.filter(
+                Q(name__icontains=token) | Q(description__icontains=token) | Q(category__name__icontains=token)
+            )
+        return list(products.order_by('-offer_active', '-sales').values_list('id', flat=True)[:limit])
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """FTS5 virtual table whose rowid is the product id."""
+
+    def create(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SEARCH_TABLE]
+            )
+            if cursor.fetchone():
+                return False
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+                "name, category, description, tokenize = 'unicode61 remove_diacritics 2')"
+            )
+        return True
+
+    def index(self, products):
+        rows = [(product.id, *product_document(product)) for product in products]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, name, category, description) VALUES (%s, %s, %s, %s)", rows
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(pk,) for pk in product_ids])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        match = " AND ".join(f'"{token}"*' for token in tokens)
+        product_table = Product._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {SEARCH_TABLE}.rowid FROM {SEARCH_TABLE} "
+                f"JOIN {product_table} ON {product_table}.id = {SEARCH_TABLE}.rowid "
+                f"WHERE {SEARCH_TABLE} MATCH %s AND {product_table}.available "
+                f"ORDER BY bm25({SEARCH_TABLE}, %s, %s, %s), {product_table}.sales DESC "
+                f"LIMIT %s",
+                [match, NAME_WEIGHT, CATEGORY_WEIGHT, DESCRIPTION_WEIGHT, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class PostgresSearchBackend(SearchBackend):
+    """Weighted tsvector per product with a GIN index."""
+
+    def create(self):
+        product_table = Product._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s)", [SEARCH_TABLE])
+            if cursor.fetchone()[0]:
+                return False
+            cursor.execute(
+                f"CREATE TABLE {SEARCH_TABLE} ("
+                f"product_id bigint PRIMARY KEY REFERENCES {product_table} (id) ON DELETE CASCADE, "
+                "document tsvector NOT NULL)"
+            )
+            cursor.execute(f"CREATE INDEX {SEARCH_TABLE}_document_gin ON {SEARCH_TABLE} USING gin (document)")
+        return True
+
+    def index(self, products):
+        rows = [(product.id, *product_document(product)) for product in products]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (%s, "
+                "setweight(to_tsvector('simple', %s), 'A') || "
+                "setweight(to_tsvector('simple', %s), 'B') || "
+                "setweight(to_tsvector('simple', %s), 'C')) "
+                "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document",
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)", [list(product_ids)])
+
+    def clear(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {SEARCH_TABLE}")
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        tsquery = " & ".join(f"{token}:*" for token in tokens)
+        product_table = Product._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT s.product_id FROM {SEARCH_TABLE} s "
+                f"JOIN {product_table} p ON p.id = s.product_id, to_tsquery('simple', %s) q "
+                "WHERE s.document @@ q AND p.available "
+                "ORDER BY ts_rank(s.document, q) DESC, p.sales DESC "
+                "LIMIT %s",
+                [tsquery, limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+def get_backend():
+    if connection.vendor == "sqlite":
+        return SQLiteSearchBackend()
+    if connection.vendor == "postgresql":
+        return PostgresSearchBackend()
+    return SearchBackend()
+
+
+def create_index():
+    """Creates the index table if missing and fills it. Returns True if it was created."""
+    backend = get_backend()
+    try:
+        created = backend.create()
+    except DatabaseError:
+        logger.exception("Full-text search is not available; falling back to icontains.")
+        return False
+    if created:
+        rebuild_index()
+    return created
+
+
+def rebuild_index(batch_size=2000):
+    backend = get_backend()
+    backend.clear()
+    products = Product.objects.select_related('category').only('id', 'name', 'description', 'category__name')
+    batch = []
+    for product in products.iterator(chunk_size=batch_size):
+        batch.append(product)
+        if len(batch) >= batch_size:
+            backend.index(batch)
+            batch = []
+    backend.index(batch)
+
+
+def index_products(products):
+    try:
+        with transaction.atomic():
+            get_backend().index(products)
+    except DatabaseError:
+        logger.exception("Could not update the search index.")
+
+
+def remove_products(product_ids):
+    try:
+        with transaction.atomic():
+            get_backend().remove(product_ids)
+    except DatabaseError:
+        logger.exception("Could not update the search index.")
+
+
+def search_product_ids(query, limit=SEARCH_LIMIT):
+    """Returns the ids of available products matching `query`, best match first."""
+    try:
+        return get_backend().search(query, limit)
+    except DatabaseError:
+        logger.exception("Full-text search failed; falling back to icontains.")
+        return SearchBackend().search(query, limit)
@@ -0,0 +1,114 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from . import autocomplete
+from .cart import flush_user_cart, merge_session_cart
+from .catalog_cache import bump_catalog_version, bump_prices_version
+from .models import Category, Product, ShowBestOffers
+from .search_index import create_index, index_products, remove_products
+
+CATALOG_MODELS = (Category, Product, ShowBestOffers)
+
+
+def catalog_changed(sender, **kwargs):
+    transaction.on_commit(bump_catalog_version)
+
+
+for model in CATALOG_MODELS:
+    post_save.connect(catalog_changed, sender=model, dispatch_uid=f"catalog_save_{model.__name__}")
+    post_delete.connect(catalog_changed, sender=model, dispatch_uid=f"catalog_delete_{model.__name__}")
+
+
+# What the cached price data of the facets is made of (see shop.facets.price_vector).
+PRICE_FIELDS = ('final_price', 'available')
+
+
+def product_prices_checked(sender, instance, update_fields=None, **kwargs):
+    # Product.save() has already computed final_price; compare it with the stored row.
+    if instance._state.adding:
+        instance._prices_changed = True
+    elif update_fields is not None and not set(PRICE_FIELDS) & set(update_fields):
+        instance._prices_changed = False
+    else:
+        stored = Product.objects.filter(pk=instance.pk).values_list(*PRICE_FIELDS).first()
+        instance._prices_changed = stored != tuple(getattr(instance, field) for field in PRICE_FIELDS)
+
+
+def product_prices_saved(sender, instance, **kwargs):
+    if getattr(instance, '_prices_changed', True):
+        transaction.on_commit(bump_prices_version)
+
+
+def product_prices_deleted(sender, instance, **kwargs):
+    transaction.on_commit(bump_prices_version)
+
+
+pre_save.connect(product_prices_checked, sender=Product, dispatch_uid="prices_product_check")
+post_save.connect(product_prices_saved, sender=Product, dispatch_uid="prices_product_save")
+post_delete.connect(product_prices_deleted, sender=Product, dispatch_uid="prices_product_delete")
+
+
+def product_saved(sender, instance, **kwargs):
+    index_products([instance])
+
+
+def product_deleted(sender, instance, **kwargs):
+    remove_products([instance.pk])
+
+
+def category_saved(sender, instance, created, update_fields=None, **kwargs):
+    # Category names are part of every product document; sales updates do not matter.
+    if created or (update_fields is not None and 'name' not in update_fields):
+        return
+    index_products(instance.product.select_related('category'))
+
+
+def create_search_index(sender, **kwargs):
+    create_index()
+
+
+post_save.connect(product_saved, sender=Product, dispatch_uid="search_index_product_save")
+post_delete.connect(product_deleted, sender=Product, dispatch_uid="search_index_product_delete")
+post_save.connect(category_saved, sender=Category, dispatch_uid="search_index_category_save")
+
+
+def autocomplete_product_saved(sender, instance, **kwargs):
+    transaction.on_commit(lambda: autocomplete.product_changed(instance))
+
+
+def autocomplete_product_deleted(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: autocomplete.product_removed(product_id))
+
+
+def autocomplete_category_saved(sender, instance, update_fields=None, **kwargs):
+    # Sales counters are saved as F() expressions on every order; the periodic rebuild picks them up.
+    if update_fields is not None and not {'name', 'slug'} & set(update_fields):
+        return
+    transaction.on_commit(lambda: autocomplete.category_changed(instance))
+
+
+def autocomplete_category_deleted(sender, instance, **kwargs):
+    category_id = instance.pk
+    transaction.on_commit(lambda: autocomplete.category_removed(category_id))
+
+
+post_save.connect(autocomplete_product_saved, sender=Product, dispatch_uid="autocomplete_product_save")
+post_delete.connect(autocomplete_product_deleted, sender=Product, dispatch_uid="autocomplete_product_delete")
+post_save.connect(autocomplete_category_saved, sender=Category, dispatch_uid="autocomplete_category_save")
+post_delete.connect(autocomplete_category_deleted, sender=Category, dispatch_uid="autocomplete_category_delete")
+
+
+def cart_logged_in(sender, request, user, **kwargs):
+    if request is not None:
+        merge_session_cart(request, user)
+
+
+def cart_logged_out(sender, request, user, **kwargs):
+    if request is not None and user is not None:
+        flush_user_cart(request, user)
+
+
+user_logged_in.connect(cart_logged_in, dispatch_uid="cart_logged_in")
+user_logged_out.connect(cart_logged_out, dispatch_uid="cart_logged_out")
@@ -0,0 +1,54 @@
+from django import template
+
+from shop.catalog_cache import CATALOG_VERSION_KEY, SALES_VERSION_KEY, get_or_set
+
+register = template.Library()
+
+
+class CatalogCacheNode(template.Node):
+    def __init__(self, nodelist, vary_on, versions):
+        self.nodelist = nodelist
+        self.vary_on = vary_on
+        self.versions = versions
+
+    def render(self, context):
+        parts = [var.resolve(context) for var in self.vary_on]
+        if not parts or not parts[0]:
+            return self.nodelist.render(context)
+
+        name = ":".join(["fragment", *map(str, parts)])
+        return get_or_set(name, lambda: self.nodelist.render(context), versions=self.versions)
+
+
+def parse_catalog_cache(parser, token, versions):
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag requires at least one argument.")
+
+    nodelist = parser.parse((f'end{bits[0]}',))
+    parser.delete_first_token()
+    return CatalogCacheNode(nodelist, [parser.compile_filter(bit) for bit in bits[1:]], versions)
+
+
+@register.tag
+def catalog_cache(parser, token):
+    """
+    Caches a catalog fragment until the next product/category change:
+
+        {% catalog_cache 'product_card' product.id %} ... {% endcatalog_cache %}
+
+    The first argument names the fragment; an empty name renders without caching.
+    Never wrap per-user content (request.user checks, {% csrf_token %}).
+    """
+    return parse_catalog_cache(parser, token, (CATALOG_VERSION_KEY,))
+
+
+@register.tag
+def ranking_cache(parser, token):
+    """
+    Like catalog_cache, for fragments listed in sales order: they are also dropped
+    after every order.
+
+        {% ranking_cache cache_name %} ... {% endranking_cache %}
+    """
+    return parse_catalog_cache(parser, token, (CATALOG_VERSION_KEY, SALES_VERSION_KEY))
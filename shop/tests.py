@@ -1,4 +1,790 @@
-from django.test import TestCase
+import json
+import re
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from io import BytesIO
+from unittest import skipUnless
+from unittest.mock import patch
 
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from home.tests import clear_caches, create_catalog
+from orders import feed
+from orders.models import Order
+from orders.slips import PyPDF2
+from orders.tasks import create_order
+from .autocomplete import PrefixIndex, invalidate_index
+from .cart import CART_CACHE_ALIAS, CART_LOCK_TIMEOUT, CartBusy, WorkingCart, get_cart
+from .checks import check_cart_cache
+from .catalog_cache import get_stats, reset_stats
+from . import facets, recommendations
+from .facets import Facets
+from .pagination import KeysetPage, OrderQueuePage, PricePage, decode_cursor, decode_order_cursor
+from .recommendations import rebuild_recommendations, top_neighbours
+from .search_index import normalize, search_product_ids
+from .models import MAX_CART_QUANTITY, Cart, CartItem, Category, Product, ProductRecommendation
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        reset_stats()
+        create_catalog(categories=3, products_per_category=4)
+
+    def test_home_is_served_from_cache(self):
+        self.client.get(reverse('home:home'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('home:home'))
+        self.assertContains(response, "Producto 0-0")
+        # The page grid and the navbar categories.
+        self.assertEqual(get_stats()['hits'], 2)
+        self.assertEqual(get_stats()['misses'], 2)
+
+    def test_orders_only_invalidate_what_is_in_sales_order(self):
+        self.client.get(reverse('home:home'))
+        get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        product = Product.objects.get(slug="producto-0-0")
+        with self.captureOnCommitCallbacks(execute=True):
+            create_order("student", [{'product_id': product.id, 'price': "0", 'quantity': 1}], school_address="classroom_01")
+
+        reset_stats()
+        self.client.get(reverse('home:home'))
+        # The ranked grid is rebuilt; the navbar categories are not.
+        self.assertEqual((get_stats()['hits'], get_stats()['misses']), (1, 1))
+
+    def test_product_change_invalidates_pages(self):
+        url = reverse('shop:search_by_category', args=['categoria-0'])
+        self.client.get(url)
+        product = Product.objects.get(slug="producto-0-0")
+        product.name = "Café renombrado"
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+        self.assertContains(self.client.get(url), "Café renombrado")
+
+    def test_category_delete_invalidates_home(self):
+        self.client.get(reverse('home:home'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.get(slug="categoria-2").delete()
+        self.assertNotContains(self.client.get(reverse('home:home')), "Producto 2-0")
+
+    def test_offers_and_best_sellers_are_cached(self):
+        for name in ('home:offers', 'home:best_sellers'):
+            self.client.get(reverse(name))
+            with self.assertNumQueries(0):
+                self.client.get(reverse(name))
+
+
+class NavbarTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=2, products_per_category=2)
+        self.user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.client.force_login(self.user)
+
+    def test_warm_navbar_does_not_query(self):
+        url = reverse('home:customer_service')
+        self.client.get(url)
+        # Session and user loading only; no categories, cart or COUNT queries.
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertContains(response, "Categoría 1")
+
+    def badge(self):
+        response = self.client.get(reverse('home:customer_service'))
+        return int(re.search(r'class="cart-badge">\s*(\d+)', response.content.decode()).group(1))
+
+    def test_cart_badge_follows_cart_actions(self):
+        product = Product.objects.get(slug="producto-0-0")
+        self.assertEqual(self.badge(), 0)
+        self.client.post(reverse('shop:cart_add', args=[product.id]), {'quantity': 2})
+        self.client.post(reverse('shop:cart_add', args=[product.id]), {'quantity': 1})
+        self.assertEqual(self.badge(), 1)
+        self.client.get(reverse('shop:cart_remove', args=[product.id]))
+        self.assertEqual(self.badge(), 0)
+
+
+class SearchIndexTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=2, products_per_category=2)
+        self.coffee = Product.objects.create(
+            category=Category.objects.get(slug="categoria-0"),
+            seller=Product.objects.first().seller,
+            name="Café con leche",
+            slug="cafe-con-leche",
+            description="Bebida caliente",
+            price=2500,
+            image="product_images/test.webp",
+        )
+
+    def test_normalize_folds_accents_and_case(self):
+        self.assertEqual(normalize("Café ÑANDÚ"), "cafe nandu")
+
+    def test_search_is_accent_insensitive(self):
+        self.assertEqual(search_product_ids("cafe"), [self.coffee.id])
+        self.assertEqual(search_product_ids("CAFÉ"), [self.coffee.id])
+
+    def test_search_matches_description_category_and_prefixes(self):
+        self.assertIn(self.coffee.id, search_product_ids("caliente"))
+        self.assertIn(self.coffee.id, search_product_ids("categoria 0"))
+        self.assertEqual(search_product_ids("lec"), [self.coffee.id])
+
+    def test_name_matches_rank_first(self):
+        other = Product.objects.create(
+            category=self.coffee.category,
+            seller=self.coffee.seller,
+            name="Pan",
+            slug="pan",
+            description="Ideal con café",
+            price=1000,
+            sales=100,
+            image="product_images/test.webp",
+        )
+        self.assertEqual(search_product_ids("cafe"), [self.coffee.id, other.id])
+
+    def test_index_follows_product_changes(self):
+        self.coffee.name = "Té frío"
+        self.coffee.description = ""
+        self.coffee.save()
+        self.assertEqual(search_product_ids("cafe"), [])
+        self.assertEqual(search_product_ids("te"), [self.coffee.id])
+        self.coffee.delete()
+        self.assertEqual(search_product_ids("te"), [])
+
+    def test_search_view_returns_ranked_page(self):
+        response = self.client.get(reverse('shop:search'), {'name_product': 'cafe'})
+        self.assertEqual(response.context['page'].products, [self.coffee])
+        self.assertEqual(response.context['page'].next_cursor, "")
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        invalidate_index()
+        self.addCleanup(invalidate_index)
+        create_catalog(categories=2, products_per_category=3)
+        Product.objects.create(
+            category=Category.objects.get(slug="categoria-0"),
+            seller=get_user_model().objects.get(code="seller"),
+            name="Café con leche",
+            slug="cafe-con-leche",
+            price=2500,
+            sales=50,
+            image="product_images/test.webp",
+        )
+
+    def suggest(self, query):
+        response = self.client.get(reverse('shop:autocomplete'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [result['name'] for result in response.json()['results']]
+
+    def test_prefix_index_ranks_by_sales(self):
+        index = PrefixIndex()
+        index.build([
+            (1, "Jugo de mango", 5, {}),
+            (2, "Jugo de mora", 30, {}),
+            (3, "Mantecada", 10, {}),
+        ])
+        self.assertEqual([e['name'] for e in index.search("ju")], ["Jugo de mora", "Jugo de mango"])
+        self.assertEqual([e['name'] for e in index.search("ma")], ["Mantecada", "Jugo de mango"])
+        self.assertEqual([e['name'] for e in index.search("jugo man")], ["Jugo de mango"])
+        index.remove(2)
+        index.add(4, "Jugo de maracuyá", 1)
+        self.assertEqual([e['name'] for e in index.search("jugo mara")], ["Jugo de maracuyá"])
+        self.assertEqual([e['name'] for e in index.search("ju", limit=1)], ["Jugo de mango"])
+
+    def test_suggestions_are_accent_insensitive_and_ranked(self):
+        self.assertEqual(self.suggest("cafe"), ["Café con leche"])
+        self.assertCountEqual(self.suggest("prod")[:2], ["Producto 0-2", "Producto 1-2"])
+        self.assertCountEqual(self.suggest("categ"), ["Categoría 0", "Categoría 1"])
+        self.assertEqual(self.suggest(""), [])
+
+    def test_warm_lookup_does_not_query(self):
+        self.suggest("prod")
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.suggest("producto")), 6)
+
+    def test_index_follows_product_changes(self):
+        self.suggest("cafe")
+        product = Product.objects.get(slug="cafe-con-leche")
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = "Té helado"
+            product.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest("cafe"), [])
+            self.assertEqual(self.suggest("te hel"), ["Té helado"])
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(self.suggest("te"), [])
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=7)
+        # Ties on sales must still page in a total order.
+        Product.objects.filter(name__in=["Producto 0-3", "Producto 0-4"]).update(sales=10)
+        self.expected = list(Product.objects.listing().values_list('name', flat=True))
+
+    def walk(self, per_page):
+        names, cursor = [], ""
+        while True:
+            page = KeysetPage(Product.objects.listing(), cursor, per_page)
+            names += [product.name for product in page.products]
+            cursor = page.next_cursor
+            if not cursor:
+                return names
+
+    def test_pages_cover_the_listing_once_in_order(self):
+        self.assertEqual(self.expected[0], "Producto 0-0")
+        for per_page in (1, 2, 3, 7, 10):
+            self.assertEqual(self.walk(per_page), self.expected)
+
+    def test_malformed_cursor_starts_over(self):
+        self.assertIsNone(decode_cursor("x.1"))
+        page = KeysetPage(Product.objects.listing(), "x.1", 2)
+        self.assertEqual([p.name for p in page.products], self.expected[:2])
+
+    def test_category_page_and_load_more_fragment(self):
+        url = reverse('shop:search_by_category', args=['categoria-0'])
+        with patch('shop.pagination.PAGE_SIZE', 3):
+            response = self.client.get(url)
+            page = response.context['page']
+            self.assertEqual([p.name for p in page.products], self.expected[:3])
+            self.assertContains(response, f'cursor={page.next_cursor}')
+
+            response = self.client.get(url, {'cursor': page.next_cursor, 'partial': '1'})
+        self.assertTemplateUsed(response, 'components/shop/_results_page.html')
+        self.assertTemplateNotUsed(response, 'components/navbar/navbar.html')
+        self.assertContains(response, self.expected[3])
+        self.assertNotContains(response, self.expected[0])
+
+
+class FinalPriceTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=5)
+        self.product = Product.objects.get(name="Producto 0-1")
+
+    def test_final_price_follows_price_fields(self):
+        self.assertEqual(self.product.final_price, Decimal("1001.00"))
+
+        self.product.offer_active = True
+        self.product.discount_percent = 15
+        self.product.save(update_fields=['offer_active', 'discount_percent'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.final_price, Decimal("850.85"))
+
+        self.product.discount_price = Decimal("700")
+        self.product.save()
+        self.assertEqual(Product.objects.get(pk=self.product.pk).final_price, Decimal("700.00"))
+
+        self.product.offer_active = False
+        self.product.save()
+        self.assertEqual(Product.objects.get(pk=self.product.pk).final_price, Decimal("1001.00"))
+
+    def test_refresh_final_prices_matches_python(self):
+        Product.objects.filter(name="Producto 0-2").update(offer_active=True, discount_percent=33)
+        Product.objects.filter(name="Producto 0-3").update(offer_active=True, discount_price=Decimal("500"))
+        Product.objects.filter(name="Producto 0-4").update(price=Decimal("2000"), discount_percent=50)
+        Product.objects.update(final_price=0)
+        Product.objects.refresh_final_prices()
+        for product in Product.objects.all():
+            self.assertEqual(product.final_price, product.calculate_final_price(), product.name)
+
+    def test_cart_total_uses_final_price_in_one_query(self):
+        self.product.offer_active = True
+        self.product.discount_percent = 50
+        self.product.save()
+        cart = Cart.objects.create(user=get_user_model().objects.create_user(code="buyer", first_name="B", last_name="C"))
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        CartItem.objects.create(cart=cart, product=Product.objects.get(name="Producto 0-2"), quantity=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.get_total(), Decimal("1001.00") + Decimal("1002.00"))
+
+    def test_category_sorted_and_filtered_by_price(self):
+        Product.objects.filter(name="Producto 0-4").update(price=Decimal("900"))
+        Product.objects.refresh_final_prices()
+        url = reverse('shop:search_by_category', args=['categoria-0'])
+
+        response = self.client.get(url, {'sort': 'price', 'max_price': '1002'})
+        names = [p.name for p in response.context['page'].products]
+        self.assertEqual(names, ["Producto 0-4", "Producto 0-0", "Producto 0-1", "Producto 0-2"])
+
+        response = self.client.get(url, {'sort': '-price', 'min_price': '1001'})
+        names = [p.name for p in response.context['page'].products]
+        self.assertEqual(names, ["Producto 0-3", "Producto 0-2", "Producto 0-1"])
+
+    def test_price_pages_cover_the_listing(self):
+        Product.objects.filter(name__in=["Producto 0-1", "Producto 0-2"]).update(price=Decimal("1500"))
+        Product.objects.refresh_final_prices()
+        expected = list(Product.objects.listing().by_price(descending=True).values_list('name', flat=True))
+        names, cursor = [], ""
+        while True:
+            page = PricePage(Product.objects.listing(), cursor, per_page=2, descending=True)
+            names += [product.name for product in page.products]
+            cursor = page.next_cursor
+            if not cursor:
+                break
+        self.assertEqual(names, expected)
+
+
+class FacetTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=2, products_per_category=4)
+        # Prices 1000-1003 in both categories; one expensive product.
+        Product.objects.filter(name="Producto 1-3").update(price=Decimal("2500"))
+        Product.objects.refresh_final_prices()
+
+    def test_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            result = Facets(Product.objects.listing(), boundaries=(1002, 2000))
+        self.assertEqual(result.count, 8)
+        self.assertEqual((result.offers, result.no_offers), (2, 6))
+        self.assertEqual([(c['name'], c['count']) for c in result.categories], [("Categoría 0", 4), ("Categoría 1", 4)])
+        self.assertEqual([b['count'] for b in result.prices], [4, 3, 1])
+        self.assertEqual(result.prices[0]['max_price'], Decimal("1001.99"))
+
+    def test_quantile_boundaries_without_numpy(self):
+        prices = [float(p) for p in range(500, 10_500, 100)]
+        with_numpy = facets.quantile_boundaries(prices)
+        with patch.object(facets, 'numpy', None):
+            self.assertEqual(facets.quantile_boundaries(prices), with_numpy)
+        self.assertEqual(with_numpy, (2500, 4500, 6500, 8500))
+
+    def test_price_vector_is_only_rebuilt_when_prices_change(self):
+        product = Product.objects.get(name="Producto 0-0")
+        self.assertEqual(len(facets.price_vector()), 8)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = "Renombrado"
+            product.save()
+        with self.assertNumQueries(0):
+            facets.price_vector()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            product.available = False
+            product.save()
+        self.assertEqual(len(facets.price_vector()), 7)
+
+    def test_cached_facet_links_carry_only_the_filters(self):
+        url = reverse('shop:search_by_category', args=['categoria-1'])
+        self.client.get(url, {'offer': '0', 'utm_source': 'newsletter'})
+        for link in self.client.get(url, {'offer': '0'}).content.decode().split('href="')[1:]:
+            self.assertNotIn('utm_source', link.split('"')[0])
+        result = self.client.get(url, {'offer': '0', 'utm_source': 'x'}).context['facets']
+        self.assertEqual(result.categories[0]['url'], "?offer=0&category=categoria-1")
+
+    def test_get_price_ranges(self):
+        ranges = Category.objects.get(slug="categoria-1").get_price_ranges()
+        self.assertEqual(sum(bucket['count'] for bucket in ranges), 4)
+        self.assertFalse(Category.objects.create(name="Vacía", slug="vacia").get_price_ranges())
+
+    def test_search_filters_and_facet_links(self):
+        url = reverse('shop:search')
+        response = self.client.get(url, {'name_product': 'producto', 'category': 'categoria-1', 'offer': '0'})
+        self.assertEqual(
+            sorted(p.name for p in response.context['page'].products), ["Producto 1-1", "Producto 1-2", "Producto 1-3"]
+        )
+        result = response.context['facets']
+        self.assertEqual(result.count, 3)
+        active = [c for c in result.categories if c['active']]
+        self.assertEqual(active[0]['slug'], 'categoria-1')
+        # Clicking the active category removes it and keeps the other filters.
+        self.assertNotIn('category=', active[0]['url'])
+        self.assertIn('offer=0', active[0]['url'])
+
+    def test_price_bucket_link_selects_the_bucket(self):
+        url = reverse('shop:search_by_category', args=['categoria-1'])
+        response = self.client.get(url)
+        bucket = next(b for b in response.context['facets'].prices if b['count'] and b['max'] is not None)
+        response = self.client.get(url + bucket['url'])
+        self.assertEqual(len(response.context['page'].products), bucket['count'])
+        self.assertTrue(next(b for b in response.context['facets'].prices if b['min'] == bucket['min'])['active'])
+
+
+class RecommendationTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=2, products_per_category=4)
+        self.buyer = get_user_model().objects.create_user(code="buyer", first_name="Luis", last_name="Pérez")
+        self.products = {p.name: p for p in Product.objects.all()}
+
+    def order(self, *names):
+        from orders.tasks import create_order
+        items = [{'product_id': self.products[name].id, 'price': "1000", 'quantity': 1} for name in names]
+        with self.captureOnCommitCallbacks(execute=True):
+            create_order("buyer", items, school_address="11A")
+
+    def test_numpy_and_python_agree(self):
+        pairs = [(1, 10), (1, 11), (1, 12), (2, 10), (2, 11), (3, 11), (3, 12), (4, 13), (4, 10), (4, 10)]
+        with_numpy = top_neighbours(pairs, k=2)
+        with patch.object(recommendations, 'numpy', None):
+            without_numpy = top_neighbours(pairs, k=2)
+        self.assertEqual(with_numpy.keys(), without_numpy.keys())
+        for product_id, neighbours in with_numpy.items():
+            self.assertEqual([n for n, _ in neighbours], [n for n, _ in without_numpy[product_id]])
+            for (_, a), (_, b) in zip(neighbours, without_numpy[product_id]):
+                self.assertAlmostEqual(a, b)
+        self.assertEqual([n for n, _ in with_numpy[10]], [11, 13])
+
+    def test_order_refreshes_its_products(self):
+        self.order("Producto 0-0", "Producto 1-1")
+        self.order("Producto 0-0", "Producto 1-2")
+        self.order("Producto 0-0", "Producto 1-2")
+        recommended = ProductRecommendation.objects.filter(product=self.products["Producto 0-0"]).order_by('rank')
+        self.assertEqual([r.recommended.name for r in recommended], ["Producto 1-2", "Producto 1-1"])
+
+    def test_rebuild_matches_incremental_refresh(self):
+        self.order("Producto 0-0", "Producto 1-1", "Producto 0-3")
+        self.order("Producto 0-0", "Producto 1-2")
+        # Products of the last order are exact; the others may drift until the rebuild.
+        last_order = [self.products["Producto 0-0"].id, self.products["Producto 1-2"].id]
+        rows = ProductRecommendation.objects.filter(product_id__in=last_order)
+        incremental = set(rows.values_list('product_id', 'recommended_id', 'rank'))
+        self.assertEqual(rebuild_recommendations(), 4)
+        rebuilt = set(rows.values_list('product_id', 'recommended_id', 'rank'))
+        self.assertEqual(incremental, rebuilt)
+
+    def test_product_detail_shows_co_purchases_then_category(self):
+        self.order("Producto 0-1", "Producto 1-3")
+        product = self.products["Producto 0-1"]
+        response = self.client.get(reverse('shop:product_detail', args=[product.id, product.slug]))
+        related = [p.name for p in response.context['related_products']]
+        # The co-purchase from another category first, then the category's best sellers.
+        self.assertEqual(related, ["Producto 1-3", "Producto 0-0", "Producto 0-3", "Producto 0-2"])
+
+
+def cart_request(user=None, session=None):
+    request = RequestFactory().get('/')
+    request.user = user or AnonymousUser()
+    request.session = session if session is not None else SessionStore()
+    return request
+
+
+class WorkingCartTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=2)
+        self.user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.product = Product.objects.get(slug="producto-0-0")
+        self.other = Product.objects.get(slug="producto-0-1")
+
+    def test_clicks_do_not_write_until_the_sync_interval(self):
+        cart = WorkingCart(cart_request(self.user))
+        self.assertEqual(len(cart), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(cart.add(self.product, 3), 3)
+            self.assertEqual(cart.add(self.product, 2), 5)
+            self.assertEqual(cart.update(self.product.id, 7), 7)
+            cart.add(self.other, 1)
+            self.assertTrue(cart.remove(self.other.id))
+        self.assertFalse(CartItem.objects.exists())
+
+        # A later request sees the clicks from the cache.
+        self.assertEqual(WorkingCart(cart_request(self.user)).items, {self.product.id: 7})
+
+        cart.flush()
+        self.assertEqual(list(CartItem.objects.values_list('product_id', 'quantity')), [(self.product.id, 7)])
+
+    def test_lock_is_only_released_by_its_holder(self):
+        cart = WorkingCart(cart_request(self.user))
+        lock = f"{cart.key}:lock"
+        with cart.locked():
+            self.assertIsNotNone(cart.cache.get(lock))
+            # It expired and another request took it.
+            cart.cache.set(lock, "other", CART_LOCK_TIMEOUT)
+        self.assertEqual(cart.cache.get(lock), "other")
+
+        # Without the lock nothing is written.
+        with patch('shop.cart.CART_LOCK_TIMEOUT', 0), self.assertRaises(CartBusy):
+            cart.add(self.product, 1)
+        self.assertEqual(cart.cache.get(lock), "other")
+        self.assertEqual(WorkingCart(cart_request(self.user)).items, {})
+
+    def test_busy_cart_asks_to_retry(self):
+        cart = WorkingCart(cart_request(self.user))
+        cart.add(self.product, 1)
+        self.client.force_login(self.user)
+        cart.cache.set(f"{cart.key}:lock", "other", CART_LOCK_TIMEOUT)
+        with patch('shop.cart.CART_LOCK_TIMEOUT', 0):
+            response = self.client.post(
+                reverse('shop:cart_update_many'), json.dumps({self.product.id: 3}), content_type='application/json',
+            )
+            self.assertEqual(response.status_code, 409)
+            response = self.client.post(reverse('shop:cart_add', args=[self.other.id]), {'quantity': 1})
+            self.assertRedirects(response, self.other.get_absolute_url(), fetch_redirect_response=False)
+        self.assertEqual(WorkingCart(cart_request(self.user)).items, {self.product.id: 1})
+
+    def test_deploy_check_needs_a_shared_cart_cache(self):
+        self.assertEqual([error.id for error in check_cart_cache(None)], ['shop.E002'])
+        redis = {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://localhost:6379/1'}
+        with override_settings(CACHES={**settings.CACHES, CART_CACHE_ALIAS: redis}):
+            self.assertEqual(check_cart_cache(None), [])
+
+    @override_settings(CART_SYNC_INTERVAL=0)
+    def test_write_behind_after_the_interval(self):
+        cart = WorkingCart(cart_request(self.user))
+        cart.add(self.product, 2)
+        cart.add(self.other, 1)
+        self.assertEqual(CartItem.objects.count(), 2)
+        # Only the changes are written.
+        with self.assertNumQueries(4):
+            cart.remove(self.other.id)
+        self.assertEqual(list(CartItem.objects.values_list('product_id', 'quantity')), [(self.product.id, 2)])
+
+    def test_quantity_is_capped(self):
+        cart = WorkingCart(cart_request(self.user))
+        cart.add(self.product, 15)
+        self.assertEqual(cart.add(self.product, 15), MAX_CART_QUANTITY)
+        self.assertEqual(cart.update(self.product.id, 99), MAX_CART_QUANTITY)
+        self.assertIsNone(cart.update(self.other.id, 1))
+
+    def test_cache_miss_reloads_the_persisted_cart(self):
+        cart = WorkingCart(cart_request(self.user))
+        cart.add(self.product, 4)
+        cart.flush()
+        clear_caches()
+        self.assertEqual(WorkingCart(cart_request(self.user)).items, {self.product.id: 4})
+
+    def test_anonymous_cart_merges_at_login(self):
+        Cart.objects.create(user=self.user).cart_items.create(product=self.product, quantity=18)
+        self.client.post(reverse('shop:cart_add', args=[self.product.id]), {'quantity': 5})
+        self.client.post(reverse('shop:cart_add', args=[self.other.id]), {'quantity': 2})
+        self.assertFalse(CartItem.objects.filter(product=self.other).exists())
+        response = self.client.get(reverse('shop:cart_detail'))
+        self.assertEqual([item.quantity for item in response.context['items']], [5, 2])
+
+        self.client.force_login(self.user)
+        self.assertEqual(
+            dict(CartItem.objects.values_list('product_id', 'quantity')),
+            {self.product.id: MAX_CART_QUANTITY, self.other.id: 2},
+        )
+        self.assertNotIn(settings.CART_SESSION_ID, self.client.session)
+
+    def test_logout_persists_the_cart(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('shop:cart_add', args=[self.product.id]), {'quantity': 3})
+        self.assertFalse(CartItem.objects.exists())
+        self.client.logout()
+        self.assertEqual(CartItem.objects.get().quantity, 3)
+
+    def test_batch_update_returns_the_summary(self):
+        self.client.force_login(self.user)
+        cart = WorkingCart(cart_request(self.user))
+        cart.add(self.product, 1)
+        cart.add(self.other, 1)
+        url = reverse('shop:cart_update_many')
+        changes = {self.product.id: 4, self.other.id: 0, 999: 3}
+        # Session, user and the products of the summary; no writes.
+        with self.assertNumQueries(3):
+            response = self.client.post(url, json.dumps(changes), content_type='application/json')
+        data = response.json()
+        self.assertEqual(data['item_count'], 4)
+        self.assertEqual(Decimal(data['subtotal']), 4 * self.product.final_price)
+        self.assertEqual(list(data['lines']), [str(self.product.id)])
+        self.assertEqual(WorkingCart(cart_request(self.user)).items, {self.product.id: 4})
+
+        for body in ('[1, 2]', '{"x": 1}', '{"1": -1}', '{}', '{"1": Infinity}', '{"1": 2.5}', '{"1": true}', '{"1": "3"}'):
+            response = self.client.post(url, body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_cart_is_built_once_per_request(self):
+        request = cart_request(self.user)
+        self.assertIs(get_cart(request), get_cart(request))
+
+
+class CartConcurrencyTests(TransactionTestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=1)
+        self.user = get_user_model().objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.product = Product.objects.get()
+
+    def hammer(self, threads, adds, quantity=1):
+        errors = []
+        start = threading.Barrier(threads)
+
+        def worker():
+            try:
+                start.wait()
+                for _ in range(adds):
+                    # A new cart per click, like separate requests from several tabs.
+                    WorkingCart(cart_request(self.user)).add(self.product, quantity)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+        cart = WorkingCart(cart_request(self.user))
+        cart.flush()
+        self.assertEqual(CartItem.objects.get().quantity, cart.items[self.product.id])
+        return cart.items[self.product.id]
+
+    def test_concurrent_adds_are_not_lost(self):
+        self.assertEqual(self.hammer(threads=4, adds=4), 16)
+
+    @override_settings(CART_SYNC_INTERVAL=0)
+    def test_concurrent_adds_with_write_behind(self):
+        self.assertEqual(self.hammer(threads=4, adds=4), 16)
+
+    def test_concurrent_adds_respect_the_cap(self):
+        self.assertEqual(self.hammer(threads=8, adds=10, quantity=2), MAX_CART_QUANTITY)
+
+
+class PendingOrderQueueTests(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        create_catalog(categories=1, products_per_category=2)
+        User = get_user_model()
+        self.seller = User.objects.get(code="seller")
+        other_seller = User.objects.create_user(code="seller2", first_name="Eva", last_name="Ruiz", is_seller=True)
+        self.mine = Product.objects.order_by('id').first()
+        self.theirs = Product.objects.create(
+            category=self.mine.category, seller=other_seller, name="Otro", slug="otro", price=500,
+            image="product_images/test.webp",
+        )
+        User.objects.create_user(code="student", first_name="Luis", last_name="Pérez")
+        self.client.force_login(self.seller)
+        feed.changes.clear()
+
+    def place(self, product, school_address="classroom_01", user="student"):
+        return create_order(user, [{'product_id': product.id, 'price': "0", 'quantity': 1}], school_address=school_address)
+
+    def follow(self, cursor, **params):
+        return self.client.get(reverse('shop:pending_orders_feed'), {'since_ts': cursor, **params}).json()
+
+    def test_feed_sends_new_and_changed_orders_from_memory(self):
+        cursor = self.client.get(reverse('shop:pending_orders')).context['feed_cursor']
+        with CaptureQueriesContext(connection) as idle:
+            self.assertEqual(self.follow(cursor)['orders'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            mine, theirs = self.place(self.mine, "classroom_02"), self.place(self.theirs)
+        with CaptureQueriesContext(connection) as queries:
+            news = self.follow(cursor)
+        # Only the session and user lookups, as with no news.
+        self.assertEqual(len(queries), len(idle))
+        self.assertEqual([order['id'] for order in news['orders']], [mine.id, theirs.id])
+        self.assertEqual(news['orders'][0]['items'], [{'name': self.mine.name, 'quantity': 1}])
+        self.assertEqual(news['since_id'], theirs.id)
+        self.assertEqual([order['id'] for order in self.follow(cursor, mine="1")['orders']], [mine.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Order.objects.get(id=mine.id).delete()
+            theirs.status = 'completed'
+            theirs.save(update_fields=['status'])
+        changed = self.follow(news['since_ts'], mine="1")['orders']
+        self.assertEqual([(order['id'], order['status']) for order in changed], [(mine.id, 'deleted'), (theirs.id, 'completed')])
+
+    def test_feed_falls_back_to_new_orders_by_id(self):
+        first = self.place(self.mine)
+        second = self.place(self.theirs)
+        news = self.follow("0", since_id=first.id)
+        self.assertTrue(news['partial'])
+        self.assertEqual([order['id'] for order in news['orders']], [second.id])
+        self.assertEqual(self.client.get(reverse('shop:pending_orders_feed'), {'since_ts': "x"}).status_code, 400)
+
+    def test_feed_sends_orders_created_by_other_processes(self):
+        cursor = self.client.get(reverse('shop:pending_orders')).context['feed_cursor']
+        # Committed without its on-commit hooks: this process' buffer never hears of it.
+        elsewhere = self.place(self.theirs)
+        news = self.follow(cursor)
+        self.assertFalse(news['partial'])
+        self.assertEqual([order['id'] for order in news['orders']], [elsewhere.id])
+        self.assertEqual(self.follow(cursor, since_id=news['since_id'])['orders'], [])
+
+    @override_settings(ORDER_FEED_LONG_POLLS=0)
+    def test_feed_without_a_free_slot_answers_at_once(self):
+        started = time.monotonic()
+        news = self.follow(feed.changes.cursor, wait="5")
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual((news['orders'], news['retry']), ([], feed.POLL_RETRY))
+
+    def queue_ids(self, **params):
+        return [order.id for order in self.client.get(reverse('shop:pending_orders'), params).context['orders']]
+
+    def test_pages_cover_the_queue_oldest_first(self):
+        orders = [self.place(self.mine) for _ in range(7)]
+        # Same timestamp for some of them: the id breaks the tie.
+        Order.objects.filter(id__in=[o.id for o in orders[2:5]]).update(created=orders[2].created)
+        Order.objects.filter(id=orders[6].id).update(status='completed')
+
+        seen, cursor = [], None
+        while True:
+            page = OrderQueuePage(Order.objects.pending_queue(), cursor, per_page=2)
+            seen += [order.id for order in page.orders]
+            cursor = page.next_cursor
+            if not cursor:
+                break
+        self.assertEqual(seen, [o.id for o in orders[:6]])
+        self.assertIsNone(decode_order_cursor("not.a-cursor"))
+
+    def test_filters(self):
+        mine_there = self.place(self.mine, "classroom_02")
+        theirs_here = self.place(self.theirs)
+        self.place(self.mine, user="seller")
+        self.assertEqual(self.queue_ids(), [mine_there.id, theirs_here.id])
+        self.assertEqual(self.queue_ids(school_address="classroom_02"), [mine_there.id])
+        self.assertEqual(self.queue_ids(mine="1"), [mine_there.id])
+        self.assertEqual(self.queue_ids(school_address="nowhere"), [mine_there.id, theirs_here.id])
+
+    def test_queries_do_not_grow_with_the_page(self):
+        def count():
+            self.client.get(reverse('shop:pending_orders'))
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(reverse('shop:pending_orders'))
+            return len(queries)
+
+        self.place(self.mine)
+        one = count()
+        for _ in range(5):
+            self.place(self.theirs)
+        self.assertEqual(count(), one)
+
+    def test_queue_is_read_from_the_status_index(self):
+        plan = Order.objects.pending_queue().exclude(user_id="seller")[:50].explain()
+        self.assertIn("order_status_created_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_slips_without_pending_orders_go_back_to_the_queue(self):
+        self.place(self.mine, "classroom_02")
+        response = self.client.get(reverse('shop:pending_orders_slips'), {'school_address': "classroom_01"})
+        self.assertRedirects(response, f"{reverse('shop:pending_orders')}?school_address=classroom_01")
+
+    @skipUnless(PyPDF2, "PyPDF2 is not installed")
+    def test_slips_pdf_has_a_page_per_filtered_order(self):
+        self.place(self.mine)
+        self.place(self.theirs)
+        self.place(self.theirs, "classroom_02")
+        with tempfile.TemporaryDirectory() as directory, override_settings(QR_CACHE_DIR=directory):
+            response = self.client.get(reverse('shop:pending_orders_slips'), {'school_address': "classroom_01"})
+            pdf = b"".join(response.streaming_content)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(len(PyPDF2.PdfReader(BytesIO(pdf)).pages), 2)
@@ -14,6 +14,8 @@ urlpatterns = [
 
     #Órdene
     path('ordenes-pendientes/', views.pending_orders_view, name='pending_orders'),
+    path('ordenes-pendientes/novedades/', views.pending_orders_feed_view, name='pending_orders_feed'),
+    path('ordenes-pendientes/imprimir/', views.pending_orders_slips_view, name='pending_orders_slips'),
     path('orden/<int:order_id>/', views.order_detail_view, name='order_detail'),
     path('orden/<int:order_id>/completada/', views.mark_order_completed_view, name='mark_order_completed'),
 
@@ -22,9 +24,11 @@ urlpatterns = [
     path('carrito/agregar/<int:product_id>/', views.cart_add_view, name='cart_add'),
     path('carrito/eliminar/<int:product_id>/', views.cart_remove_view, name='cart_remove'),
     path('carrito/actualizar/<int:product_id>/', views.cart_update, name='cart_update'),
+    path('carrito/actualizar/', views.cart_update_many, name='cart_update_many'),
 
     #Búsqueda
     path('buscar/', views.search_view, name='search'),
+    path('buscar/sugerencias/', views.autocomplete_view, name='autocomplete'),
     path('buscar/categoria/<str:category>/', views.search_by_category_view, name='search_by_category'),
 
     #Vendedor
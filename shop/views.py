@@ -1,3 +1,4 @@
+import json
 from datetime import timedelta
 
 from django.conf import settings
@@ -6,14 +7,25 @@ from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
 from django.db.models import F, Sum, ExpressionWrapper, DecimalField
 from django.db.models.functions import ExtractMonth
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
+from django.utils.functional import SimpleLazyObject
 from django.utils.timezone import now
 from django.views.decorators.http import require_POST
 
 from .decorators import seller_required
-from .models import Category, Product, Cart, CartItem
+from blocks.decorators import BlocksView
+from .models import MAX_CART_QUANTITY, Category, Product
+from .cart import MAX_CART_BATCH, CartBusy, get_cart, get_cart_summary
+from .search_index import search_product_ids
+from .pagination import ORDER_PAGE_SIZE, OrderQueuePage, RankedPage, listing_page, page_query, render_results
+from .facets import Facets, apply_filters, has_filters, parse_filters
+from .autocomplete import suggestions
+from .recommendations import related_products
 from .forms import SubmitProductForm, CartAddProductForm, CartUpdateProductForm, CreditRechargeForm
+from orders import feed as order_feed
+from orders.slips import MAX_SLIPS, pending_slips, slips_pdf
 from orders.models import Order, OrderItem
 
 User = settings.AUTH_USER_MODEL
@@ -21,25 +33,20 @@ User = settings.AUTH_USER_MODEL
 
 def product_detail(request, id, slug, error=None):
     """
-    Displays the details of a product along with related products.
+    Displays the details of a product along with the products most often
+    bought with it.
     If the user is not the seller, shows the form to add to cart.
     """
     product = get_object_or_404(Product, id=id, slug=slug, available=True)
 
-    related_products_qs = (
-        Product.objects.filter(category=product.category, available=True)
-        .exclude(id=product.id)
-        .order_by('-offer_active', '-sales')
-    )
-
-    related_products = list(related_products_qs[:20]) if related_products_qs.count() > 10 else list(related_products_qs[:10])
+    related = related_products([product.id], [product.category_id])
 
     context = {
         'product': product,
         'product_id': product.id,
         'seller_user': product.get_name_seller,
-        'related_products': related_products,
-        'quantity_range': range(1, 21),
+        'related_products': related,
+        'quantity_range': range(1, MAX_CART_QUANTITY + 1),
     }
 
     if error:
@@ -53,51 +60,75 @@ def product_detail(request, id, slug, error=None):
 
 def search_view(request):
     """
-    Allows searching for products by name and groups results by category.
+    Searches products by name, description and category through the full-text
+    index (accent and case insensitive). Results keep their rank order, can be
+    narrowed with the facet filters and are paginated; only the products of the
+    requested page are loaded.
     """
     context = {'products': []}
 
     if 'name_product' in request.GET:
         name_product = request.GET.get('name_product')
-        search_results = Product.objects.filter(name__icontains=name_product, available=True).order_by('-offer_active', '-sales')
-
-        category_dict = {}
-        for product in search_results:
-            category_name = product.category.name
-            category_dict.setdefault(category_name, []).append(product)
+        filters = parse_filters(request)
+        product_ids = search_product_ids(name_product)
+        matches = apply_filters(Product.objects.filter(id__in=product_ids), filters)
+        if has_filters(filters):
+            allowed = set(matches.values_list('id', flat=True))
+            product_ids = [pk for pk in product_ids if pk in allowed]
+
+        page = RankedPage(
+            Product.objects.select_related('category', 'seller'),
+            product_ids,
+            request.GET.get('cursor'),
+        )
 
         context = {
-            'search_results': search_results,
-            'categories': category_dict,
+            'page': page,
+            'filters': filters,
+            # The search term is part of the result set, so the facet links keep it.
+            'facets': SimpleLazyObject(lambda: Facets(matches, request, keep=('name_product',))),
+            'show_category_facet': True,
+            'show_offer_facet': True,
+            'ranked': True,
+            'page_query': page_query(request),
         }
 
-    return render(request, 'pages/shop/search/search.html', context)
+    return render_results(request, 'pages/shop/search/search.html', context)
+
+
+def autocomplete_view(request):
+    """
+    Returns name suggestions for the search box as JSON, best sellers first.
+    Served from the in-process prefix index, so it does not touch the database.
+    """
+    query = request.GET.get('q', '')[:100]
+    return JsonResponse({'results': suggestions(query)})
 
 
 def search_by_category_view(request, category=None):
     """
-    Shows products filtered by a specific category.
+    Shows the products of a category, one keyset page at a time,
+    optionally sorted or filtered by final price.
     Redirects if no category is provided.
     """
     if not category:
         return redirect('shop:search')
 
     category_obj = get_object_or_404(Category, slug=category)
-    search_results = Product.objects.filter(category=category_obj, available=True).order_by('-offer_active', '-sales')
-
-    category_dict = {}
-    if search_results.exists():
-        category_dict[category_obj.name] = list(search_results)
+    page, filters = listing_page(request, Product.objects.listing().filter(category=category_obj))
 
     context = {
-        'search_results': search_results,
-        'categories': category_dict,
+        'category': category_obj,
+        'page': page,
+        'filters': filters,
+        'facets': SimpleLazyObject(lambda: Facets(page.queryset, request)),
+        'show_offer_facet': True,
+        'facets_cache_name': f'facets:category:{category_obj.slug}:{page.variant}',
+        'page_query': page_query(request),
+        'cache_name': f'category:{category_obj.slug}:{page.cache_key}',
     }
 
-    if not search_results.exists():
-        context['errors'] = 'No hay productos en esta categoría.'
-
-    return render(request, 'pages/shop/search/search_by_category.html', context)
+    return render_results(request, 'pages/shop/search/search_by_category.html', context)
 
 
 @login_required
@@ -147,16 +178,28 @@ def edit_product_view(request, product_id):
     return render(request, 'pages/shop/sell/edit_product.html', {'form': form, 'product': product})
 
 
+# Another tab of the same student holds the cart lock; nothing was changed.
+CART_BUSY_MESSAGE = 'El carrito se está actualizando en otra pestaña; intenta de nuevo.'
+
+
+def cart_busy_response():
+    """409 for the AJAX cart views: the change was not applied and can be retried."""
+    return JsonResponse({
+        'success': False,
+        'message': CART_BUSY_MESSAGE
+    }, status=409)
+
+
 @require_POST
-@login_required
+@BlocksView
 def cart_add_view(request, product_id):
     """
-    Adds a product to the authenticated user's cart.
+    Adds a product to the cart; anonymous visitors get a session cart.
     Does not allow adding your own products.
     """
     product = get_object_or_404(Product, id=product_id, available=True)
 
-    if product.seller == request.user:
+    if product.seller_id == request.user.pk:
         messages.error(request, 'No puedes agregar tu propio producto al carrito.')
         return redirect('shop:product_detail', id=product.id, slug=product.slug)
 
@@ -164,94 +207,76 @@ def cart_add_view(request, product_id):
     if not form.is_valid():
         return redirect('shop:product_detail', id=product.id, slug=product.slug)
 
-    quantity = form.cleaned_data['quantity']
-
-    cart, _ = Cart.objects.get_or_create(user=request.user)
-    cart_item, created = CartItem.objects.get_or_create(cart=cart, product=product, defaults={'quantity': quantity})
-
-    if not created:
-        cart_item.quantity += quantity
-        cart_item.save()
+    try:
+        get_cart(request).add(product, form.cleaned_data['quantity'])
+    except CartBusy:
+        messages.error(request, CART_BUSY_MESSAGE)
+        return redirect('shop:product_detail', id=product.id, slug=product.slug)
 
     return redirect('shop:cart_detail')
 
 
-@login_required
 def cart_remove_view(request, product_id):
     """
-    Removes a product from the authenticated user's cart.
+    Removes a product from the cart.
     """
-    product = get_object_or_404(Product, id=product_id)
-
     try:
-        cart = Cart.objects.get(user=request.user)
-        CartItem.objects.filter(cart=cart, product=product).delete()
-    except Cart.DoesNotExist:
-        pass
+        get_cart(request).remove(product_id)
+    except CartBusy:
+        messages.error(request, CART_BUSY_MESSAGE)
 
     return redirect('shop:cart_detail')
 
 
-@login_required
 def cart_detail_view(request):
     """
     Displays the cart details, related products, and allows updating quantities.
     """
-    cart, _ = Cart.objects.get_or_create(user=request.user)
-    items = cart.cart_items.select_related('product').all()
+    summary = get_cart_summary(request)
+    items = summary.lines
     update_amount_items = {}
 
     for item in items:
         form = CartUpdateProductForm(initial={'quantity': item.quantity})
         update_amount_items[item.product.id] = form
 
-    product_ids_in_cart = items.values_list('product_id', flat=True)
-    category_ids = Product.objects.filter(id__in=product_ids_in_cart).values_list('category_id', flat=True)
-
-    related_products = Product.objects.filter(
-        category_id__in=category_ids,
-        available=True
-    ).exclude(
-        id__in=product_ids_in_cart
-    ).exclude(
-        seller=request.user if getattr(request.user, 'is_seller', False) else None
-    )[:20]
-
-    has_unavailable = any(not item.product.available for item in items)
+    related = related_products(
+        [item.product_id for item in items],
+        {item.product.category_id for item in items},
+        exclude_seller=request.user if getattr(request.user, 'is_seller', False) else None,
+    )
 
     return render(
         request,
         'pages/shop/cart/cart_detail.html',
         {
-            'cart': cart,
+            'summary': summary,
             'items': items,
-            'related_products': related_products,
+            'related_products': related,
             'update_amount_items': update_amount_items,
-            'has_unavailable': has_unavailable,
+            'has_unavailable': summary.has_unavailable,
         }
     )
 
 
-@login_required
 @require_POST
 def cart_update(request, product_id):
     """
     Updates the quantity of a product in the cart via AJAX request.
     """
-    cart = get_object_or_404(Cart, user=request.user)
-    product = get_object_or_404(Product, id=product_id, available=True)
-    item = get_object_or_404(CartItem, cart=cart, product=product)
-
     form = CartUpdateProductForm(request.POST)
     if form.is_valid():
-        quantity = form.cleaned_data['update']
-        item.quantity = quantity
-        item.save()
+        try:
+            quantity = get_cart(request).update(product_id, form.cleaned_data['update'])
+        except CartBusy:
+            return cart_busy_response()
+        if quantity is None:
+            raise Http404("El producto no está en el carrito.")
 
         return JsonResponse({
             'success': True,
             'message': 'Cantidad actualizada correctamente.',
-            'quantity': item.quantity
+            'quantity': quantity
         })
 
     return JsonResponse({
@@ -260,6 +285,40 @@ def cart_update(request, product_id):
     }, status=400)
 
 
+@require_POST
+def cart_update_many(request):
+    """
+    Applies several quantity changes sent as a JSON object {product_id: quantity}
+    in one cart write; 0 removes the product. Returns the recomputed cart summary,
+    so the cart page can batch the changes a student makes in a row.
+    """
+    try:
+        changes = json.loads(request.body)
+        # Only JSON integers: int() would accept 2.5, true or "3", and fail on Infinity.
+        if not all(type(quantity) is int for quantity in changes.values()):
+            raise ValueError
+        quantities = {int(product_id): quantity for product_id, quantity in changes.items()}
+    except (ValueError, TypeError, AttributeError):
+        quantities = None
+
+    if not quantities or len(quantities) > MAX_CART_BATCH or min(quantities.values()) < 0:
+        return JsonResponse({
+            'success': False,
+            'message': 'Formato inválido.'
+        }, status=400)
+
+    try:
+        get_cart(request).update_many(quantities)
+    except CartBusy:
+        return cart_busy_response()
+
+    return JsonResponse({
+        'success': True,
+        'message': 'Carrito actualizado correctamente.',
+        **get_cart_summary(request).as_json(),
+    })
+
+
 @seller_required
 @login_required
 def list_my_products(request):
@@ -348,10 +407,108 @@ def seller_recharge_credit(request):
 @login_required
 def pending_orders_view(request):
     """
-    Shows pending orders that do not belong to the authenticated seller.
+    Shows the queue of pending orders that do not belong to the authenticated seller,
+    oldest first and a page at a time. ?school_address= narrows it to one place and
+    ?mine=1 to the orders that contain the seller's products.
     """
-    orders = Order.objects.filter(status='pending').exclude(user=request.user)
-    return render(request, 'pages/shop/sell/pending_orders.html', {'orders': orders})
+    # Taken before the query, so a change committed meanwhile is sent again rather than missed.
+    feed_cursor = order_feed.changes.cursor
+    orders, school_address, mine = pending_queue(request)
+    page = OrderQueuePage(
+        orders.select_related('user').prefetch_related('items__product'),
+        request.GET.get('cursor'),
+    )
+    context = {
+        'page': page,
+        'orders': page.orders,
+        'school_address': school_address,
+        'school_address_choices': Order._meta.get_field('school_address').choices,
+        'mine': mine,
+        'page_query': page_query(request),
+        'feed_cursor': repr(feed_cursor),
+        'feed_since_id': max((order.id for order in page.orders), default=0),
+    }
+    return render(request, 'pages/shop/sell/pending_orders.html', context)
+
+
+def pending_queue(request):
+    """The seller's pending queue with the ?school_address= and ?mine=1 filters applied."""
+    orders = Order.objects.pending_queue().exclude(user=request.user)
+
+    school_address = request.GET.get('school_address', '')
+    if school_address in dict(Order._meta.get_field('school_address').choices):
+        orders = orders.filter(school_address=school_address)
+    else:
+        school_address = ''
+
+    mine = request.GET.get('mine') == '1'
+    if mine:
+        orders = orders.containing_products_of(request.user)
+    return orders, school_address, mine
+
+
+@seller_required
+@login_required
+def pending_orders_feed_view(request):
+    """
+    Orders that entered or left the seller's queue after ?since_ts=, waiting up to
+    ?wait= seconds for one (long-poll). Changes made in this process come from the
+    in-process change buffer; the orders newer than ?since_id= that it does not
+    have, created by other processes, are loaded with one query. `partial` is set
+    when the buffer no longer reaches back to the cursor, so only the new orders
+    are known. When this process already holds its ORDER_FEED_LONG_POLLS, the
+    answer comes at once with `retry`, the seconds to wait before polling again.
+    """
+    try:
+        since_ts = float(request.GET['since_ts'])
+        since_id = int(request.GET.get('since_id') or 0)
+        wait = min(max(float(request.GET.get('wait') or 0), 0), order_feed.MAX_WAIT)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': "Cursor inválido."}, status=400)
+
+    with order_feed.long_poll_slot() as slot:
+        payloads, cursor = order_feed.changes.since(since_ts, wait if slot else 0)
+    orders, school_address, mine = pending_queue(request)
+    partial = payloads is None
+    if partial:
+        payloads = []
+    else:
+        payloads = [
+            payload for payload in payloads
+            if order_feed.visible_to(payload, request.user, school_address, mine)
+        ]
+    buffered = {payload['id'] for payload in payloads}
+    new_orders = orders.filter(id__gt=since_id).exclude(id__in=buffered)[:ORDER_PAGE_SIZE]
+    payloads += order_feed.load_payloads(new_orders)
+
+    return JsonResponse({
+        'orders': payloads,
+        'since_ts': repr(cursor),
+        'since_id': max([since_id, *(payload['id'] for payload in payloads)]),
+        'partial': partial,
+        'retry': 0 if slot or not wait else order_feed.POLL_RETRY,
+    })
+
+
+@seller_required
+@login_required
+def pending_orders_slips_view(request):
+    """
+    One printable PDF with the pickup slip (QR and items) of every order in the
+    seller's pending queue, with the same ?school_address= and ?mine=1 filters.
+    Drawn in this process, up to MAX_SLIPS; print_order_slips uses a process pool.
+    """
+    orders, school_address, mine = pending_queue(request)
+    count = orders.count()
+    if not count:
+        messages.info(request, "No hay órdenes pendientes para imprimir.")
+        return redirect(f"{reverse('shop:pending_orders')}?{request.GET.urlencode()}")
+    if count > MAX_SLIPS:
+        messages.warning(request, f"Solo se imprimieron las primeras {MAX_SLIPS} de {count} órdenes; filtra por salón para el resto.")
+
+    output, _ = slips_pdf(pending_slips(orders))
+    filename = f"ordenes-pendientes-{school_address or 'todas'}.pdf"
+    return FileResponse(output, content_type='application/pdf', filename=filename)
 
 
 @seller_required
@@ -111,6 +111,10 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
         verbose_name = _("Usuario")
         verbose_name_plural = _("Usuarios")
         ordering = ["code"]
+        constraints = [
+            # Checkout debits with a conditional UPDATE; this is the last line of defense.
+            models.CheckConstraint(condition=models.Q(credit__gte=0), name="credit_not_negative"),
+        ]
 
     def __str__(self):
         return f"{self.code} - {self.first_name} {self.last_name or ''}".strip()